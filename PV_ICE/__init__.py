@@ -11,3 +11,6 @@ except PackageNotFoundError:
 
 from PV_ICE.main import Simulation, Scenario, Material, weibull_params, weibull_cdf, calculateLCA, weibull_cdf_vis
 from PV_ICE.main import sens_StageImprovement, sens_StageEfficiency
+from PV_ICE.main import CohortMatrix, RegionResults, Surrogate
+from PV_ICE.main import ScenarioOverlay, MaterialOverlay
+from PV_ICE.main import runShards, aggregateScenario, reducedPercentiles
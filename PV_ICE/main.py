@@ -15,11 +15,67 @@ import datetime
 import os
 import matplotlib.pyplot as plt
 import itertools
+import functools
+import copy
+import collections
+import threading
+import hashlib
+import concurrent.futures
+from multiprocessing import shared_memory
 from pathlib import Path
 
 global DATA_PATH # path to data files including module.json.  Global context
 DATA_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), 'baselines'))
 
+# Number of (alpha, beta, horizon) Weibull tables kept in memory
+WEIBULL_CACHE_SIZE = 256
+
+# Number of scenarios calculated between checkpoints of calculateFlows
+CHECKPOINT_SCENARIOS = 16
+
+# Number of scenarios calculated at a time by calculateFlows with reducers
+REDUCE_SCENARIOS = 16
+
+# Number of per-unit-area cohort responses kept by calculateMassFlow with
+# impulseresponse
+IMPULSE_CACHE_SIZE = 16
+
+# Results gathered back from parallel workers, for scenarios and materials
+_SCENARIO_OUTPUTS = ['dataOut_m', 'dataOut_e', 'dataOut_c', '_debugMatrices_m']
+_MATERIAL_OUTPUTS = ['matdataOut_m', 'matdataOut_e', 'matdataOut_c']
+# Inputs that can be handed to parallel workers through shared memory
+_SCENARIO_INPUTS = ['dataIn_m', 'dataIn_e']
+_MATERIAL_INPUTS = ['matdataIn_m', 'matdataIn_e']
+# Module inputs of the cohort calculations, besides the Weibull parameters
+_COHORT_INPUTS = ['mod_eff', 'irradiance_stc', 'mod_degradation',
+                  'mod_lifetime', 'mod_EOL_collection_eff', 'mod_MerchantTail',
+                  'mod_EOL_pg0_resell', 'mod_Repair']
+# EOL paths that calculateMassFlow stops on if they add to more than 100%,
+# and the landfill path it sets to their remainder if the landfill makes
+# them go over 100%
+_EOL_PATH_GROUPS = {'mod_EOL_pg1_landfill': [
+                        'mod_EOL_pg0_resell', 'mod_EOL_pg2_stored',
+                        'mod_EOL_pg3_reMFG', 'mod_EOL_pg4_recycled'],
+                    'mod_EOL_pb1_landfill': [
+                        'mod_EOL_pb2_stored', 'mod_EOL_pb3_reMFG',
+                        'mod_EOL_pb4_recycled']}
+# Inputs the mass flows can be differentiated by: the yearly percentages of
+# the cohort, EOL and manufacturing stages, and the material columns.
+# Lifetimes, degradation, reliability and installs move retirement ages or
+# the installed area and are not differentiated.
+_DERIVATIVE_INPUTS = [
+    'mod_MFG_eff', 'mod_Repair', 'mod_MerchantTail', 'mod_EOL_collection_eff',
+    'mod_EOL_pg0_resell', 'mod_EOL_pg1_landfill', 'mod_EOL_pg2_stored',
+    'mod_EOL_pg3_reMFG', 'mod_EOL_pg4_recycled', 'mod_EOL_reMFG_yield',
+    'mod_EOL_sp_reMFG_recycle', 'mod_EOL_pb1_landfill', 'mod_EOL_pb2_stored',
+    'mod_EOL_pb3_reMFG', 'mod_EOL_pb4_recycled']
+_MATERIAL_DERIVATIVE_INPUTS = [
+    'mat_virgin_eff', 'mat_massperm2', 'mat_MFG_eff', 'mat_MFG_scrap_Recycled',
+    'mat_MFG_scrap_Recycling_eff', 'mat_MFG_scrap_Recycled_into_HQ',
+    'mat_MFG_scrap_Recycled_into_HQ_Reused4MFG', 'mat_PG3_ReMFG_target',
+    'mat_ReMFG_yield', 'mat_PG4_Recycling_target', 'mat_Recycling_yield',
+    'mat_EOL_Recycled_into_HQ', 'mat_EOL_RecycledHQ_Reused4MFG']
+
 
 def read_baseline_material(scenario, material='None', file=None):
 
@@ -315,6 +371,7 @@ class Simulation:
     name : text to append to output files
     nowstr : current date/time string
     path : working directory with circular economy results
+    dtype : floating point type of the mass and energy flows calculated
 
     Methods
     -------
@@ -323,7 +380,8 @@ class Simulation:
 
     """
 
-    def __init__(self, name=None, path=None, baselinepath=None):
+    def __init__(self, name=None, path=None, baselinepath=None,
+                 dtype=None):
         '''
         initialize ScenarioObj with path of Scenario's baseline of module and
         materials as well as a basename to append to
@@ -332,6 +390,15 @@ class Simulation:
         ----------
         name: string, append temporary and output files with this value
         path: location of Radiance materials and objects
+        dtype: numpy floating point type of the mass and energy flows,
+            np.float64 (default) or np.float32. float32 halves the memory of
+            the results for large sweeps. On baseline_modules_mass_US.csv
+            (7 materials, mass and energy) every float32 output is within
+            1e-5 of the peak of the same float64 column, and within 1e-6 of
+            the largest flow of its dataframe. Columns that are only a
+            cancellation residual (float64 peak below 1e-3 of the largest
+            flow, i.e. scrap landfilled with 100% recycling) are bounded by
+            the latter.
 
         Returns
         -------
@@ -361,8 +428,930 @@ class Simulation:
         else:
             self.baselinepath = baselinepath
 
+        if dtype is None:
+            dtype = np.float64
+        self.dtype = np.dtype(dtype)
+
         self.scenario = {}
 
+    def _flowDtype(self, dtype=None):
+        # Simulations pickled before dtype existed run in float64.
+        if dtype is None:
+            dtype = getattr(self, 'dtype', np.float64)
+        return np.dtype(dtype)
+
+    def _calculateParallel(self, method, scenarios, materials, n_jobs,
+                           sharedmemory=False, **kwargs):
+        '''
+        Runs one of the calculate methods with the scenarios split in
+        ``n_jobs`` contiguous chunks over a process pool, and gathers the
+        outputs back onto ``self.scenario`` in the scenarios order.
+
+        Parameters
+        ----------
+        method : str
+            Name of the Simulation method, i.e. 'calculateMassFlow'.
+        scenarios : None, str or list
+            Scenarios to calculate. Defaults to all of them.
+        materials : None, str or list
+            Materials to calculate. Defaults to the materials of the first
+            scenario, for all the chunks.
+        n_jobs : int
+            Number of processes. -1 uses all the CPUs.
+        sharedmemory : bool
+            If True, the input dataframes of each chunk are packed into a
+            shared memory block that workers read without copies, and the
+            output dataframes come back the same way instead of pickled.
+        '''
+        if scenarios is None:
+            scenarios = list(self.scenario.keys())
+        elif isinstance(scenarios, str):
+            scenarios = [scenarios]
+
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        if n_jobs < 0:
+            n_jobs = os.cpu_count()
+        n_jobs = max(1, min(n_jobs, len(scenarios)))
+
+        # Each worker receives a shallow copy of the simulation holding only
+        # its chunk of scenarios.
+        sims = []
+        blocks = []
+        for chunk in np.array_split(np.arange(len(scenarios)), n_jobs):
+            sim = copy.copy(self)
+            sim.scenario = {scenarios[ii]: self.scenario[scenarios[ii]]
+                            for ii in chunk}
+            if sharedmemory:
+                sim, frames = _detachInputs(sim)
+                blocks.append(_packFrames(frames))
+            sims.append(sim)
+        shared = [(shm.name, layout) for shm, layout in blocks]
+
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                results = list(pool.map(_calculateScenarios, sims,
+                                        [method]*n_jobs, [materials]*n_jobs,
+                                        [kwargs]*n_jobs,
+                                        shared or [None]*n_jobs))
+        finally:
+            for shm, layout in blocks:
+                shm.close()
+                shm.unlink()
+
+        if sharedmemory:
+            results = [_collectOutputs(*result) for result in results]
+
+        for outputs in results:
+            self._setOutputs(outputs)
+
+    def _setOutputs(self, outputs):
+        '''
+        Sets the outputs calculated elsewhere, as returned by
+        ``_scenarioOutputs``, on the scenarios and materials of ``self``.
+        '''
+        for scen, (scenoutputs, matoutputs) in outputs.items():
+            if '_debugMatrices_m' in scenoutputs:
+                self.scenario[scen].__dict__.pop('_dataDebug_m', None)
+                self.scenario[scen].__dict__.pop('dataDebug_m', None)
+            for attribute, value in scenoutputs.items():
+                setattr(self.scenario[scen], attribute, value)
+            for mat, attributes in matoutputs.items():
+                for attribute, value in attributes.items():
+                    setattr(self.scenario[scen].material[mat], attribute,
+                            value)
+
+    def _calculateCheckpointed(self, folder, resume, scenarios, materials,
+                               **kwargs):
+        '''
+        ``calculateFlows`` saving the outputs of every scenario to ``folder``
+        as soon as its chunk of scenarios is done, and recording them in
+        ``manifest.json`` with a fingerprint of their inputs and the
+        arguments. With ``resume``, scenarios already in the manifest are
+        loaded instead of calculated, unless their fingerprint changed.
+        '''
+        import json
+
+        if scenarios is None:
+            scenarios = list(self.scenario.keys())
+        elif isinstance(scenarios, str):
+            scenarios = [scenarios]
+
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        fingerprints = {scen: _checkpointFingerprint(
+            self.scenario[scen], materials, kwargs) for scen in scenarios}
+
+        os.makedirs(folder, exist_ok=True)
+        manifestfile = os.path.join(folder, 'manifest.json')
+        manifest = {'materials': materials, 'done': {}, 'fingerprints': {}}
+        loaded = []
+        if resume and os.path.isfile(manifestfile):
+            with open(manifestfile) as inp:
+                manifest = json.load(inp)
+            manifest.setdefault('fingerprints', {})
+            for scen, filename in manifest['done'].items():
+                if scen in scenarios and (manifest['fingerprints'].get(scen)
+                                          == fingerprints[scen]):
+                    _loadCheckpoint(self.scenario[scen],
+                                    os.path.join(folder, filename))
+                    loaded.append(scen)
+            print("Resuming from checkpoint:", len(loaded),
+                  "scenarios done")
+
+        todo = [scen for scen in scenarios if scen not in loaded]
+        for start in range(0, len(todo), CHECKPOINT_SCENARIOS):
+            chunk = todo[start:start+CHECKPOINT_SCENARIOS]
+            self.calculateFlows(scenarios=chunk, materials=materials,
+                                **kwargs)
+
+            for scen in chunk:
+                if self.scenario[scen].__dict__.get('dataOut_e') is None:
+                    # Stopped by the input checks, nothing to save.
+                    continue
+                filename = manifest['done'].get(
+                    scen, 'scenario_{:05d}.npz'.format(len(manifest['done'])))
+                _saveCheckpoint(self.scenario[scen], materials,
+                                os.path.join(folder, filename))
+                manifest['done'][scen] = filename
+                manifest['fingerprints'][scen] = fingerprints[scen]
+
+            partial = manifestfile + '.tmp'
+            with open(partial, 'w') as outp:
+                json.dump(manifest, outp, indent=1)
+            os.replace(partial, manifestfile)
+
+    def _calculateReduced(self, reducers, scenarios, materials, **kwargs):
+        '''
+        ``calculateFlows`` in chunks of ``REDUCE_SCENARIOS`` scenarios,
+        passing each finished scenario to the ``reducers`` and dropping its
+        outputs afterwards.
+        '''
+        if scenarios is None:
+            scenarios = list(self.scenario.keys())
+        elif isinstance(scenarios, str):
+            scenarios = [scenarios]
+
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        reduced = {name: {} for name in reducers}
+        for start in range(0, len(scenarios), REDUCE_SCENARIOS):
+            chunk = scenarios[start:start+REDUCE_SCENARIOS]
+            self.calculateFlows(scenarios=chunk, materials=materials,
+                                **kwargs)
+
+            for scen in chunk:
+                scenario = self.scenario[scen]
+                if scenario.__dict__.get('dataOut_e') is not None:
+                    for name, reducer in reducers.items():
+                        reduced[name][scen] = reducer(scenario)
+                _dropOutputs(scenario)
+
+        self.reduced = reduced
+        return reduced
+
+    def _unitResponses(self, modinputs, weibullParams, dtype, **limits):
+        '''
+        Per-unit-area cohort responses of a batch of scenarios. Responses
+        are calculated in one pass for the distinct module inputs of the
+        batch, and cached on the simulation (``IMPULSE_CACHE_SIZE``).
+
+        Returns
+        -------
+        keys : list
+            Key of the response of each scenario of the batch.
+        found : dict
+            Responses by key: 'yearly' is a (names, generation x (output,
+            year) array) pair with the yearly outputs of a unit area
+            installed on each generation, and 'area_PG', 'area_L0' and
+            'area_PB' are the unit-area cohort matrices.
+        '''
+        keys = []
+        for ss, params in enumerate(weibullParams):
+            digest = hashlib.sha1(repr((
+                np.dtype(dtype).str, sorted(limits.items()),
+                [(p['alpha'], p['beta']) for p in params])).encode())
+            for field in _COHORT_INPUTS:
+                digest.update(np.ascontiguousarray(
+                    modinputs[field][ss], dtype=np.float64).tobytes())
+            keys.append(digest.hexdigest())
+
+        cache = self.__dict__.setdefault('_impulseResponses', {})
+        found = {key: cache[key] for key in keys if key in cache}
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        if missing:
+            rows = [keys.index(key) for key in missing]
+            _, responses = _cohortMassFlows(
+                area=np.ones((len(rows), modinputs['Area'].shape[-1])),
+                weibullalpha=[[p['alpha'] for p in weibullParams[row]]
+                              for row in rows],
+                weibullbeta=[[p['beta'] for p in weibullParams[row]]
+                             for row in rows],
+                dtype=dtype, responses=True,
+                **{field: modinputs[field][rows] for field in _COHORT_INPUTS},
+                **limits)
+            # The yearly responses of all the outputs are kept dense, side
+            # by side, as a generation x (output, year) matrix.
+            names = [name for name in responses if name != 'area_PB']
+            dense = np.concatenate([responses[name].toDense()
+                                    for name in names], axis=-1)
+            for ii, key in enumerate(missing):
+                found[key] = {'yearly': (names, dense[ii])}
+                for name in ['area_PG', 'area_L0', 'area_PB']:
+                    found[key][name] = responses[name][ii]
+                cache[key] = found[key]
+            while len(cache) > IMPULSE_CACHE_SIZE:
+                del cache[next(iter(cache))]
+
+        return keys, found
+
+    def _impulseCohorts(self, modinputs, weibullParams, dtype, **limits):
+        '''
+        Cohort flows of a batch of scenarios from per-unit-area responses.
+        With the module, Weibull and EOL inputs fixed, the cohort flows are
+        linear on the area installed, so each scenario's matrices are its
+        unit-area cohort matrices scaled by its area of each generation,
+        and the yearly flows are the products of its area by the
+        upper-triangular unit responses (see ``_unitResponses``).
+
+        Returns
+        -------
+        yearly, matrices : dict
+            Same as ``_cohortMassFlows``.
+        '''
+        keys, found = self._unitResponses(modinputs, weibullParams, dtype,
+                                          **limits)
+
+        area = np.nan_to_num(np.asarray(modinputs['Area'], dtype=dtype))
+        nyears = area.shape[-1]
+        groups = {}
+        for ss, key in enumerate(keys):
+            groups.setdefault(key, []).append(ss)
+
+        names = found[keys[0]]['yearly'][0]
+        yearly = np.empty((len(keys), len(names)*nyears), dtype=dtype)
+        for key, rows in groups.items():
+            yearly[rows] = area[rows] @ found[key]['yearly'][1]
+        yearly = {name: yearly[:, ii*nyears:(ii+1)*nyears]
+                  for ii, name in enumerate(names)}
+
+        matrices = {}
+        for name in ['area_PG', 'area_L0', 'area_PB']:
+            # Lifetimes set the bandwidth of each response; shorter ones
+            # are a prefix of the longer.
+            bandwidth = max(found[key][name].bandwidth for key in groups)
+            matrix = CohortMatrix(nyears, bandwidth, (len(keys),), dtype)
+            generations, _ = matrix._indices()
+            for key, rows in groups.items():
+                data = found[key][name].data
+                matrix.data[rows, :data.shape[-1]] = (
+                    data * area[rows][:, generations[:data.shape[-1]]])
+            matrices[name] = matrix
+
+        return yearly, matrices
+
+    def _solveCapacityTarget(self, modinputs, weibullParams, target, dtype,
+                             **limits):
+        '''
+        Area to install each year so that the effective capacity of a
+        batch of scenarios follows ``target``. The effective capacity of a
+        year is the power left of every generation installed before, plus
+        the nameplate power of the new installs, so with the unit power
+        responses of the generations (``_unitResponses``) the installs are
+        solved in one forward pass over the years:
+
+            area[t] = max(0, (target[t] - sum_g<t area[g]*power[g, t])
+                             / power[t, t])
+
+        Parameters
+        ----------
+        target : numpy array
+            Effective capacity [W] of shape (S, N). Years with NaN keep the
+            area of ``modinputs``.
+
+        Returns
+        -------
+        area : numpy array
+            Area [m2] to install, of shape (S, N).
+        '''
+        keys, found = self._unitResponses(modinputs, weibullParams, dtype,
+                                          **limits)
+        names, _ = found[keys[0]]['yearly']
+        nyears = target.shape[-1]
+        column = names.index('power_active')*nyears
+        power = np.stack([found[key]['yearly'][1][:, column:column+nyears]
+                          for key in keys]).astype(float)
+
+        area = np.nan_to_num(np.array(modinputs['Area'], dtype=float))
+        for year in range(nyears):
+            active = np.einsum('sg,sg->s', area[:, :year],
+                               power[:, :year, year])
+            nameplate = power[:, year, year]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                needed = np.where(nameplate > 0,
+                                  (target[:, year] - active)/nameplate, 0.0)
+            area[:, year] = np.where(np.isnan(target[:, year]),
+                                     area[:, year], np.maximum(needed, 0.0))
+        return area
+
+    def calculateRegions(self, installs, scenarios=None, materials=None,
+                         reducer=None, **kwargs):
+        '''
+        Calculates the mass flows of many regions, i.e. ReEDS PCAs or
+        states, sharing the module and material baselines of each scenario,
+        in batched engine passes of ``REDUCE_SCENARIOS`` regions. Regions
+        are added as overlays of their scenario with their own installs,
+        reduced and dropped. Only the installs change between the regions of
+        a scenario, so by default they run with ``impulseresponse`` and share
+        its cohort calculations.
+
+        Parameters
+        ----------
+        installs : pd.DataFrame or dict
+            New installed capacity [MW] with one column per region, indexed
+            by year, for all scenarios, or a {scenario: DataFrame} dict.
+            Years of a scenario missing from the table get no installs.
+        scenarios : None, str or list
+            Scenarios with the baselines of the regions. Defaults to all of
+            them. They must have the same years.
+        materials : None, str or list
+            Materials to calculate. Defaults to the materials of the first
+            scenario.
+        reducer : function
+            Function of each region's calculated scenario returning a year by
+            metric DataFrame. Defaults to ``aggregateScenario``.
+        **kwargs
+            Other arguments of ``calculateMassFlow``. ``impulseresponse``
+            defaults to True.
+
+        Returns
+        -------
+        RegionResults
+            Scenario x region x year x metric array of the reduced results.
+        '''
+        if scenarios is None:
+            scenarios = list(self.scenario.keys())
+        elif isinstance(scenarios, str):
+            scenarios = [scenarios]
+
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        if reducer is None:
+            reducer = functools.partial(aggregateScenario,
+                                        materials=materials)
+        if not isinstance(installs, dict):
+            installs = {scen: installs for scen in scenarios}
+        regions = list(installs[scenarios[0]].columns)
+        kwargs.setdefault('impulseresponse', True)
+
+        tables = {}
+        for scen in scenarios:
+            years = self.scenario[scen].dataIn_m['year'].values
+            table = installs[scen].reindex(index=years, columns=regions)
+            tables[scen] = table.fillna(0.0)
+        keys = [(scen, region) for scen in scenarios for region in regions]
+
+        values = None
+        for start in range(0, len(keys), REDUCE_SCENARIOS):
+            chunk = keys[start:start+REDUCE_SCENARIOS]
+            try:
+                for scen, region in chunk:
+                    self.overlayScenario(scen, (scen, region), [
+                        ('new_Installed_Capacity_[MW]',
+                         tables[scen][region].values)])
+                self.calculateMassFlow(scenarios=chunk, materials=materials,
+                                       **kwargs)
+                for ii, key in enumerate(chunk, start):
+                    reduced = reducer(self.scenario[key])
+                    if values is None:
+                        years = list(reduced.index)
+                        metrics = list(reduced.columns)
+                        values = np.empty((len(keys),) + reduced.shape)
+                    values[ii] = reduced.values
+            finally:
+                for key in chunk:
+                    self.scenario.pop(key, None)
+
+        return RegionResults(
+            values.reshape(len(scenarios), len(regions), len(years),
+                           len(metrics)), scenarios, regions, years, metrics)
+
+    def calculateJacobian(self, scenario, outputs, fields, materials=None,
+                          years=None, method='calculateMassFlow', **kwargs):
+        '''
+        Derivatives of the ``outputs`` of ``scenario`` with respect to its
+        input ``fields`` on each year. They are calculated in forward mode
+        (see ``derivatives`` on ``calculateMassFlow``): the derivatives of
+        the inputs are carried along the cohort area matrices, the EOL
+        pathways and the material flows in the same pass as the outputs.
+        Outputs are piecewise linear on the EOL and recycling percentages
+        and the mass per m2, and smooth on the manufacturing efficiencies.
+        Their kinks (i.e. a recycling surplus carried over that runs out,
+        or a failure cap) are taken on the branch calculated. The energy
+        flows are linear on the mass flows, so their derivatives follow
+        from those with the energy inputs fixed.
+
+        Parameters
+        ----------
+        scenario : str
+            Scenario to differentiate. It is calculated as well.
+        outputs : str or list
+            Output columns of ``dataOut_m`` or ``matdataOut_m`` (and
+            ``dataOut_e`` or ``matdataOut_e`` with 'calculateFlows').
+        fields : str or list
+            Input columns of ``dataIn_m`` (the repair, merchant tail,
+            collection, EOL paths, reMFG yield and split, and manufacturing
+            efficiency percentages), or (material, column) tuples for the
+            columns of ``matdataIn_m``. Inputs that move retirement ages or
+            the installed area raise a ValueError.
+        materials : None, str or list
+            Materials to calculate. Defaults to all the scenario materials.
+        years : list
+            Years of the inputs. Defaults to all of them.
+        method : str
+            'calculateMassFlow' (default) or 'calculateFlows', with its
+            defaults for the mass flows.
+        **kwargs
+            Other arguments of ``calculateMassFlow``. The flows are always
+            calculated in float64, whatever the ``dtype``.
+
+        Returns
+        -------
+        jacobian : pd.DataFrame
+            Derivatives with rows indexed by (source, output, year) and
+            columns by (source, field, year), where source is 'module' or
+            the material name.
+        '''
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        if isinstance(fields, (str, tuple)):
+            fields = [fields]
+        fields = [('module', field) if isinstance(field, str) else
+                  tuple(field) for field in fields]
+        if method not in ('calculateMassFlow', 'calculateFlows'):
+            raise ValueError("method must be 'calculateMassFlow' or "
+                             "'calculateFlows'.")
+
+        base = self.scenario[scenario]
+        if materials is None:
+            materials = list(base.material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+        kwargs['dtype'] = np.float64
+        if method == 'calculateFlows':
+            kwargs.setdefault('reducecapacity', True)
+
+        if years is None:
+            years = _inputFrame(base, 'dataIn_m')['year'].values
+        directions = [(source, field, year) for source, field in fields
+                      for year in years]
+
+        self.calculateMassFlow(scenarios=scenario, materials=materials,
+                               derivatives=directions, **kwargs)
+        if 'dataOut_m' not in base.__dict__:
+            return None
+        derived = base.__dict__.pop('_derivatives_m')
+        frames = [('module', base.dataOut_m, derived['module'])]
+        frames += [(mat, base.material[mat].matdataOut_m, derived[mat])
+                   for mat in materials]
+
+        if method == 'calculateFlows':
+            self.calculateEnergyFlow(scenarios=scenario, materials=materials,
+                                     dtype=np.float64)
+            index = base.dataOut_m.index
+            # Module energy flows scale the mass flows, but the energy out,
+            # which scales the capacity by the irradiance.
+            dmodule = {column: derived['module'].get(column, 0.0)
+                       for column in base.dataOut_m}
+            dmodule['irradiance_stc'] = base.dataOut_m['irradiance_stc'].values
+            modEnergy = _stackColumns([_inputFrame(
+                base, 'dataIn_e').reindex(index)])
+            frames.append(('module', base.dataOut_e,
+                           _moduleEnergyFlows(dmodule, modEnergy)))
+            for mat in materials:
+                material = base.material[mat]
+                if getattr(material, 'matdataOut_e', None) is None:
+                    continue
+                matEnergy = _stackColumns([_inputFrame(
+                    material, 'matdataIn_e').reindex(
+                        material.matdataOut_m.index)])
+                frames.append((mat, material.matdataOut_e,
+                               _materialEnergyFlows(derived[mat], matEnergy)))
+
+        rows, blocks = [], []
+        for source, df, derivatives in frames:
+            for output in outputs:
+                if output in df and (source, output) not in rows:
+                    rows.append((source, output))
+                    blocks.append(np.broadcast_to(
+                        derivatives.get(output, 0.0),
+                        (len(directions), len(df))).T)
+
+        outputyears = _inputFrame(base, 'dataIn_m')['year'].values
+        index = pd.MultiIndex.from_tuples(
+            [key + (year,) for key in rows for year in outputyears],
+            names=['source', 'output', 'year'])
+        columns = pd.MultiIndex.from_tuples(directions,
+                                            names=['source', 'field', 'year'])
+        return pd.DataFrame(np.concatenate(blocks) if blocks else
+                            np.empty((0, len(directions))),
+                            index=index, columns=columns)
+
+    def _addLevers(self, scenario, name, labels, point):
+        '''
+        Adds overlay ``name`` of ``scenario`` with the levers ``labels``,
+        as returned by ``_leverBounds``, set to the values of ``point``.
+        '''
+        self.overlayScenario(scenario, name)
+        for (source, field, start_year, end_year), value in zip(labels, point):
+            overlay = self.scenario[name]
+            if source != 'module':
+                overlay = overlay.material[source]
+            overlay.addEdit(field, value, start_year, end_year)
+
+    def _evaluateLevers(self, scenario, labels, points, reducer, materials,
+                        method, **kwargs):
+        '''
+        Calculates overlays of ``scenario`` with the levers ``labels`` set to
+        each of ``points``, ``REDUCE_SCENARIOS`` at a time in batched passes,
+        and returns the ``reducer`` of each calculated overlay (None if the
+        input checks stopped it). Overlays are removed afterwards. Mass
+        flows run with ``impulseresponse`` by default, unless the levers
+        change the cohort calculations.
+        '''
+        if method == 'calculateMassFlow':
+            kwargs.setdefault('impulseresponse', not any(
+                source == 'module' and field in _COHORT_INPUTS + [
+                    'mod_reliability_t50', 'mod_reliability_t90']
+                for source, field, _, _ in labels))
+        results = []
+        for start in range(0, len(points), REDUCE_SCENARIOS):
+            names = []
+            try:
+                for ii, point in enumerate(points[start:start+REDUCE_SCENARIOS]):
+                    names.append(('_evaluateLevers', scenario, start + ii))
+                    self._addLevers(scenario, names[-1], labels, point)
+                getattr(self, method)(scenarios=names, materials=materials,
+                                      **kwargs)
+                for key in names:
+                    scen = self.scenario[key]
+                    if getattr(scen, 'dataOut_m', None) is None:
+                        results.append(None)
+                    else:
+                        results.append(reducer(scen))
+            finally:
+                for key in names:
+                    del self.scenario[key]
+        return results
+
+    def optimizeLevers(self, scenario, levers, objective=None,
+                       constraints=None, x0=None, name=None, materials=None,
+                       maxiter=100, xtol=1e-4, method='calculateMassFlow',
+                       **kwargs):
+        '''
+        Finds the values of bounded circularity levers (input fields set
+        over a range of years) that minimize ``objective`` subject to
+        ``constraints`` on the outputs of ``scenario``, i.e. the lowest
+        recycling yield after 2025 that keeps the silver virgin stock of
+        2035 under a limit.
+
+        The search is a bounded compass (pattern) search: each iteration
+        steps every lever up and down from the best point on overlays of
+        the scenario, calculated in batched passes of ``REDUCE_SCENARIOS``,
+        moves to the best of them if it improves, and halves the step
+        otherwise. Points are compared first by their constraint violation
+        and then by their objective, so outputs do not need derivatives or
+        scaling. When no lever changes the module cohort inputs, the mass
+        flows run with ``impulseresponse`` by default and reuse the cached
+        cohorts on every iteration. Evaluated points are not calculated
+        again.
+
+        Parameters
+        ----------
+        scenario : str
+            Scenario with the baseline inputs. It is not modified.
+        levers : list
+            (field, lower, upper, start_year, end_year) decision variables.
+            ``field`` is a column of ``dataIn_m`` or a (material, column)
+            tuple of ``matdataIn_m``; the years are optional and default to
+            all years.
+        objective : function
+            Function of a calculated scenario returning the value to
+            minimize, i.e. ``lambda scen: aggregateScenario(scen).loc[2035,
+            'VirginStock_silver_[Tonnes]']``. If None, the search stops at
+            the first point meeting the constraints.
+        constraints : list
+            Functions of a calculated scenario that must be <= 0.
+        x0 : list
+            Starting lever values. Defaults to the mean of each field over
+            its years on the scenario, within the bounds.
+        name : str
+            If given, the best levers are kept as the overlay scenario
+            ``name`` of ``scenario``, with its outputs calculated.
+        materials : None, str or list
+            Materials to calculate. Defaults to all the scenario materials.
+        maxiter : int
+            Maximum number of iterations.
+        xtol : float
+            Search stops when the step is below this fraction of the range
+            of the levers.
+        method : str
+            'calculateMassFlow' (default) or 'calculateFlows'.
+        **kwargs
+            Other arguments of ``method``.
+
+        Returns
+        -------
+        result : dict
+            'x' (Series of the best lever values), 'objective', 'violation'
+            (sum of the positive constraints), 'success' (no violation),
+            'iterations' and 'evaluations' (scenarios calculated).
+        '''
+        if constraints is None:
+            constraints = []
+        base = self.scenario[scenario]
+        if materials is None:
+            materials = list(base.material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+        labels, lower, upper = _leverBounds(levers)
+
+        if x0 is None:
+            x0 = []
+            for source, field, start_year, end_year in labels:
+                df = (base.dataIn_m if source == 'module'
+                      else base.material[source].matdataIn_m)
+                select = np.ones(len(df), dtype=bool)
+                if start_year is not None:
+                    select &= (df['year'] >= start_year).values
+                if end_year is not None:
+                    select &= (df['year'] <= end_year).values
+                x0.append(df.loc[select, field].mean())
+        x = np.clip(np.asarray(x0, dtype=float), lower, upper)
+
+        def _rank(scen):
+            violation = sum(max(0.0, constraint(scen))
+                            for constraint in constraints)
+            return violation, 0.0 if objective is None else objective(scen)
+
+        evaluated = {}
+
+        def _evaluate(points):
+            todo = list(dict.fromkeys(tuple(point) for point in points
+                                      if tuple(point) not in evaluated))
+            results = self._evaluateLevers(scenario, labels, todo, _rank,
+                                           materials, method, **kwargs)
+            for point, result in zip(todo, results):
+                # Points stopped by the input checks rank last
+                evaluated[point] = (np.inf, np.inf) if result is None \
+                    else result
+            return [evaluated[tuple(point)] for point in points]
+
+        best = _evaluate([x])[0]
+        fraction = 0.25
+        iterations = 0
+        while iterations < maxiter and fraction >= xtol:
+            if objective is None and best[0] == 0:
+                break
+            iterations += 1
+            polls = []
+            for ii in range(len(x)):
+                for sign in [1, -1]:
+                    point = x.copy()
+                    point[ii] = np.clip(
+                        x[ii] + sign*fraction*(upper[ii] - lower[ii]),
+                        lower[ii], upper[ii])
+                    if point[ii] != x[ii]:
+                        polls.append(point)
+            results = _evaluate(polls)
+            if polls:
+                jj = min(range(len(polls)), key=lambda ii: results[ii])
+            if polls and results[jj] < best:
+                x, best = polls[jj], results[jj]
+            else:
+                fraction = fraction/2
+
+        if name is not None:
+            self._addLevers(scenario, name, labels, x)
+            getattr(self, method)(scenarios=name, materials=materials,
+                                  **kwargs)
+
+        return {'x': pd.Series(x, index=pd.MultiIndex.from_tuples(
+                    labels, names=['source', 'field', 'start_year',
+                                   'end_year'])),
+                'objective': best[1], 'violation': best[0],
+                'success': best[0] == 0, 'iterations': iterations,
+                'evaluations': len(evaluated)}
+
+    def trainSurrogate(self, scenario, levers, metrics, degree=2,
+                       nsamples=None, seed=None, materials=None,
+                       method='calculateMassFlow', **kwargs):
+        '''
+        Trains a ``Surrogate`` emulator of ``aggregateScenario`` metrics of
+        ``scenario`` over the box of ``levers``, for what-if queries that
+        do not run the engine. The levers are sampled on a Latin hypercube,
+        and the samples are calculated as overlays of the scenario in
+        batched passes of ``REDUCE_SCENARIOS``, reduced to the metrics and
+        dropped.
+
+        Parameters
+        ----------
+        scenario : str
+            Scenario with the baseline inputs. It is not modified.
+        levers : list
+            (field, lower, upper, start_year, end_year) inputs to vary, as
+            in ``optimizeLevers``.
+        metrics : str or list
+            Columns of ``aggregateScenario`` to emulate, i.e.
+            'VirginStock_Module_[Tonnes]'.
+        degree : int
+            Total degree of the polynomials.
+        nsamples : int
+            Number of engine runs. Defaults to twice the number of
+            polynomial terms.
+        seed : int
+            Seed of the sampling.
+        materials : None, str or list
+            Materials to calculate. Defaults to all the scenario materials.
+        method : str
+            'calculateMassFlow' (default) or 'calculateFlows'.
+        **kwargs
+            Other arguments of ``method``, also used by
+            ``Surrogate.validate``.
+
+        Returns
+        -------
+        Surrogate
+        '''
+        if isinstance(metrics, str):
+            metrics = [metrics]
+        if materials is None:
+            materials = list(self.scenario[scenario].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        labels, lower, upper = _leverBounds(levers)
+        exponents = _totalDegreeExponents(len(labels), degree)
+        if nsamples is None:
+            nsamples = 2*len(exponents)
+        if nsamples <= len(exponents):
+            raise ValueError("nsamples must be above the {} polynomial "
+                             "terms.".format(len(exponents)))
+
+        rng = np.random.default_rng(seed)
+        points = lower + _latinHypercube(nsamples, len(labels), rng)*(
+            upper - lower)
+        outputs = self._evaluateLevers(
+            scenario, labels, points,
+            lambda scen: aggregateScenario(scen, materials)[metrics],
+            materials, method, **kwargs)
+        done = [ii for ii, output in enumerate(outputs) if output is not None]
+
+        surrogate = Surrogate(labels, lower, upper, metrics,
+                              list(outputs[done[0]].index), exponents,
+                              settings={'scenario': scenario,
+                                        'materials': materials,
+                                        'method': method})
+        surrogate.kwargs = kwargs
+        surrogate.fit(points[done],
+                      np.stack([outputs[ii].values for ii in done]))
+        return surrogate
+
+    def writeShards(self, folder, definitions=None, shardsize=1,
+                    method='calculateFlows', materials=None, **kwargs):
+        '''
+        Writes the scenarios of a sweep as shard files to ``folder``, to be
+        calculated by any number of processes or hosts sharing that folder
+        with ``runShards``, and merged back with ``reduceShards``.
+
+        The bases of the overlays and their copies of the base inputs are
+        written once to ``bases.pkl``, without results, and shards only
+        refer to them, so a shard of overlays carries their edits.
+
+        Parameters
+        ----------
+        folder : str
+            Folder for the shards, locks and results. Created if needed. The
+            shards, results and locks of a previous sweep in it are removed.
+        definitions : list
+            Scenarios to calculate: names of scenarios of the simulation, or
+            (name, base, edits) tuples, added first as overlays of scenario
+            ``base`` with ``overlayScenario``. Defaults to all scenarios.
+            The overlays stay on the simulation, so ``reduceShards`` can
+            merge their results; delete them from ``scenario`` afterwards
+            if not needed.
+        shardsize : int
+            Number of scenarios per shard.
+        method : str
+            Simulation method the shards run, i.e. 'calculateMassFlow'.
+        materials : None, str or list
+            Materials to calculate. Defaults to the materials of the first
+            scenario.
+        **kwargs
+            Other arguments of ``method``.
+
+        Returns
+        -------
+        shards : list
+            Paths of the shard files written.
+        '''
+        import pickle
+
+        if definitions is None:
+            definitions = list(self.scenario.keys())
+        scenarios = []
+        for definition in definitions:
+            if isinstance(definition, str):
+                scenarios.append(definition)
+            else:
+                name, base, edits = definition
+                self.overlayScenario(base, name, edits)
+                scenarios.append(name)
+
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        elif isinstance(materials, str):
+            materials = [materials]
+
+        # Objects written once to bases.pkl, by id of the objects the
+        # shards refer to.
+        references = {}
+        bases = []
+        stripped = {}
+        for scen in scenarios:
+            scenario = self.scenario[scen]
+            for overlay in [scenario] + list(scenario.material.values()):
+                if not isinstance(overlay, _Overlay):
+                    continue
+                for obj in [overlay.base] + list(overlay._snapshot.values()):
+                    if obj is not None and id(obj) not in references:
+                        references[id(obj)] = len(bases)
+                        bases.append(obj if isinstance(obj, pd.DataFrame)
+                                     else _withoutOutputs(obj, stripped))
+
+        os.makedirs(folder, exist_ok=True)
+        # Results and locks left by a previous sweep would be taken as done
+        # or claimed
+        for pattern in ['shard_*', 'result_*', 'bases.pkl']:
+            for old in Path(folder).glob(pattern):
+                os.remove(old)
+        with open(os.path.join(folder, 'bases.pkl'), 'wb') as outp:
+            pickle.dump(bases, outp, pickle.HIGHEST_PROTOCOL)
+
+        shards = []
+        for ii, start in enumerate(range(0, len(scenarios), shardsize)):
+            sim = copy.copy(self)
+            for attribute in ['reduced', 'USyearly', 'UScum',
+                              '_impulseResponses']:
+                sim.__dict__.pop(attribute, None)
+            sim.scenario = {scen: self.scenario[scen]
+                            for scen in scenarios[start:start+shardsize]}
+            shard = os.path.join(folder, 'shard_{:05d}.pkl'.format(ii))
+            with open(shard, 'wb') as outp:
+                pickler = pickle.Pickler(outp, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = lambda obj: references.get(id(obj))
+                pickler.dump((sim, method, materials, kwargs))
+            shards.append(shard)
+        return shards
+
+    def reduceShards(self, folder):
+        '''
+        Merges the results of the shards of ``writeShards`` in ``folder``
+        back on the scenarios of the simulation.
+
+        Returns
+        -------
+        missing : list
+            Paths of the shards without results yet. Their scenarios are left
+            as they were.
+        '''
+        import pickle
+
+        missing = []
+        for shard in sorted(Path(folder).glob('shard_*.pkl')):
+            result = _shardResultPath(shard)
+            if not result.exists():
+                missing.append(str(shard))
+                continue
+            with open(result, 'rb') as inp:
+                self._setOutputs(pickle.load(inp))
+
+        if missing:
+            print("Shards without results:", len(missing))
+        return missing
+
     def pickle_Sim(self, filename=None):
         import pickle
         if filename is None:
@@ -446,6 +1435,58 @@ class Simulation:
                                        massmodulefile=massmodulefile,
                                        energymodulefile=energymodulefile)
 
+    def cloneScenario(self, src, name, share=False):
+        '''
+        Adds scenario ``name`` as a copy of scenario ``src`` and its
+        materials, without reading and saving their files again. Results
+        of ``src`` are not copied.
+
+        Parameters
+        ----------
+        src : str
+            Name of the scenario to copy.
+        name : str
+            Name of the new scenario.
+        share : bool
+            If False (default) the clone owns copies of all the inputs.
+            If True the input dataframes of both scenarios share their
+            columns until ``modifyScenario``, ``modifyScenarioEnergy``,
+            ``modifyMaterials`` or ``modifyMaterialEnergy`` changes one of
+            them, which copies that column first. Any other write into a
+            shared column, i.e. ``clone.dataIn_m.loc[...] = ...``, changes
+            both scenarios.
+        '''
+        scenario = _cloneInputs(self.scenario[src], _SCENARIO_INPUTS, share)
+        scenario.name = name
+        scenario.material = {mat: _cloneInputs(material, _MATERIAL_INPUTS,
+                                               share)
+                             for mat, material in
+                             self.scenario[src].material.items()}
+        self.scenario[name] = scenario
+
+    def overlayScenario(self, base, name, edits=None):
+        '''
+        Adds scenario ``name`` as a ``ScenarioOverlay`` of scenario ``base``,
+        stored as the base plus a sparse list of edits. It sees the base
+        inputs as they are now, and ``modifyScenario``,
+        ``modifyScenarioEnergy``, ``modifyMaterials`` and
+        ``modifyMaterialEnergy`` record edits on it.
+
+        Parameters
+        ----------
+        base : str
+            Name of the base scenario.
+        name : str
+            Name of the new scenario.
+        edits : list
+            (field, value, start_year, end_year) module input edits. Material
+            edits can be added with ``addEdit`` on its materials.
+        '''
+        overlay = ScenarioOverlay(name, self.scenario[base])
+        for edit in edits or []:
+            overlay.addEdit(*edit)
+        self.scenario[name] = overlay
+
     def modifyScenario(self, scenarios, stage, value, start_year=None):
 
         if start_year is None:
@@ -457,8 +1498,21 @@ class Simulation:
             if isinstance(scenarios, str):
                 scenarios = [scenarios]
 
+        # Overlays store the change as an edit
+        for scen in scenarios:
+            if isinstance(self.scenario[scen], ScenarioOverlay):
+                self.scenario[scen].addEdit(stage, value, start_year,
+                                            attribute='dataIn_m')
+        scenarios = [scen for scen in scenarios
+                     if not isinstance(self.scenario[scen], ScenarioOverlay)]
+        if not scenarios:
+            return
+
         selectyears = self.scenario[scenarios[0]].dataIn_m['year'] >= start_year
 
+        for scen in scenarios:
+            _ownColumns(self.scenario[scen], 'dataIn_m', stage)
+
         if isinstance(value, (pd.Series)):
             for scen in scenarios:
                 timeshift = start_year - self.scenario[scen].dataIn_m.iloc[0,0]
@@ -536,8 +1590,21 @@ class Simulation:
             if isinstance(scenarios, str):
                 scenarios = [scenarios]
 
+        # Overlays store the change as an edit
+        for scen in scenarios:
+            if isinstance(self.scenario[scen], ScenarioOverlay):
+                self.scenario[scen].addEdit(stage, value, start_year,
+                                            attribute='dataIn_e')
+        scenarios = [scen for scen in scenarios
+                     if not isinstance(self.scenario[scen], ScenarioOverlay)]
+        if not scenarios:
+            return
+
         selectyears = self.scenario[scenarios[0]].dataIn_e['year'] >= start_year
 
+        for scen in scenarios:
+            _ownColumns(self.scenario[scen], 'dataIn_e', stage)
+
         if isinstance(value, (pd.Series)):
             for scen in scenarios:
                 timeshift = start_year - self.scenario[scen].dataIn_e.iloc[0,0]
@@ -551,8 +1618,37 @@ class Simulation:
     def calculateFlows(self, scenarios=None, materials=None,
                        weibullInputParams=None, bifacialityfactors=None,
                        reducecapacity=True, debugflag=False,
-                       installByArea=None, nameplatedeglimit=None):
-        
+                       installByArea=None, nameplatedeglimit=None,
+                       carryoverVat=True, carryoverReMFG=True, dtype=None,
+                       prunearea=0.0, n_jobs=None, sharedmemory=False,
+                       n_threads=None, checkpoint=None, resume=False,
+                       reducers=None, impulseresponse=False,
+                       capacitytarget=None):
+        '''
+        Calculates the mass and then the energy flows of the scenarios. See
+        ``calculateMassFlow`` and ``calculateEnergyFlow`` for the arguments.
+
+        Parameters
+        ----------
+        checkpoint : str
+            Folder to checkpoint a long sweep in. Scenarios are calculated
+            ``CHECKPOINT_SCENARIOS`` at a time, and the outputs of each
+            finished scenario are saved right away to a compressed ``.npz``
+            file, listed in ``manifest.json``. Debug matrices are not saved.
+        resume : bool
+            With ``checkpoint``, load the outputs of the scenarios already in
+            the manifest instead of calculating them again. Scenarios whose
+            inputs or arguments changed since they were saved are
+            calculated again.
+        reducers : dict
+            Reduce-only mode. Scenarios are calculated ``REDUCE_SCENARIOS``
+            at a time, each finished scenario is passed to every
+            ``{name: function(scenario)}`` reducer, i.e. ``aggregateScenario``,
+            and then its outputs are dropped, so memory does not grow with
+            the number of scenarios. Results are returned and kept in
+            ``self.reduced`` as ``{name: {scenario: value}}``.
+        '''
+
         # #create a check that the start year on mass and energy files are the same
         # for scen in scenarios:
         #     mod_m_startyear = self.scenario[scen].dataIn_m.iloc[0,0]
@@ -570,15 +1666,67 @@ class Simulation:
         #             return
         
         
+        if reducers is not None:
+            if checkpoint is not None:
+                raise ValueError("reducers drop the outputs checkpoint saves, "
+                                 "use one or the other.")
+            return self._calculateReduced(
+                reducers, scenarios, materials,
+                weibullInputParams=weibullInputParams,
+                bifacialityfactors=bifacialityfactors,
+                reducecapacity=reducecapacity, debugflag=debugflag,
+                installByArea=installByArea,
+                nameplatedeglimit=nameplatedeglimit,
+                carryoverVat=carryoverVat, carryoverReMFG=carryoverReMFG,
+                dtype=dtype, prunearea=prunearea, n_jobs=n_jobs,
+                sharedmemory=sharedmemory, n_threads=n_threads,
+                impulseresponse=impulseresponse,
+                capacitytarget=capacitytarget)
+
+        if checkpoint is not None:
+            return self._calculateCheckpointed(
+                checkpoint, resume, scenarios, materials,
+                weibullInputParams=weibullInputParams,
+                bifacialityfactors=bifacialityfactors,
+                reducecapacity=reducecapacity, debugflag=debugflag,
+                installByArea=installByArea,
+                nameplatedeglimit=nameplatedeglimit,
+                carryoverVat=carryoverVat, carryoverReMFG=carryoverReMFG,
+                dtype=dtype, prunearea=prunearea, n_jobs=n_jobs,
+                sharedmemory=sharedmemory, n_threads=n_threads,
+                impulseresponse=impulseresponse,
+                capacitytarget=capacitytarget)
+
+        if n_jobs not in (None, 1):
+            return self._calculateParallel(
+                'calculateFlows', scenarios, materials, n_jobs,
+                sharedmemory=sharedmemory,
+                weibullInputParams=weibullInputParams,
+                bifacialityfactors=bifacialityfactors,
+                reducecapacity=reducecapacity, debugflag=debugflag,
+                installByArea=installByArea,
+                nameplatedeglimit=nameplatedeglimit,
+                carryoverVat=carryoverVat, carryoverReMFG=carryoverReMFG,
+                dtype=dtype, prunearea=prunearea, n_threads=n_threads,
+                impulseresponse=impulseresponse,
+                capacitytarget=capacitytarget)
+
         self.calculateMassFlow(scenarios=scenarios, materials=materials,
                                weibullInputParams=weibullInputParams,
                                bifacialityfactors=bifacialityfactors,
                                reducecapacity=reducecapacity,
                                debugflag=debugflag,
                                installByArea=installByArea,
-                               nameplatedeglimit=nameplatedeglimit)
-
-        self.calculateEnergyFlow(scenarios=scenarios, materials=materials)
+                               nameplatedeglimit=nameplatedeglimit,
+                               carryoverVat=carryoverVat,
+                               carryoverReMFG=carryoverReMFG,
+                               dtype=dtype, prunearea=prunearea,
+                               n_threads=n_threads,
+                               impulseresponse=impulseresponse,
+                               capacitytarget=capacitytarget)
+
+        self.calculateEnergyFlow(scenarios=scenarios, materials=materials,
+                                 dtype=dtype, n_threads=n_threads)
         
         #self.calculateCarbonFlows(scenarios=scenarios,materials=materials)
 
@@ -586,7 +1734,12 @@ class Simulation:
                           weibullInputParams=None, bifacialityfactors=None,
                           reducecapacity=False, debugflag=False,
                           installByArea=None, nameplatedeglimit=None,
-                          secondlifenameplatedeglimit = None):
+                          secondlifenameplatedeglimit = None,
+                          carryoverVat=True, carryoverReMFG=True,
+                          dtype=None, prunearea=0.0, n_jobs=None,
+                          sharedmemory=False, n_threads=None,
+                          impulseresponse=False, capacitytarget=None,
+                          derivatives=None):
         '''
         Function takes as input a baseline dataframe already imported,
         with the right number of columns and content.
@@ -621,6 +1774,64 @@ class Simulation:
         secondlifenameplatedeglimit : float
             Limit at which if the nameplate power is below at their second life,
             the modules will be trashed. i.e. 0.5 default. 
+        carryoverVat : bool
+            If True (default), high quality recycled material sent back to
+            manufacturing that exceeds the manufacturing needs of a year is
+            carried over to the following years (closed-loop VAT). If False,
+            the surplus goes to other uses and virgin needs are set to 0 on
+            the years with surplus.
+        carryoverReMFG : bool
+            If True (default), successfully remanufactured material that
+            exceeds the module manufacturing needs of a year is carried over
+            to the following years.
+        dtype : numpy dtype
+            Floating point type of the flows calculated, i.e. np.float32
+            for large sweeps. Defaults to the Simulation ``dtype``.
+        prunearea : float
+            Remaining active area [m2] at or below which a generation stops
+            being tracked by the cohort calculations. Default 0 only drops
+            fully retired generations, with no change on the results. Above
+            0, the area left on the pruned generations (at most
+            ``prunearea`` each) does not reach any EOL path; it is reported
+            on the year it leaves in 'Yearly_Sum_Area_Pruned', so the
+            installed area is still the EOL, active and pruned areas.
+        n_jobs : int
+            Number of processes to split the scenarios on. None or 1 (default)
+            calculate on this process; -1 uses all the CPUs. Scenarios are
+            split in contiguous chunks and results are gathered back on each
+            scenario, so outputs do not depend on the number of jobs.
+        sharedmemory : bool
+            With ``n_jobs``, hand the input and output dataframes to the
+            workers through shared memory blocks instead of pickling them.
+        n_threads : int
+            Number of threads to split the materials on, after the module
+            stage. None or 1 (default) run all materials on this thread; -1
+            uses all the CPUs.
+        impulseresponse : bool
+            If True, the cohort flows are obtained from per-unit-area
+            responses of each generation, calculated once for each distinct
+            set of module, Weibull and EOL inputs and kept on the Simulation,
+            so re-running scenarios that only change their installs skips
+            the cohort calculations. ``prunearea`` is not used.
+        capacitytarget : array, Series or dict
+            Effective capacity [MW] to keep each year, as an array with a
+            value for each year, a Series indexed by year, or a {scenario:
+            target} dict. The new installs of each year, replacing the
+            failed, degraded and retired modules of the generations before
+            with modules of that year's efficiency and ``irradiance_stc``,
+            are solved in one forward pass and returned in the
+            `new_Installed_Capacity_[MW]` column of ``dataOut_m``. Years
+            without a target (NaN, or missing from the Series) keep their
+            input installs, and years already above the target get none.
+            Cohorts are calculated as with ``impulseresponse``.
+        derivatives : list
+            (source, field, year) inputs to differentiate the outputs by,
+            where source is 'module' or a material name (see
+            ``calculateJacobian``, which returns them). Their derivatives
+            are carried in forward mode along the cohorts, the EOL pathways
+            and the material flows, in the same pass as the outputs. Not
+            available with ``n_jobs``, ``impulseresponse`` or
+            ``capacitytarget``.
 
         Returns
         --------
@@ -642,13 +1853,60 @@ class Simulation:
         if secondlifenameplatedeglimit is None:
             secondlifenameplatedeglimit = 0.5
 
+        if derivatives is not None and (
+                n_jobs not in (None, 1) or impulseresponse or
+                capacitytarget is not None):
+            raise ValueError("derivatives are carried through the cohort "
+                             "calculations of this process, they can not be "
+                             "used with n_jobs, impulseresponse or "
+                             "capacitytarget.")
+
+        if n_jobs not in (None, 1):
+            return self._calculateParallel(
+                'calculateMassFlow', scenarios, materials, n_jobs,
+                sharedmemory=sharedmemory,
+                weibullInputParams=weibullInputParams,
+                bifacialityfactors=bifacialityfactors,
+                reducecapacity=reducecapacity, debugflag=debugflag,
+                installByArea=installByArea,
+                nameplatedeglimit=nameplatedeglimit,
+                secondlifenameplatedeglimit=secondlifenameplatedeglimit,
+                carryoverVat=carryoverVat, carryoverReMFG=carryoverReMFG,
+                dtype=dtype, prunearea=prunearea, n_threads=n_threads,
+                impulseresponse=impulseresponse,
+                capacitytarget=capacitytarget)
+
+        dtype = self._flowDtype(dtype)
+
         print(">>>> Calculating Material Flows <<<<\n")
 
+        if materials is None:
+            materials = list(self.scenario[scenarios[0]].material.keys())
+        else:
+            if isinstance(materials, str):
+                materials = [materials]
+
+        # Inputs are prepared scenario by scenario; scenarios with the same
+        # number of years are then calculated together on scenario x year
+        # arrays.
+        prepared = []
+        stopped = False
+        # Landfill paths set to the remainder of the other paths
+        landfills = {}
+
+        if capacitytarget is not None:
+            if installByArea is not None:
+                raise ValueError("capacitytarget solves the installs, it "
+                                 "can not be used with installByArea.")
+            if not isinstance(capacitytarget, dict):
+                capacitytarget = {scen: capacitytarget for scen in scenarios}
+            targets = {}
+
         for scen in scenarios:
 
             print("Working on Scenario: ", scen)
             print("********************")
-            df = self.scenario[scen].dataIn_m.copy()
+            df = _inputFrame(self.scenario[scen], 'dataIn_m').copy()
             initialCols = df.keys()
 
             # Constant
@@ -697,828 +1955,325 @@ class Simulation:
 
             df['Area'] = df['Area'].fillna(0)  # Chagne na's to 0s.
 
-            # Calculating Wast by Generation by Year, and Cum. Waste by Year.
-            Generation_EOL_pathsG = []
-            Matrix_Landfilled_noncollected = []
-            Matrix_areaEOL_degradation_all = []
-            Matrix_Failures = []
-            weibullParamList = []
+            if capacitytarget is not None:
+                if 'Mass_[MetricTonnes]' in df:
+                    raise ValueError("capacitytarget can not be used with "
+                                     "Mass_[MetricTonnes] inputs.")
+                target = capacitytarget[scen]
+                if isinstance(target, pd.Series):
+                    target = target.reindex(df['year'].values)
+                targets[scen] = np.asarray(target, dtype=float)*1e6  # W
 
+            # Calculating Wast by Generation by Year, and Cum. Waste by Year.
+            if weibullInputParams:
+                weibullParamList = [weibullInputParams]*len(df)
+            elif 'weibull_alpha' in df:
+                # "Weibull Input Params passed internally as a column"
+                weibullParamList = [{'alpha': alpha, 'beta': beta}
+                                    for alpha, beta in zip(df['weibull_alpha'],
+                                                           df['weibull_beta'])]
+            else:
+                # "Calculating Weibull Params from Modules t50 and T90"
+                # only once for each different pair of values.
+                weibullParamList = [dict(_weibullParamsCached(t50, t90))
+                                    for t50, t90 in zip(df['t50'], df['t90'])]
 
-            df['Yearly_Sum_Area_EOLby_Failure'] = 0
-            df['Yearly_Sum_Power_EOLby_Failure'] = 0
-            df['Yearly_Sum_Area_EOLby_Degradation'] = 0
-            df['Yearly_Sum_Power_EOLby_Degradation'] = 0
-            df['Yearly_Sum_Area_EOLby_ProjectLifetime'] = 0
-            df['Yearly_Sum_Power_EOLby_ProjectLifetime'] = 0
+            # Paths GOOD Check for 100% sum.
+            # If P1-P5 over 100% will reduce landfill.
+            # If P2-P5 over 100% it will shut down with Warning and Exit.
+            #TODO: add check for less than 100%, adjust landfill
+            SUMS1 = (df['mod_EOL_pg1_landfill'] + df['mod_EOL_pg0_resell'] +
+                     df['mod_EOL_pg2_stored'] + df['mod_EOL_pg3_reMFG'] +
+                     df['mod_EOL_pg4_recycled'])
+            SUMS2 = (df['mod_EOL_pg0_resell'] +
+                     df['mod_EOL_pg2_stored'] + df['mod_EOL_pg3_reMFG'] +
+                     df['mod_EOL_pg4_recycled'])
 
-            df['Yearly_Sum_Area_atEOL'] = 0  # Failure + Degradation + ProjcLife
-            df['Yearly_Sum_Power_atEOL'] = 0
-            df['Yearly_Sum_Area_PathsBad'] = 0 # should be degradation, failures not fixed
-            df['Yearly_Sum_Power_PathsBad'] = 0
-            df['Yearly_Sum_Area_PathsGood'] = 0  # should be proj lifetimes
-            df['Yearly_Sum_Power_PathsGood'] = 0
+            if (SUMS2 > 100).any():
+                print("WARNING: Paths 0 through 4 should add to a 100%." +
+                      " and there is no way to correct by updating " +
+                      " path1_landfill. " +
+                      " STOPPING SIMULATION NOW GO AND FIX YOUR INPUT. Tx <3")
+                stopped = True
+                break
 
-            df['Landfill_0_ProjLife'] = 0 # non collected
+            if (SUMS1 > 100).any():
+                print("Warning: Paths 0 through 4 add to above 100%;" +
+                      "Fixing by Updating Landfill value to the remainder of" +
+                      "100-(P0+P2+P3+P4).")
+                df['mod_EOL_pg1_landfill'] = 100-SUMS2
+                landfills.setdefault(scen, []).append('mod_EOL_pg1_landfill')
 
-            df['Repaired_Area'] = 0
-            df['Repaired_[W]'] = 0
+            # PATH BADS:
+            # ~~~~~~~~~~~
 
-            df['Resold_Area'] = 0
-            df['Resold_[W]'] = 0
+            # Check for 100% sum.
+            # If P1-P5 over 100% will reduce landfill.
+            # If P2-P5 over 100% it will shut down with Warning and Exit.
+            SUMS1 = (df['mod_EOL_pb1_landfill'] +
+                     df['mod_EOL_pb2_stored'] + df['mod_EOL_pb3_reMFG'] +
+                     df['mod_EOL_pb4_recycled'])
+            SUMS2 = (df['mod_EOL_pb2_stored'] + df['mod_EOL_pb3_reMFG'] +
+                     df['mod_EOL_pb4_recycled'])
 
-            df['MerchantTail_Area'] = 0
-            df['MerchantTail_[W]'] = 0
+            if (SUMS2 > 100).any():
+                print("WARNING: Paths B 1 through 4 should add to a 100%." +
+                      " and there is no way to correct by updating " +
+                      " path1_landfill. " +
+                      " STOPPING SIMULATION NOW GO AND FIX YOUR INPUT. Tx <3")
+                stopped = True
+                break
 
-            df['Cumulative_Active_Area'] = 0 # Effective installed area
-            df['Effective_Capacity_[W]'] = 0 # Effective installed capacity 
-            # i.e  installed - degrad - fails - eol PL ..
+            if (SUMS1 > 100).any():
+                print("Warning: Paths B 1 through 4 add to above 100%;" +
+                      "Fixing by Updating Landfill value to the remainder of" +
+                      "100-(P2+P3+P4).")
+                df['mod_EOL_pb1_landfill'] = 100-SUMS2
+                landfills.setdefault(scen, []).append('mod_EOL_pb1_landfill')
+
+            prepared.append((scen, df, initialCols, weibullParamList))
+
+        batches = {}
+        for item in prepared:
+            batches.setdefault(len(item[1]), []).append(item)
+
+        for batch in batches.values():
+            modinputs = _stackColumns([df for _, df, _, _ in batch])
+            weibullParams = [weibullParamList
+                             for _, _, _, weibullParamList in batch]
+
+            limits = dict(
+                nameplatedeglimit=nameplatedeglimit,
+                secondlifenameplatedeglimit=secondlifenameplatedeglimit)
+
+            if capacitytarget is not None:
+                area = self._solveCapacityTarget(
+                    modinputs, weibullParams,
+                    np.stack([targets[scen] for scen, _, _, _ in batch]),
+                    dtype, **limits)
+                modinputs['Area'] = area
+                for ss, (_, df, _, _) in enumerate(batch):
+                    df['Area'] = area[ss]
+                    if reducecapacity:
+                        irradiance = df['irradiance_stc']
+                    else:
+                        irradiance = 1000.0
+                    df['new_Installed_Capacity_[W]'] = (
+                        df['Area']*(df['mod_eff']*0.01)*irradiance)
+                    df['new_Installed_Capacity_[MW]'] = (
+                        df['new_Installed_Capacity_[W]']/1000000)
+
+            # Derivatives of the inputs along each direction, with the
+            # directions as leading axis of all the derivatives.
+            tangents = cohorttangents = None
+            if derivatives is not None:
+                tangents = _derivativeSeeds(
+                    derivatives,
+                    np.stack([df['year'].values for _, df, _, _ in batch]),
+                    materials, [landfills.get(scen, [])
+                                for scen, _, _, _ in batch], dtype)
+                cohorttangents = {key: tangents[key] for key in _COHORT_INPUTS
+                                  if key in tangents} or None
+
+            # All scenarios, generations and ages are calculated at once on
+            # the scenario x generation x year grid.
+            if impulseresponse or capacitytarget is not None:
+                if prunearea:
+                    print("Warning: prunearea is not used with "
+                          "impulseresponse.")
+                    prunearea = 0.0
+                yearlysum, cohorts = self._impulseCohorts(
+                    modinputs, weibullParams, dtype, **limits)
+            else:
+                yearlysum, cohorts, *dcohorts = _cohortMassFlows(
+                    area=modinputs['Area'],
+                    mod_eff=modinputs['mod_eff'],
+                    irradiance_stc=modinputs['irradiance_stc'],
+                    mod_degradation=modinputs['mod_degradation'],
+                    mod_lifetime=modinputs['mod_lifetime'],
+                    weibullalpha=[[p['alpha'] for p in params]
+                                  for params in weibullParams],
+                    weibullbeta=[[p['beta'] for p in params]
+                                 for params in weibullParams],
+                    mod_EOL_collection_eff=modinputs['mod_EOL_collection_eff'],
+                    mod_MerchantTail=modinputs['mod_MerchantTail'],
+                    mod_EOL_pg0_resell=modinputs['mod_EOL_pg0_resell'],
+                    mod_Repair=modinputs['mod_Repair'],
+                    nameplatedeglimit=nameplatedeglimit,
+                    secondlifenameplatedeglimit=secondlifenameplatedeglimit,
+                    dtype=dtype, prunearea=prunearea,
+                    tangents=cohorttangents)
+            print("Finished Area+Power Generation Calculations")
+            if cohorttangents is not None:
+                dyearlysum, dcohorts = dcohorts
+                tangents.update(dcohorts)
+            elif tangents is not None:
+                dyearlysum = {key: np.zeros(
+                    (len(derivatives),) + value.shape, dtype=dtype)
+                    for key, value in yearlysum.items()}
 
-            df['Power_Degraded_[W]'] = 0   # The way it is calculated it is 
-                                           # 'cumulative' or relative from the nameplate
-                                           # to each year. 
-            
-            for generation, row in df.iterrows():
-                # generation is an int 0,1,2,.... etc.
-                # generation=4
-                # row=df.iloc[generation]
-
-                if weibullInputParams:
-                    weibullIParams = weibullInputParams
-                elif 'weibull_alpha' in row:
-                    # "Weibull Input Params passed internally as a column"
-                    weibullIParams = {'alpha': row['weibull_alpha'],
-                                      'beta': row['weibull_beta']}
-                else:
-                    # "Calculating Weibull Params from Modules t50 and T90"
-                    t50, t90 = row['t50'], row['t90']
-                    weibullIParams = weibull_params({t50: 0.50, t90: 0.90})
+            # # Start to do EOL Processes PATHS GOOD
+            #######################################
 
-                f = weibull_cdf(weibullIParams['alpha'],
-                                weibullIParams['beta'])
+            # This Multiplication goes through Module and then material.
+            # It is for processes that depend on each year as they improve,
+            # i.e. Collection Efficiency,
+            #
+            # [  G1_1   G1_2    G1_3   G2_4 ...]       [N1
+            # [    0    G2_1    G2_2   G2_3 ...]   X    N2
+            # [    0      0     G3_1   G3_2 ...]        N3
+            #                                           N4]
+            #
+            #      EQUAL
+            # EOL_Collected =
+            # [  G1_1*N1   G1_2 *N2   G1_3 *N3   G2_4 *N4 ...]
+            # [    0       G2_1 *N2   G2_2 *N3   G2_3 *N4 ...]
+            # [    0        0         G3_1 *N3   G3_2 *N4 ...]
+            #
+            # Only the column sums of these products are used, so they are
+            # calculated by _eolPathways directly from the PG, L0 and PB
+            # (path bad: degradation + failures not repaired) matrices.
+            if tangents is None:
+                flows = _eolPathways(cohorts['area_PG'], cohorts['area_L0'],
+                                     cohorts['area_PB'], modinputs)
+            else:
+                flows, dflows = _eolPathways(
+                    cohorts['area_PG'], cohorts['area_L0'],
+                    cohorts['area_PB'], modinputs, tangents=tangents)
 
-                weibullParamList.append(weibullIParams)
+            ################
+            # Material Loop#
+            ################
 
-                x = np.clip(df.index - generation, 0, np.inf)
-                cdf = list(map(f, x))
-                # TODO: Check this line, does it need commas or remove space
-                # for linting?
-                pdf = [0] + [j - i for i, j in zip(cdf[:-1], cdf[1:])]
+            # Stacking the materials inputs as scenario x materials x year
+            # arrays
+            matdataIn = [[_inputFrame(self.scenario[scen].material[mat],
+                                      'matdataIn_m')
+                          for mat in materials] for scen, _, _, _ in batch]
+            matinputs = _stackColumns(matdataIn, dtype)
+
+            # Materials only share the module matrices, so chunks of them
+            # can run on separate threads.
+            def materialChunk(chunk):
+                chunktangents = None
+                if tangents is not None:
+                    chunktangents = {
+                        key: value[:, :, chunk] if key in matinputs else value
+                        for key, value in tangents.items()}
+                return _materialMassFlows(
+                    cohorts, modinputs,
+                    {key: value[:, chunk] for key, value in matinputs.items()},
+                    carryoverReMFG=carryoverReMFG, carryoverVat=carryoverVat,
+                    tangents=chunktangents)
+
+            results = _threadMap(materialChunk,
+                                 _materialChunks(len(materials), n_threads),
+                                 n_threads)
+            matdataOut, surplusEndofSim = [
+                {key: np.concatenate([result[ii][key] for result in results],
+                                     axis=1)
+                 for key in results[0][ii]} for ii in range(2)]
+            matcolumns = sorted(matdataOut)
+            matdataOut = np.stack([matdataOut[key] for key in matcolumns],
+                                  axis=-1)
+            if tangents is not None:
+                dmatdataOut = {key: np.concatenate(
+                    [result[2][key] for result in results], axis=2)
+                    for key in matcolumns}
+
+            for ss, (scen, df, initialCols, weibullParamList) in enumerate(
+                    batch):
+
+                # Output columns are collected and joined to df at once.
+                out = _moduleMassOutputs(yearlysum, flows, ss)
+
+                # Active area of the generations no longer tracked, so the
+                # installed area stays equal to the EOL plus active areas.
+                if prunearea:
+                    out['Yearly_Sum_Area_Pruned'] = yearlysum['area_pruned'][ss]
+
+                out['WeibullParams'] = weibullParamList
+
+                if debugflag:
+                    # Cohort matrices are kept packed on the scenario; the
+                    # dataDebug_m DataFrame is only built when it is read.
+                    self.scenario[scen]._debugMatrices_m = {
+                        'index': df.index, 'PG': cohorts['area_PG'][ss],
+                        'L0': cohorts['area_L0'][ss], 'PB': cohorts['area_PB'][ss],
+                        'collection_eff': df['mod_EOL_collection_eff'].values,
+                        'lifetime': df['mod_lifetime'].values}
+                    self.scenario[scen].__dict__.pop('_dataDebug_m', None)
+                    self.scenario[scen].__dict__.pop('dataDebug_m', None)
+
+                # Cleanup of internal renaming and internal use columns
+                df.drop(['new_Installed_Capacity_[W]', 't50', 't90'],
+                        axis=1, inplace=True)
+
+                # Printout ref. of how much more module area is being manufactured.
+                # The manufactured efficiency is calculated on more detail on the
+                # material loop below for hte mass.
+                out['ModuleTotal_MFG'] = df['Area']*100/df['mod_MFG_eff']
+
+                out = pd.DataFrame(out, index=df.index)
+                df = pd.concat([df.drop(columns=out.columns, errors='ignore'),
+                                out], axis=1)
+
+                for ii, mat in enumerate(materials):
+
+                    print("==> Working on Material : ", mat)
+
+                    if surplusEndofSim['reMFG'][ss, ii] > 0:
+                        print("ReMFG surplus End of Sim for Mat ", mat,
+                              " Scenario ", scen, " = ",
+                              surplusEndofSim['reMFG'][ss, ii]/1000000,
+                              " tonnes.")
+                    if surplusEndofSim['recycled'][ss, ii] > 0:
+                        print("Recycled surplus End of Sim for Mat ", mat,
+                              " Scenario ", scen, " = ",
+                              surplusEndofSim['recycled'][ss, ii]/1000000,
+                              " tonnes.")
+                    if not carryoverVat:
+                        print("VAT carryover material is turned OFF")
+
+                    self.scenario[scen].material[mat].matdataOut_m = (
+                        pd.DataFrame(matdataOut[ss, ii], columns=matcolumns,
+                                     index=matdataIn[ss][ii].index))
+
+                columns = df.columns.difference(initialCols)
+                if capacitytarget is not None:
+                    # Solved installs are returned with the outputs.
+                    columns = columns.union(['new_Installed_Capacity_[MW]'])
+                self.scenario[scen].dataOut_m = _castFloatColumns(
+                    df[columns], dtype)
+
+                if tangents is not None:
+                    # Derivatives of the outputs by source and column, of
+                    # shape (D, N), read back by calculateJacobian.
+                    index = (Ellipsis, ss, slice(None))
+                    derived = {'module': _moduleMassOutputs(dyearlysum, dflows,
+                                                            index)}
+                    if 'mod_MFG_eff' in tangents:
+                        derived['module']['ModuleTotal_MFG'] = (
+                            -df['ModuleTotal_MFG'].values /
+                            df['mod_MFG_eff'].values *
+                            tangents['mod_MFG_eff'][index])
+                    for ii, mat in enumerate(materials):
+                        derived[mat] = {key: dmatdataOut[key][:, ss, ii]
+                                        for key in matcolumns}
+                    self.scenario[scen]._derivatives_m = derived
+
+        if stopped:
+            return
 
-                activearea = row['Area']
-                if np.isnan(activearea):
-                    activearea = 0
 
-                activeareacount = []
-                activepowercount = []  # Active area production.
-
-                areaEOL_failure_notrepaired_all = []
-                powerEOL_failure_notrepaired_all = []
-
-                areaEOL_ProjLife_all = []
-                powerEOL_ProjLife_all = []
-
-                area_repaired_all = []
-                power_repaired_all = []
-
-                area_resold_all = []
-                power_resold_all = []
-                
-                area_merchantTail_all = []
-                power_merchantTail_all = []
-                
-                areaEOL_degradation_all = []
-                powerEOL_degradation_all = []
-                
-                areaEOL_ProjLife_collected_PG_3to5_all = []
-                powerEOL_ProjLife_collected_PG_3to5_all = []
-
-                areaEOL_ProjLife_notcollected_L0_all = []
-                powerEOL_ProjLife_notcollected_L0_all = []
-
-                power_degraded_all = []
-                # Age 0, nothing dies <3
-
-                active = 0
-                secondlife = False
-
-                for age in range(len(cdf)):
-                    
-                    if x[age] == 0.0:
-                        activeareacount.append(0)
-                        activepowercount.append(0)
-
-                        areaEOL_failure_notrepaired_all.append(0)
-                        powerEOL_failure_notrepaired_all.append(0)
-                        areaEOL_ProjLife_all.append(0)
-                        powerEOL_ProjLife_all.append(0)
-                        area_resold_all.append(0)
-                        power_resold_all.append(0)
-                        area_merchantTail_all.append(0)
-                        power_merchantTail_all.append(0)
-                        areaEOL_degradation_all.append(0)
-                        powerEOL_degradation_all.append(0)
-                        area_repaired_all.append(0)
-                        power_repaired_all.append(0)
-                        areaEOL_ProjLife_collected_PG_3to5_all.append(0)
-                        powerEOL_ProjLife_collected_PG_3to5_all.append(0)             
-                        areaEOL_ProjLife_notcollected_L0_all.append(0)
-                        powerEOL_ProjLife_notcollected_L0_all.append(0)
-                        power_degraded_all.append(0)
-                        
-                    else:
-                        active += 1
-                        removed_projectlifetime = 0
-                        landfilled_noncollected = 0
-                        
-                        deg_nameplate = (1-row['mod_degradation']*0.01)**active
-                        poweragegen = (row['mod_eff'] * 0.01 *
-                                       row['irradiance_stc']*deg_nameplate)
-                        powerinitgen = row['mod_eff'] * 0.01 * row['irradiance_stc']
-                        
-                        
-                        # 1. Check if remaining cohort has degraded
-    
-                        power_degradaded = activearea * (powerinitgen - poweragegen) 
-    
-                        if secondlife:
-                            nameplatedeglimiteval = secondlifenameplatedeglimit
-                        else:
-                            nameplatedeglimiteval = nameplatedeglimit
-    
-                        if deg_nameplate < nameplatedeglimiteval:
-                            # TODO check this! killing and not sending
-                            # to EOL collection paths,
-                            areaEOL_degradation = activearea
-                            powerEOL_degradation = (
-                                areaEOL_degradation * poweragegen)
-                            
-                            # Reduntant as it is performed in the MATRIX later on PBD
-                            '''
-                            areaEOL_degradation_collected = (
-                                areaEOL_degradation *
-                                (df.iloc[age]['mod_EOL_collection_eff'] *
-                                 0.01))
-                            powerEOL_degradation_collected = areaEOL_degradation_collected * poweragegen
-                            areaEOL_Deg_notcollected_L0 = areaEOL_degradation - areaEOL_degradation_collected
-                            powerEOL_Deg_notcollected_L0 = areaEOL_Deg_notcollected_L0*poweragegen
-                            '''
-                            activearea = 0
-                        else:
-                            areaEOL_degradation = 0
-                            powerEOL_degradation = 0
-                            
-                            #areaEOL_degradation_collected = 0
-                            #powerEOL_degradation_collected = 0
-                            #areaEOL_Deg_notcollected_L0 = 0
-                            #powerEOL_Deg_notcollected_L0 = 0
-    
-                        # 3. EoL Project Lifetime 
-                        if age != int(row['mod_lifetime']+generation):
-                            #removed_projectlifetime = 0
-                            #landfilled_noncollected = 0
-                            area_merchantTail = 0
-                            power_merchantTail = 0
-                            area_resold = 0
-                            power_resold = 0
-                            areaEOL_ProjLife_notcollected_L0 = 0
-                            powerEOL_ProjLife_notcollected_L0 = 0
-                            areaEOL_ProjLife_collected_PG_3to5 = 0
-                            powerEOL_ProjLife_collected_PG_3to5 = 0
-                            areaEOL_ProjLife = 0
-                            powerEOL_ProjLife = 0
-                        else:
-                            # activearea_temp = activearea
-                            area_merchantTail = (
-                                    activearea *
-                                    (df.iloc[age]['mod_MerchantTail']*0.01))
-                            power_merchantTail = area_merchantTail*poweragegen
-    
-                            if area_merchantTail > 0:
-                                secondlife = True
-                                
-                            # internal - removed_projectlifetime
-                            area_removed_projectlifetime = (activearea -
-                                                        area_merchantTail)
-    
-                            # internal - area_removed_collected (pre-resold)
-                            area_ProjLife_collected = (
-                                area_removed_projectlifetime *
-                                (df.iloc[age]['mod_EOL_collection_eff'] *
-                                 0.01))
-                            areaEOL_ProjLife_notcollected_L0 = (
-                                area_removed_projectlifetime-area_ProjLife_collected)
-    
-                            powerEOL_ProjLife_notcollected_L0 = areaEOL_ProjLife_notcollected_L0 * poweragegen
-                            area_resold = (
-                                area_ProjLife_collected *
-                                (df.iloc[age]['mod_EOL_pg0_resell']*0.01))
-                            power_resold = area_resold*poweragegen
-    
-                            areaEOL_ProjLife_collected_PG_3to5 = (
-                                area_ProjLife_collected - area_resold)
-    
-                            powerEOL_ProjLife_collected_PG_3to5 = (
-                                areaEOL_ProjLife_collected_PG_3to5 * poweragegen)
-    
-                            activearea = area_merchantTail + area_resold
-    
-                            # removed_projectlifetime does not include
-                            # Merchant Tail & Resold as they went back to
-                            # active
-                            areaEOL_ProjLife = (areaEOL_ProjLife_collected_PG_3to5 +
-                                               areaEOL_ProjLife_notcollected_L0)
-                                    # Same as removed_ProjLife - area_Resold
-                            powerEOL_ProjLife = (
-                                areaEOL_ProjLife*poweragegen)
-    
-                        # 2. Calculate failures
-                        activeareaprev = activearea
-                        failures = row['Area']*pdf[age]
-    
-                        if failures > activearea:
-                            failures = activearea
-    
-    
-                        area_repaired = (failures *
-                                          df.iloc[age]['mod_Repair']*0.01)
-                        power_repaired = area_repaired*poweragegen
-    
-                        areaEOL_Failures_notrepaired = failures-area_repaired
-                        powerEOL_Failures_notrepaired = areaEOL_Failures_notrepaired*poweragegen
-    
-                        activearea = activeareaprev-areaEOL_Failures_notrepaired
-    
-    
-                        # Start appending the yearly age values
-    
-                        power_degraded_all.append(power_degradaded)
-                        
-                        areaEOL_degradation_all.append(areaEOL_degradation)
-                        powerEOL_degradation_all.append(powerEOL_degradation)
-    
-                        area_repaired_all.append(area_repaired)
-                        power_repaired_all.append(power_repaired)
-                        
-                        areaEOL_failure_notrepaired_all.append(areaEOL_Failures_notrepaired)
-                        powerEOL_failure_notrepaired_all.append(powerEOL_Failures_notrepaired)
-    
-                        area_merchantTail_all.append(area_merchantTail)
-                        power_merchantTail_all.append(power_merchantTail)
-    
-                        area_resold_all.append(area_resold)
-                        power_resold_all.append(power_resold)
-                        
-                        # has collected and non collected
-                        # but not merchant tailed and resold
-                        areaEOL_ProjLife_all.append(areaEOL_ProjLife)
-                        powerEOL_ProjLife_all.append(powerEOL_ProjLife)
-    
-                        # noncollected from project lifetime ((only one that had to be
-                        # collected internally for calculating the resold. 
-                        # Failures and degradation collection get calculated
-                        # later on the matrixes directly))
-                        areaEOL_ProjLife_notcollected_L0_all.append(areaEOL_ProjLife_notcollected_L0)
-                        powerEOL_ProjLife_notcollected_L0_all.append(powerEOL_ProjLife_notcollected_L0)
-                        
-                        # Collected for Path Goods
-                        areaEOL_ProjLife_collected_PG_3to5_all.append(areaEOL_ProjLife_collected_PG_3to5)
-                        powerEOL_ProjLife_collected_PG_3to5_all.append(powerEOL_ProjLife_collected_PG_3to5)
-    
-                        activeareacount.append(activearea)
-                        activepowercount.append(activearea*poweragegen)
-    
-                        # Generation age loop ends
-    
-                
-                # !! Unelegantly Correcting Initial Years 
-                try:
-                    # becuase the clip starts with 0 for the installation year,
-                    # dentifying installation year and adding initial area
-                    fixinitialareacount = next((i for i, e in enumerate(x)
-                                                if e), None) - 1
-                    activeareacount[fixinitialareacount] = (
-                        activeareacount[fixinitialareacount]+row['Area'])
-                    activepowercount[fixinitialareacount] = (
-                        activepowercount[fixinitialareacount] +
-                        row['Area'] * row['mod_eff'] * 0.01 *
-                        row['irradiance_stc'])
-                    # TODO: note mentioned 'this addition seems to do nothing.'
-                    # Check who /when wrote this and if theres need to fix.
-
-                except:
-                    # Last value doesnt have a xclip value of nonzero so it
-                    # gives except. But it also means the loop finished for
-                    # the calculations of Lifetime.
-                    fixinitialareacount = len(cdf)-1
-                    activeareacount[fixinitialareacount] = (
-                        activeareacount[fixinitialareacount]+row['Area'])
-                    activepowercount[fixinitialareacount] = (
-                        activepowercount[fixinitialareacount] + row['Area'] *
-                        row['mod_eff'] * 0.01 * row['irradiance_stc'])
-                    print("Finished Area+Power Generation Calculations")
-
-                #   area_disposed_of_generation_by_year = [element*row['Area']
-                #                                           for element in pdf]
-                # This used to be labeled as cumulative; but in the sense that
-                # they cumulate yearly deaths for all cohorts that die.
-
-                df['Yearly_Sum_Area_EOLby_Degradation'] += (
-                    areaEOL_degradation_all)
-                df['Yearly_Sum_Power_EOLby_Degradation'] += (
-                    powerEOL_degradation_all)
-                
-                df['Power_Degraded_[W]'] += power_degraded_all
-                
-                df['Yearly_Sum_Area_EOLby_Failure'] += (
-                    areaEOL_failure_notrepaired_all)
-                df['Yearly_Sum_Power_EOLby_Failure'] += (
-                    powerEOL_failure_notrepaired_all)
-
-                df['Yearly_Sum_Area_EOLby_ProjectLifetime'] += (
-                    areaEOL_ProjLife_all)
-                df['Yearly_Sum_Power_EOLby_ProjectLifetime'] += (
-                    powerEOL_ProjLife_all)
-
-                df['Yearly_Sum_Area_atEOL'] += areaEOL_failure_notrepaired_all
-                df['Yearly_Sum_Area_atEOL'] += areaEOL_ProjLife_all
-                df['Yearly_Sum_Area_atEOL'] += areaEOL_degradation_all
-
-                df['Yearly_Sum_Power_atEOL'] += powerEOL_failure_notrepaired_all
-                df['Yearly_Sum_Power_atEOL'] += (powerEOL_ProjLife_all)
-                df['Yearly_Sum_Power_atEOL'] += (powerEOL_degradation_all)
-
-                df['Repaired_Area'] += area_repaired_all
-                df['Repaired_[W]'] += power_repaired_all
-                df['Resold_Area'] += area_resold_all
-                df['Resold_[W]'] += power_resold_all
-                df['MerchantTail_Area'] += area_merchantTail_all
-                df['MerchantTail_[W]'] += power_merchantTail_all
-
-                df['Yearly_Sum_Area_PathsBad'] += areaEOL_degradation_all
-                df['Yearly_Sum_Power_PathsBad'] += powerEOL_degradation_all
-                
-                df['Yearly_Sum_Area_PathsBad'] += areaEOL_failure_notrepaired_all
-                df['Yearly_Sum_Power_PathsBad'] += powerEOL_failure_notrepaired_all
-
-                df['Yearly_Sum_Area_PathsGood'] += areaEOL_ProjLife_collected_PG_3to5_all
-                df['Yearly_Sum_Power_PathsGood'] += powerEOL_ProjLife_collected_PG_3to5_all
-
-                df['Cumulative_Active_Area'] += activeareacount
-                df['Effective_Capacity_[W]'] += activepowercount
-
-                df['Landfill_0_ProjLife'] += areaEOL_ProjLife_notcollected_L0_all
-
-
-                # MATRIXES:
-                Generation_EOL_pathsG.append(areaEOL_ProjLife_collected_PG_3to5_all)
-                Matrix_Landfilled_noncollected.append(
-                    areaEOL_ProjLife_notcollected_L0_all)
-                Matrix_areaEOL_degradation_all.append(areaEOL_degradation_all)
-                Matrix_Failures.append(areaEOL_failure_notrepaired_all)
-
-
-            df['WeibullParams'] = weibullParamList
-
-            # Cleanup of old calculations. Needed when you run twice function.
-            try:
-                df = df[df.columns.drop(list(df.filter(regex='^EOL_')))]
-            except:
-                print("Warning: Issue dropping EOL columns generated by "
-                      "calculateMFC routine to overwrite")
-
-            PG = pd.DataFrame(Generation_EOL_pathsG, columns=df.index,
-                              index=df.index)
-
-            L0 = pd.DataFrame(Matrix_Landfilled_noncollected,
-                              columns=df.index, index=df.index)
-
-            PBD = pd.DataFrame(Matrix_areaEOL_degradation_all, columns=df.index,
-                              index=df.index)
-
-            PBF = pd.DataFrame(Matrix_Failures, columns=df.index,
-                              index=df.index)
-
-            # Path Bad includes Path Bad from Project Lifetime and adding now
-            #  the path bads from Failures atEOL (not repaired)
-            PB = PBD + PBF
-
-            # Updating Path Bad for collection efficiency.
-            PBC = PB.mul(df['mod_EOL_collection_eff'].values*0.01)
-            PBNC = PB - PBC
-
-            # What doesn't get collected of Path Bad, goes to Landfill 0.
-            L0 = L0 + PBNC
-
-            # What goes on forward to Path Bads EoL Pathways is PBC.
-            df = df.join(PG.add_prefix("EOL_PG_Year_"))
-            df = df.join(L0.add_prefix("EOL_L0_Year_"))
-            df = df.join(PBC.add_prefix("EOL_BS_Year"))
-
-            df['EOL_Landfill0'] = L0.sum(axis=0)
-            df['EOL_BadStatus'] = PBC.sum(axis=0)
-            df['EOL_PG'] = PG.sum(axis=0)
-            df['EOL_PATHS'] = (PBC+PG).sum(axis=0)
-
-            # # Start to do EOL Processes PATHS GOOD
-            #######################################
-
-            # This Multiplication goes through Module and then material.
-            # It is for processes that depend on each year as they improve,
-            # i.e. Collection Efficiency,
-            #
-            # [  G1_1   G1_2    G1_3   G2_4 ...]       [N1
-            # [    0    G2_1    G2_2   G2_3 ...]   X    N2
-            # [    0      0     G3_1   G3_2 ...]        N3
-            #                                           N4]
-            #
-            #      EQUAL
-            # EOL_Collected =
-            # [  G1_1*N1   G1_2 *N2   G1_3 *N3   G2_4 *N4 ...]
-            # [    0       G2_1 *N2   G2_2 *N3   G2_3 *N4 ...]
-            # [    0        0         G3_1 *N3   G3_2 *N4 ...]
-            #
-
-            # Re-scaling Path Good Matrix, becuase Resold modules already got
-            # resold in the cohort loop above.
-            # 'originalMatrix' = reducedMatrix x 100 / (100-p2)
-            PG = PG.mul(100/(100-df['mod_EOL_pg0_resell']), axis=0)
-
-            # Paths GOOD Check for 100% sum.
-            # If P1-P5 over 100% will reduce landfill.
-            # If P2-P5 over 100% it will shut down with Warning and Exit.
-            #TODO: add check for less than 100%, adjust landfill
-            SUMS1 = (df['mod_EOL_pg1_landfill'] + df['mod_EOL_pg0_resell'] +
-                     df['mod_EOL_pg2_stored'] + df['mod_EOL_pg3_reMFG'] +
-                     df['mod_EOL_pg4_recycled'])
-            SUMS2 = (df['mod_EOL_pg0_resell'] +
-                     df['mod_EOL_pg2_stored'] + df['mod_EOL_pg3_reMFG'] +
-                     df['mod_EOL_pg4_recycled'])
-
-            if (SUMS2 > 100).any():
-                print("WARNING: Paths 0 through 4 should add to a 100%." +
-                      " and there is no way to correct by updating " +
-                      " path1_landfill. " +
-                      " STOPPING SIMULATION NOW GO AND FIX YOUR INPUT. Tx <3")
-                return
-
-            if (SUMS1 > 100).any():
-                print("Warning: Paths 0 through 4 add to above 100%;" +
-                      "Fixing by Updating Landfill value to the remainder of" +
-                      "100-(P0+P2+P3+P4).")
-                df['mod_EOL_pg1_landfill'] = 100-SUMS2
-
-            # PATH1
-            PG1_landfill = PG.mul(df['mod_EOL_pg1_landfill'].values*0.01)
-            df['PG1_landfill'] = list(PG1_landfill.sum())
-
-            # PATH2
-            PG2_stored = PG.mul(df['mod_EOL_pg2_stored'].values*0.01)
-            df['PG2_stored'] = list(PG2_stored.sum())
-            # TODO: Future development of Stored path here.
-
-            # PATH3
-
-            # TODO: evaluate if PG3_reMFG, PG3_reMFG_yield and
-            # PG3_reMFG_unyield are given as output and if not are needed.
-            # Also for BAD PATHS PB3_reMFG, PB3_reMFG_yield, PB3_reMFG_unyield
-
-            PG3_reMFG = PG.mul(df['mod_EOL_pg3_reMFG'].values*0.01)
-            df['PG3_reMFG'] = list(PG3_reMFG.sum())
-
-            PG3_reMFG_yield = PG3_reMFG.mul(
-                                        df['mod_EOL_reMFG_yield'].values*0.01)
-            df['PG3_reMFG_yield'] = list(PG3_reMFG_yield.sum())
-
-            PG3_reMFG_unyield = PG3_reMFG-PG3_reMFG_yield
-            df['PG3_reMFG_unyield'] = list(PG3_reMFG_unyield.sum())
-
-            # PATH 4
-            PG4_recycled = PG.mul(df['mod_EOL_pg4_recycled'].values*0.01)
-            df['PG4_recycled'] = list(PG4_recycled.sum())
-
-            # PATH BADS:
-            # ~~~~~~~~~~~
-
-            # Check for 100% sum.
-            # If P1-P5 over 100% will reduce landfill.
-            # If P2-P5 over 100% it will shut down with Warning and Exit.
-            SUMS1 = (df['mod_EOL_pb1_landfill'] +
-                     df['mod_EOL_pb2_stored'] + df['mod_EOL_pb3_reMFG'] +
-                     df['mod_EOL_pb4_recycled'])
-            SUMS2 = (df['mod_EOL_pb2_stored'] + df['mod_EOL_pb3_reMFG'] +
-                     df['mod_EOL_pb4_recycled'])
-
-            if (SUMS2 > 100).any():
-                print("WARNING: Paths B 1 through 4 should add to a 100%." +
-                      " and there is no way to correct by updating " +
-                      " path1_landfill. " +
-                      " STOPPING SIMULATION NOW GO AND FIX YOUR INPUT. Tx <3")
-                return
-
-            if (SUMS1 > 100).any():
-                print("Warning: Paths B 1 through 4 add to above 100%;" +
-                      "Fixing by Updating Landfill value to the remainder of" +
-                      "100-(P2+P3+P4).")
-                df['mod_EOL_pb1_landfill'] = 100-SUMS2
-
-            # PATH1
-            PB1_landfill = PBC.mul(df['mod_EOL_pb1_landfill'].values*0.01)
-            df['PB1_landfill'] = list(PB1_landfill.sum())
-
-            # PATH2
-            PB2_stored = PBC.mul(df['mod_EOL_pg2_stored'].values*0.01)
-            df['PB2_stored'] = list(PB2_stored.sum())
-            # TODO: Future development of Stored path here.
-
-            # PATH3
-            PB3_reMFG = PBC.mul(df['mod_EOL_pb3_reMFG'].values*0.01)
-            df['PB3_reMFG'] = list(PB3_reMFG.sum())
-
-            PB3_reMFG_yield = PB3_reMFG.mul(
-                                        df['mod_EOL_reMFG_yield'].values*0.01)
-            df['PB3_reMFG_yield'] = list(PB3_reMFG_yield.sum())
-
-            PB3_reMFG_unyield = PB3_reMFG-PB3_reMFG_yield
-            df['PB3_reMFG_unyield'] = list(PB3_reMFG_unyield.sum())
-
-            # PATH 4
-            PB4_recycled = PBC.mul(df['mod_EOL_pb4_recycled'].values*0.01)
-            df['PB4_recycled'] = list(PB4_recycled.sum())
-
-            # ADD Matrices now for path goods and bads, becuase we don't need
-            # to distinguish on the source of the material stream.
-            P1_landfill = PG1_landfill + PB1_landfill
-            P2_stored = PG2_stored + PB2_stored
-            P3_reMFG_yield = PG3_reMFG_yield + PB3_reMFG_yield
-            P3_reMFG_unyield = PG3_reMFG_unyield + PB3_reMFG_unyield
-
-            df['P2_stored'] = list(P2_stored.sum())
-
-            df['P3_reMFG'] = list((P3_reMFG_yield+P3_reMFG_unyield).sum())
-
-            P4_recycled = PG4_recycled + PB4_recycled
-            df['P4_recycled'] = list(P4_recycled.sum())
-
-            # Cleanup of internal renaming and internal use columns
-            df.drop(['new_Installed_Capacity_[W]', 't50', 't90'],
-                    axis=1, inplace=True)
-
-            # Printout ref. of how much more module area is being manufactured.
-            # The manufactured efficiency is calculated on more detail on the
-            # material loop below for hte mass.
-            df['ModuleTotal_MFG'] = df['Area']*100/df['mod_MFG_eff']
-
-            ################
-            # Material Loop#
-            ################
-
-            if materials is None:
-                materials = list(self.scenario[scenarios[0]].material.keys())
-            else:
-                if isinstance(materials, str):
-                    materials = [materials]
-
-            for mat in materials:
-
-                print("==> Working on Material : ", mat)
-
-                dm = self.scenario[scen].material[mat].matdataIn_m.copy()
-                initialColsMat = dm.keys()
-                # SWITCH TO MASS UNITS FOR THE MATERILA NOW:
-                # THIS IS DIFFERENT MULTIPLICATION THAN THE REST
-                # BECAUSE IT DEPENDS TO THE ORIGINAL MASS OF EACH MODULE
-                # WHEN INSTALLED
-                # [M1  * [  G1_1   G1_2    G1_3   G2_4 ...]
-                #  M2     [    0    G2_1    G2_2   G2_3 ...]
-                #  M3]    [    0      0     G3_1   G3_2 ...]
-                #
-                #           EQUAL
-                # mat_EOL_sentoRecycling =
-                #     [  G1_1*M1   G1_2*M1    G1_3*M1   G2_4*M1 ...]
-                #     [    0       G2_1*M2    G2_2*M2   G2_3*M2 ...]
-                #     [    0           0      G3_1*M3   G3_2*M3 ...]
-                #
-
-
-                dm['mat_L0'] = list(L0.multiply(dm['mat_massperm2'], axis=0).sum())
-
-                dm['mat_PG2_stored'] = list(P2_stored.multiply(dm['mat_massperm2'],axis=0).sum())
-
-                dm['mat_L1'] = list(P1_landfill.multiply(dm['mat_massperm2'], axis=0).sum())
-
-                # PATH 3
-                mat_reMFG = P3_reMFG_yield.multiply(dm['mat_massperm2'],axis=0)
-                mat_reMFG_mod_unyield = P3_reMFG_unyield.multiply(dm['mat_massperm2'],axis=0)
-                dm['mat_reMFG'] = list(mat_reMFG.sum())
-                dm['mat_reMFG_mod_unyield'] = list(mat_reMFG_mod_unyield.sum())
-
-                dm['mat_reMFG_target'] = dm['mat_reMFG'] * dm['mat_PG3_ReMFG_target'] * 0.01
-                dm['mat_reMFG_untarget'] = dm['mat_reMFG']-dm['mat_reMFG_target']
-
-                dm['mat_reMFG_yield'] = dm['mat_reMFG_target'] * dm['mat_ReMFG_yield'] * 0.01
-                dm['mat_reMFG_unyield'] = dm['mat_reMFG_target'] - dm['mat_reMFG_yield']
-
-
-                # SUBPATH 1: ReMFG to Recycling
-                dm['mat_reMFG_all_unyields'] = dm['mat_reMFG_mod_unyield'] + dm['mat_reMFG_untarget'] + dm['mat_reMFG_unyield']
-                dm['mat_reMFG_2_recycle'] = dm['mat_reMFG_all_unyields'] * df['mod_EOL_sp_reMFG_recycle'] * 0.01
-                dm['mat_L2'] = dm['mat_reMFG_all_unyields']-dm['mat_reMFG_2_recycle']
-
-
-                # PATH 4
-                mat_recycled = P4_recycled.multiply(dm['mat_massperm2'],axis=0)
-                dm['mat_recycled_PG4'] = list(mat_recycled.sum())
-                dm['mat_recycled_all'] = dm['mat_recycled_PG4'] + dm['mat_reMFG_2_recycle']
-
-                dm['mat_recycled_target'] = dm['mat_recycled_all'] * dm['mat_PG4_Recycling_target'] * 0.01
-                dm['mat_L3'] = dm['mat_recycled_all'] - dm['mat_recycled_target']  # material un-target
-
-                dm['mat_recycled_yield'] = dm['mat_recycled_target'] * dm['mat_Recycling_yield'] * 0.01
-                dm['mat_L4'] = dm['mat_recycled_target'] - dm['mat_recycled_yield']  # material un-target
-
-                # HQ and OQ reycling paths:
-                dm['mat_EOL_Recycled_2_HQ'] = dm['mat_recycled_yield'] * dm['mat_EOL_Recycled_into_HQ'] * 0.01
-                dm['mat_EOL_Recycled_2_OQ'] = dm['mat_recycled_yield'] - dm['mat_EOL_Recycled_2_HQ']
-
-                dm['mat_EOL_Recycled_HQ_into_MFG'] = dm['mat_EOL_Recycled_2_HQ'] * dm['mat_EOL_RecycledHQ_Reused4MFG'] * 0.01
-                dm['mat_EOL_Recycled_HQ_into_OU'] = dm['mat_EOL_Recycled_2_HQ'] - dm['mat_EOL_Recycled_HQ_into_MFG']
-
-
-                ## Beginning of Life Calculations Now
-                ######################################
-                # TODO: Close loop later to reduce MFG step... something. mat_reMFG_yield closing to mat_
-
-                # CHECK
-                dm['mat_EnteringModuleManufacturing_total'] = (df['Area'] * dm['mat_massperm2']*100/df['mod_MFG_eff'])
-                dm['mat_UsedSuccessfullyinModuleManufacturing'] = (df['Area'] * dm['mat_massperm2'])
-                dm['mat_LostinModuleManufacturing'] = dm['mat_EnteringModuleManufacturing_total'] - dm['mat_UsedSuccessfullyinModuleManufacturing']
-
-                dm['mat_EnteringModuleManufacturing_total'] = (df['Area'] * dm['mat_massperm2']*100/df['mod_MFG_eff'])
-
-                # Input from Successful ReMFG to offset Module Manufacturing Material Needs.
-                dm['mat_EnteringModuleManufacturing_virgin'] = dm['mat_EnteringModuleManufacturing_total'] - dm['mat_reMFG_yield']
-                
-                ###################HEATHERS REMFG ATTEMPT
-                
-                dm['mat_EOL_ReMFG_VAT'] = dm['mat_reMFG_yield'] #make a copy of remfged yield to modify
-
-                carryoverReMFG = True #todo, make sim input?
-                
-                if carryoverReMFG: #if we are using previous years recovered reMFGing materials
-                    reMFGsurplusEndofSim = 0 #init
-                    
-                    for rn in range(0,len(dm)): #loop over sim years
-                        reMFGsurplus = ( dm['mat_EOL_ReMFG_VAT'].loc[rn]- # vat of prev remfg
-                                        dm['mat_EnteringModuleManufacturing_total'].loc[rn]) #minus mfging needs CHECK THIS
-                        #positive value means surplus
-                        if reMFGsurplus > 0: #if surplus
-                            if rn == len(dm)-1: #end of simulation condition
-                                reMFGsurplusEndofSim = reMFGsurplus
-                                print("ReMFG surplus End of Sim for Mat ", mat,
-                                      " Scenario ", scen, " = ",
-                                      reMFGsurplusEndofSim/1000000, " tonnes.")
-                                dm.loc[rn,'mat_EOL_ReMFG_VAT'] -= reMFGsurplus
-                            else: #during simulation years
-                                dm.loc[rn+1,'mat_EOL_ReMFG_VAT'] += reMFGsurplus #move surplus to next year
-                                dm.loc[rn,'mat_EOL_ReMFG_VAT'] -= reMFGsurplus #remove surplus from current year
-                    #input from REMFG to offset material
-                    dm['mat_EnteringModuleManufacturing_virgin'] = ( 
-                        dm['mat_EnteringModuleManufacturing_total']-
-                        dm['mat_EOL_ReMFG_VAT'])
-                    
-                else:
-                    #input from REMFG to offset material, modify main data frame
-                    dm['mat_EnteringModuleManufacturing_virgin'] = ( 
-                        dm['mat_EnteringModuleManufacturing_total']-
-                        dm['mat_EOL_ReMFG_VAT'])
-                
-                #####################################################
-                    
-                # Material Manufacturing Stage
-                dm['mat_Manufacturing_Input'] = dm['mat_EnteringModuleManufacturing_virgin'] / (dm['mat_MFG_eff'] * 0.01)
-
-                # Scrap = Lost to Material manufacturing losses + Module manufacturing losses
-                dm['mat_MFG_Scrap'] = (dm['mat_Manufacturing_Input'] - dm['mat_EnteringModuleManufacturing_virgin'] +
-                                      dm['mat_LostinModuleManufacturing'])
-                dm['mat_MFG_Scrap_Sentto_Recycling'] = dm['mat_MFG_Scrap'] * dm['mat_MFG_scrap_Recycled'] * 0.01
-
-
-                dm['mat_MFG_Scrap_Landfilled'] = dm['mat_MFG_Scrap'] - dm['mat_MFG_Scrap_Sentto_Recycling']
-                dm['mat_MFG_Scrap_Recycled_Successfully'] = (dm['mat_MFG_Scrap_Sentto_Recycling'] *
-                                                                 dm['mat_MFG_scrap_Recycling_eff'] * 0.01)
-                dm['mat_MFG_Scrap_Recycled_Losses_Landfilled'] = (dm['mat_MFG_Scrap_Sentto_Recycling'] -
-                                                                          dm['mat_MFG_Scrap_Recycled_Successfully'])
-                dm['mat_MFG_Recycled_into_HQ'] = (dm['mat_MFG_Scrap_Recycled_Successfully'] *
-                                                        dm['mat_MFG_scrap_Recycled_into_HQ'] * 0.01)
-                dm['mat_MFG_Recycled_into_OQ'] = dm['mat_MFG_Scrap_Recycled_Successfully'] - dm['mat_MFG_Recycled_into_HQ']
-                dm['mat_MFG_Recycled_HQ_into_MFG'] = (dm['mat_MFG_Recycled_into_HQ'] *
-                                          dm['mat_MFG_scrap_Recycled_into_HQ_Reused4MFG'] * 0.01)
-                dm['mat_MFG_Recycled_HQ_into_OU'] = dm['mat_MFG_Recycled_into_HQ'] - dm['mat_MFG_Recycled_HQ_into_MFG']
-
-                dm['mat_EOL_Recycled_VAT'] = dm['mat_EOL_Recycled_HQ_into_MFG']
-                
-                carryoverVat = True # TODO: Make this a sim input
-
-                if carryoverVat:    #if we are using previous years recycled material to closed loop offset
-                    recycledsurplusEndofSim = 0 #init
-                    # calculate the difference between mfging req and recycled material availability
-                    for rr in range(0, len(dm)): #loop over the the years of existing dm 
-                        recycledsurplus = ( dm['mat_MFG_Recycled_HQ_into_MFG'].loc[rr] + #mfg scrap in that year
-                                       dm['mat_EOL_Recycled_VAT'].loc[rr] #plus EOL scrap in that year
-                                       -dm['mat_Manufacturing_Input'].loc[rr] ) #minus mfging needs
-                        # positive value means there is a surplus in that year that needs to be carried to next year
-                        if recycledsurplus > 0: # if surplus
-                            if rr == len(dm)-1: #end of simulation condition
-                                recycledsurplusEndofSim = recycledsurplus
-                                print("Recycled surplus End of Sim for Mat ", mat,
-                                      " Scenario ", scen, " = ",
-                                      recycledsurplusEndofSim/1000000, " tonnes.")
-                                
-                                dm.loc[rr,'mat_EOL_Recycled_VAT'] -= recycledsurplus
-                                
-                            else:  #during simulation 
-                                dm.loc[rr+1,'mat_EOL_Recycled_VAT'] += ( #add the surplus to the next year's VAT
-                                            recycledsurplus)
-                                dm.loc[rr, 'mat_EOL_Recycled_VAT'] -= recycledsurplus #remove surplus from current year
-                                
-                    # Input from Successful Recycling to offset Material
-                    # Manufacturing Virgin Needs:
-                    dm['mat_Virgin_Stock'] = (dm['mat_Manufacturing_Input'] -
-                                              dm['mat_EOL_Recycled_VAT'] -
-                                              dm['mat_MFG_Recycled_HQ_into_MFG'])     
-                    # This is what goes into OU in the 'else' statement.
-                    dm['mat_EOL_Recycled_HQ_into_MFG_notUSED'] = (
-                        dm['mat_EOL_Recycled_HQ_into_MFG'] - dm['mat_EOL_Recycled_VAT'])
-
-                    # Have ot think on the recycledendofsimsurplus... 
-                else:
-                # Input from Successful Recycling to offset Material
-                # Manufacturing Virgin Needs:                   
-                    dm['mat_Virgin_Stock'] = (dm['mat_Manufacturing_Input'] -
-                                          dm['mat_EOL_Recycled_HQ_into_MFG'] -
-                                          dm['mat_MFG_Recycled_HQ_into_MFG'])
-
-                    # TO DO: rename 2 to original one, just using it for the 
-                    # sanity check
-                    dm['mat_MFG_Recycled_HQ_into_OU2'] = dm['mat_MFG_Recycled_HQ_into_OU']
-
-                    dm.loc[dm['mat_Virgin_Stock'] < 0, 'mat_MFG_Recycled_HQ_into_OU2'] = (dm[dm['mat_Virgin_Stock'] < 0]['mat_MFG_Recycled_HQ_into_OU2'] - dm[dm['mat_Virgin_Stock'] < 0]['mat_Virgin_Stock'] )
-                    
-                    dm.loc[dm['mat_Virgin_Stock']<0, 'mat_Virgin_Stock'] = 0
-                    print("VAT carryover material is turned OFF")                   
-        
-                # Calculate raw virgin needs before mining and refining efficiency losses
-                dm['mat_Virgin_Stock_Raw'] = (dm['mat_Virgin_Stock'] * 100 /  dm['mat_virgin_eff'])
-
-
-                    
-                    
-                # Add Wastes
-
-                dm['mat_Total_EOL_Landfilled'] = (dm['mat_L0']+  #'mat_modules_NotCollected'] +
-                                                  dm['mat_L1']+ # 'mat Path Good Chosen to be Landfilled +
-                                                  dm['mat_L2']+ # mat not reMFG (yields module, target, or yieldds matr) NOT sent to recycling
-                                                  dm['mat_L3']+ # mat in recycling not TARGET so landfilled +
-                                                  dm['mat_L4']) # mat in EOL_Recycled_Losses_Landfilled
-
-                dm['mat_Total_MFG_Landfilled'] = (dm['mat_MFG_Scrap_Landfilled'] +
-                                                 dm['mat_MFG_Scrap_Recycled_Losses_Landfilled'])
-
-                dm['mat_Total_Landfilled'] = (dm['mat_Total_EOL_Landfilled'] +
-                                              dm['mat_Total_MFG_Landfilled'])
-
-                dm['mat_Total_Recycled_OU'] = (dm['mat_EOL_Recycled_2_OQ'] +
-                                               dm['mat_EOL_Recycled_HQ_into_OU'] +
-                                               dm['mat_MFG_Recycled_into_OQ'] +
-                                               dm['mat_MFG_Recycled_HQ_into_OU'])
-
-
-                self.scenario[scen].material[mat].matdataOut_m = dm[dm.columns.difference(initialColsMat)]
-
-
-            # CLEANUP MATRICES HERE:
-            if debugflag:
-                debugdf = df[(list(df.filter(regex='EOL_PG_Year_')))]
-                debugdfB = df[(list(df.filter(regex='EOL_L0_Year_')))]
-                debugdfC = df[(list(df.filter(regex='EOL_BS_Year')))]
-                debugdf = debugdf.join(debugdfB) 
-                debugdf = debugdf.join(debugdfC) 
-                self.scenario[scen].dataDebug_m = debugdf                        
-
-            df = df[df.columns.drop(list(df.filter(regex='EOL_PG_Year_')))]
-            df = df[df.columns.drop(list(df.filter(regex='EOL_L0_Year_')))]
-            df = df[df.columns.drop(list(df.filter(regex='EOL_BS_Year')))]
-
-            self.scenario[scen].dataOut_m = df[df.columns.difference(initialCols)]
-
-
-    #method to calculate energy flows as a function of mass flows and circular pathways
-    def calculateEnergyFlow(self, scenarios=None, materials=None,
-                            insolation = 4800, PR = 0.85):
-        '''
-        Function takes as input PV ICE resulting mass flow dataframes for scenarios
-        and materials and performs the energy flow calculations.
+    #method to calculate energy flows as a function of mass flows and circular pathways
+    def calculateEnergyFlow(self, scenarios=None, materials=None,
+                            insolation = 4800, PR = 0.85, dtype=None,
+                            n_jobs=None, sharedmemory=False,
+                            n_threads=None):
+        '''
+        Function takes as input PV ICE resulting mass flow dataframes for scenarios
+        and materials and performs the energy flow calculations.
 
         Parameters
         ------------
@@ -1540,6 +2295,19 @@ class Simulation:
         PR : float
             Performance ratio, converts from DC to AC accounting for interver
             loading, necessary for EROI. Default is 0.85
+        dtype : numpy dtype
+            Floating point type of the energy flows. Defaults to the
+            Simulation ``dtype``.
+        n_jobs : int
+            Number of processes to split the scenarios on. None or 1
+            (default) calculate on this process; -1 uses all the CPUs.
+        sharedmemory : bool
+            With ``n_jobs``, hand the input and output dataframes to the
+            workers through shared memory blocks instead of pickling them.
+        n_threads : int
+            Number of threads to split the materials on, after the module
+            stage. None or 1 (default) run all materials on this thread; -1
+            uses all the CPUs.
 
         Returns
         --------
@@ -1565,74 +2333,111 @@ class Simulation:
             if isinstance(materials, str):
                 materials = [materials]
 
+        if n_jobs not in (None, 1):
+            return self._calculateParallel(
+                'calculateEnergyFlow', scenarios, materials, n_jobs,
+                sharedmemory=sharedmemory,
+                insolation=insolation, PR=PR, dtype=dtype,
+                n_threads=n_threads)
+
+        dtype = self._flowDtype(dtype)
+
         print("\n\n>>>> Calculating Energy Flows <<<<\n")
 
+        # Scenarios with the same number of years are calculated together on
+        # scenario x year arrays.
+        batches = {}
         for scen in scenarios:
-            print("Working on Scenario: ", scen)
-            print("********************")
-            
-            df = self.scenario[scen].dataOut_m
-            df_in = self.scenario[scen].dataIn_m
-            modEnergy=self.scenario[scen].dataIn_e
-
-            de = pd.DataFrame()
-            de['mod_MFG'] = df['ModuleTotal_MFG']*modEnergy['e_mod_MFG']
-            de['mod_Install'] = df['Area']*modEnergy['e_mod_Install']
-            de['mod_OandM'] = df['Cumulative_Active_Area']*modEnergy['e_mod_OandM']
-            de['mod_Repair'] = df['Repaired_Area']*modEnergy['e_mod_Repair']
-            de['mod_Demount'] = (df['Resold_Area']+df['Yearly_Sum_Area_PathsBad']+df['Landfill_0_ProjLife']
-                               +df['Yearly_Sum_Area_PathsGood'])*modEnergy['e_mod_Demount']
-            de['mod_Store'] = df['P2_stored']*modEnergy['e_mod_Store']
-            de['mod_Resell_Certify'] = df['Resold_Area']*modEnergy['e_mod_Resell_Certify']
-            de['mod_ReMFG_Disassembly'] = df['P3_reMFG']*modEnergy['e_mod_ReMFG_Disassembly']
-            de['mod_Recycle_Crush'] = df['P4_recycled']*modEnergy['e_mod_Recycle_Crush']
-
-            #Energy Generation, Energy_out = Insolation (adjusted for bifi) * ActivePower/Irradience * time * PR
-            de['e_out_annual_[Wh]'] = insolation*(df['irradiance_stc']/1000) * (df['Effective_Capacity_[W]']/1000) * 365 * PR
-            
-            self.scenario[scen].dataOut_e = de #Wh
-            
+            batches.setdefault(len(self.scenario[scen].dataOut_m), []).append(scen)
+
+        for batch in batches.values():
+            for scen in batch:
+                print("Working on Scenario: ", scen)
+                print("********************")
+
+            dfs = [self.scenario[scen].dataOut_m for scen in batch]
+            modEnergy = _stackColumns([
+                _inputFrame(self.scenario[scen], 'dataIn_e').reindex(df.index)
+                for scen, df in zip(batch, dfs)], dtype)
+            de = _moduleEnergyFlows(_stackColumns(dfs, dtype), modEnergy,
+                                    insolation=insolation, PR=PR)
+            decolumns = list(de)
+            de = np.stack([de[key] for key in decolumns], axis=-1)
+
+            for ss, (scen, df) in enumerate(zip(batch, dfs)):
+                self.scenario[scen].dataOut_e = pd.DataFrame(
+                    de[ss], columns=decolumns, index=df.index) #Wh
+
+            withEnergy = {}
             for mat in materials:
-                
-                if self.scenario[scen].material[mat].matdataIn_e is None:
-                    print("==> No energy material found for Material : ", mat, ". Skipping Energy calculations.")
-                    demat = None
-                else:
-    
-                    print("==> Working on Energy for Material : ", mat)
-                    
-                    dm = self.scenario[scen].material[mat].matdataOut_m               
-                    matEnergy=self.scenario[scen].material[mat].matdataIn_e
-        
-                    demat = pd.DataFrame()
-                    demat['mat_extraction'] = dm['mat_Virgin_Stock_Raw']*matEnergy['e_mat_extraction']
-                    demat['mat_MFG_virgin'] = dm['mat_Virgin_Stock']*matEnergy['e_mat_MFG'] #multiply only the virgin input
-                    demat['mat_MFG_virgin_fuel'] = demat['mat_MFG_virgin']*matEnergy['e_mat_MFG_fuelfraction']*0.01 #fuel fraction of the virgin energy demands
-                    #demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']*(1-matEnergy['e_mat_MFG_fuelfraction'])*0.01 
-                    demat['mat_MFGScrap_LQ'] = dm['mat_MFG_Scrap_Sentto_Recycling']*matEnergy['e_mat_MFGScrap_LQ'] #OQ only - everything that goes into mfgscrap recycle
-                    demat['mat_MFGScrap_HQ'] = dm['mat_MFG_Recycled_into_HQ']*(matEnergy['e_mat_MFGScrap_HQ']) #the additional energy required for HQ
-                    demat['mat_MFGScrap_HQ_fuel'] = demat['mat_MFGScrap_HQ']*matEnergy['e_mat_Recycled_HQ_fuelfraction']*0.01 #fraction of HQ energy attributable to fuel
-                    #demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']*(1-matEnergy['e_mat_MFG_fuelfraction'])*0.01 
-    
-                    demat['mat_Landfill'] = dm['mat_Total_Landfilled']*matEnergy['e_mat_Landfill']
-                    demat['mat_Landfill_fuel'] = demat['mat_Landfill']*matEnergy['e_mat_Landfill_fuelfraction']*0.01 #fuel fraction of landfilling
-                    demat['mat_EoL_ReMFG_clean'] = dm['mat_reMFG_target']*matEnergy['e_mat_EoL_ReMFG_clean']
-                    demat['mat_Recycled_LQ'] = dm['mat_recycled_target']*matEnergy['e_mat_Recycled_LQ']
-                    demat['mat_Recycled_HQ'] = dm['mat_EOL_Recycled_2_HQ']*matEnergy['e_mat_Recycled_HQ']
-                    demat['mat_Recycled_HQ_fuel'] = demat['mat_Recycled_HQ']*matEnergy['e_mat_Recycled_HQ_fuelfraction']*0.01
-                    demat['mat_Recycled_HQ_elec'] = demat['mat_Recycled_HQ']-demat['mat_Recycled_HQ_fuel']
-    
-                self.scenario[scen].material[mat].matdataOut_e = demat #Wh
+
+                withEnergy[mat] = [
+                    scen for scen in batch
+                    if _inputFrame(self.scenario[scen].material[mat],
+                                   'matdataIn_e') is not None]
+
+                for scen in batch:
+                    if scen not in withEnergy[mat]:
+                        print("==> No energy material found for Material : ", mat, ". Skipping Energy calculations.")
+                        self.scenario[scen].material[mat].matdataOut_e = None
+                    else:
+                        print("==> Working on Energy for Material : ", mat)
+
+            def materialEnergy(mat):
+                dms = [self.scenario[scen].material[mat].matdataOut_m
+                       for scen in withEnergy[mat]]
+                matEnergy = _stackColumns([
+                    _inputFrame(self.scenario[scen].material[mat],
+                                'matdataIn_e').reindex(dm.index)
+                    for scen, dm in zip(withEnergy[mat], dms)], dtype)
+                demat = _materialEnergyFlows(_stackColumns(dms, dtype), matEnergy)
+                dematcolumns = list(demat)
+                demat = np.stack([demat[key] for key in dematcolumns], axis=-1)
+                return dms, dematcolumns, demat
+
+            # Each material only reads its own frames, so they can run on
+            # separate threads.
+            energymaterials = [mat for mat in materials if withEnergy[mat]]
+            results = _threadMap(materialEnergy, energymaterials, n_threads)
+
+            for mat, (dms, dematcolumns, demat) in zip(energymaterials, results):
+                for ss, (scen, dm) in enumerate(zip(withEnergy[mat], dms)):
+                    self.scenario[scen].material[mat].matdataOut_e = pd.DataFrame(
+                        demat[ss], columns=dematcolumns, index=dm.index) #Wh
 
     def calculateCarbonFlows(self, scenarios=None, materials=None, 
                              countrygridmixes = None, gridemissionfactors = None, 
                              materialprocesscarbon = None, modulecountrymarketshare = None, 
-                             materialcountrymarketshare = None, country_deploy = 'USA'):
-        if scenarios is None:
-            scenarios = list(self.scenario.keys())
-        else:
-            if isinstance(scenarios, str):
-                scenarios = [scenarios]
+                             materialcountrymarketshare = None, country_deploy = 'USA',
+                             n_jobs=None, sharedmemory=False,
+                             n_threads=None):
+        '''
+        Function takes as input PV ICE resulting energy flow dataframes for
+        scenarios and materials and performs the carbon flow calculations.
+
+        Parameters
+        ------------
+        scenarios : None
+            string with the scenario name or list of strings with
+            scenarios names to loop over. Must exist on the PV ICE object and
+            already have undergone the energy flow calculations.
+        materials : None
+            string with the material name or list of strings with the
+            materials names to loop over.
+        n_jobs : int
+            Number of worker processes to split the scenarios over, as in
+            ``calculateFlows``.
+        n_threads : int
+            Accepted for symmetry with the mass and energy flows, but the
+            carbon stage always runs serially: it is pandas code that holds
+            the GIL, so threads would not speed it up. The country market
+            share files are read once per material for all the scenarios.
+        '''
+        if scenarios is None:
+            scenarios = list(self.scenario.keys())
+        else:
+            if isinstance(scenarios, str):
+                scenarios = [scenarios]
 
         if materials is None:
             materials = list(self.scenario[scenarios[0]].material.keys())
@@ -1640,6 +2445,17 @@ class Simulation:
             if isinstance(materials, str):
                 materials = [materials]
 
+        if n_jobs not in (None, 1):
+            return self._calculateParallel(
+                'calculateCarbonFlows', scenarios, materials, n_jobs,
+                sharedmemory=sharedmemory,
+                countrygridmixes=countrygridmixes,
+                gridemissionfactors=gridemissionfactors,
+                materialprocesscarbon=materialprocesscarbon,
+                modulecountrymarketshare=modulecountrymarketshare,
+                materialcountrymarketshare=materialcountrymarketshare,
+                country_deploy=country_deploy, n_threads=n_threads)
+
         print("\n\n>>>> Calculating Carbon Flows <<<<\n")
         
         #carbon folder 
@@ -1659,7 +2475,7 @@ class Simulation:
         materialprocesscarbon = pd.read_csv(os.path.join(carbonfolder,'baseline_materials_processCO2.csv'), index_col='Material')
         #countrygridmixes = pd.read_csv(os.path.join(carbonfolder,'baseline_countrygridmix.csv'))
         countrymodmfg = pd.read_csv(os.path.join(carbonfolder,'baseline2100_module_countrymarketshare.csv'))
-        
+        countrymatmfgs = {} # material market shares, read once for all scenarios
         
         
         for scen in scenarios:
@@ -1729,73 +2545,75 @@ class Simulation:
             
             self.scenario[scen].dataOut_c = dc
             
-            for mat in materials:
+            def materialCarbon(mat):
+                demat = self.scenario[scen].material[mat].matdataOut_e
+                dm = self.scenario[scen].material[mat].matdataOut_m               
                 
-                if self.scenario[scen].material[mat].matdataIn_e is None:
-                    print("==> No Carbon intensity found for Material : ", mat, ". Skipping Carbon calculations.")
-                    demat = None
-                else:
-    
-                    print("==> Working on Carbon for Material : ", mat)
-                    
-                    demat = self.scenario[scen].material[mat].matdataOut_e
-                    dm = self.scenario[scen].material[mat].matdataOut_m               
-                    
+                if mat not in countrymatmfgs:
                     matfilename = 'baseline2100_'+str(mat)+'_MFGing_countrymarketshare.csv'
-                    countrymatmfg = pd.read_csv(os.path.join(carbonfolder, matfilename))
-                
-                    #carbon intensity of material manufacturing weighted by country
-                    #list countries mfging material
-                    countriesmfgingmat = list(countrymatmfg.columns[1:])
-
-                    #weight carbon intensity of electricity by countries which mfging modules
-                    countrycarbon_matmfg_gco2eqpwh = []
-                    for matcountry in countriesmfgingmat:
-                        if matcountry in country_carbonpwh:
-                            currentcountry = country_carbonpwh[matcountry]*countrymatmfg[matcountry]*.01
-                            countrycarbon_matmfg_gco2eqpwh.append(currentcountry)
-                        else: print('Check '+mat+' MFGing by Country file OR add to country grid mix file. We dont have a grid mix for: '+matcountry)
-        
-                    matmfg_gco2eqpwh_bycountry = pd.DataFrame(countrycarbon_matmfg_gco2eqpwh).T #
-                    matmfg_gco2eqpwh_bycountry['Global_gCO2eqpwh'] = matmfg_gco2eqpwh_bycountry.sum(axis=1) #annual carbon intensity of elec country wtd 
+                    countrymatmfgs[mat] = pd.read_csv(os.path.join(carbonfolder, matfilename))
+                countrymatmfg = countrymatmfgs[mat]
             
-                    #carbon impacts mat mfging wtd by country
-                    #electric
-                    demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']-demat['mat_MFG_virgin_fuel']
-                    dcmat = matmfg_gco2eqpwh_bycountry.mul(demat['mat_MFG_virgin_elec'],axis=0)
-                    dcmat.rename(columns={'Global_gCO2eqpwh':'Global'}, inplace=True)
-                    dcmat = dcmat.add_suffix('_vmfg_elec_gCO2eq')
-                    
-                    #fuel CO2 impacts
-                    steamHeat = list(gridemissionfactors[gridemissionfactors['Energy Source']=='SteamAndHeat']['CO2_gpWh_EPA'])[0]
-                    dcmat['mat_vmfg_fuel_gCO2eq'] = demat['mat_MFG_virgin_fuel']*steamHeat #CO2 from mfging fuels
-                    dcmat['mat_MFGScrap_HQ_fuel_gCO2eq'] = demat['mat_MFGScrap_HQ_fuel']*steamHeat #CO2 from mfging scrap recycling fuels
-                    dcmat['mat_landfill_fuel_gCO2eq'] = demat['mat_Landfill_fuel']*steamHeat
-                    dcmat['mat_Recycled_HQ_fuel_gCO2eq'] = demat['mat_Recycled_HQ_fuel']*steamHeat #co2 from eol recycling fuels
-                    
-                    #circular paths electricity in target country
-                    dcmat['mat_landfill_elec_gCO2eq'] = (demat['mat_Landfill']-demat['mat_Landfill_fuel'])*country_carbonpwh[country_deploy]
-                    dcmat['mat_EoL_ReMFG_clean_elec_gCO2eq'] = demat['mat_EoL_ReMFG_clean']*country_carbonpwh[country_deploy]
-                    dcmat['mat_Recycled_LQ_elec_gCO2eq'] = demat['mat_Recycled_LQ']*country_carbonpwh[country_deploy]
-                    dcmat['mat_Recycled_HQ_elec_gCO2eq'] = demat['mat_Recycled_HQ_elec']*country_carbonpwh[country_deploy]
-                    
-                    #CO2 process emissions from MFGing (v, lq, hq)
-                    #mass of material being processed in each stream * CO2 intensity of that process
-                    dcmat['mat_vMFG_p_gCO2eq'] = dm['mat_Virgin_Stock']*materialprocesscarbon.loc[mat,'v_MFG_gCO2eqpg']
-                    dcmat['mat_LQmfg_p_gCO2eq'] = dm['mat_MFG_Scrap_Sentto_Recycling']*materialprocesscarbon.loc[mat,'LQ_Recycle_gCO2eqpg']
-                    dcmat['mat_LQeol_p_gCO2eq'] = dm['mat_recycled_target']*materialprocesscarbon.loc[mat,'LQ_Recycle_gCO2eqpg']
-                    #dcmat['mat_LQ_p_gCO2eq'] = dcmat['mat_LQmfg_p_gCO2eq']+dcmat['mat_LQeol_p_gCO2eq']
-                    dcmat['mat_HQmfg_p_gCO2eq'] = dm['mat_MFG_Recycled_into_HQ']*materialprocesscarbon.loc[mat,'HQ_Recycle_gCO2eqpg']
-                    dcmat['mat_HQeol_p_gCO2eq'] = dm['mat_EOL_Recycled_2_HQ']*materialprocesscarbon.loc[mat,'HQ_Recycle_gCO2eqpg']
-                    #dcmat['mat_HQ_p_gCO2eq'] = dcmat['mat_HQmfg_p_gCO2eq']+dcmat['mat_HQeol_p_gCO2eq'] 
+                #carbon intensity of material manufacturing weighted by country
+                #list countries mfging material
+                countriesmfgingmat = list(countrymatmfg.columns[1:])
+
+                #weight carbon intensity of electricity by countries which mfging modules
+                countrycarbon_matmfg_gco2eqpwh = []
+                for matcountry in countriesmfgingmat:
+                    if matcountry in country_carbonpwh:
+                        currentcountry = country_carbonpwh[matcountry]*countrymatmfg[matcountry]*.01
+                        countrycarbon_matmfg_gco2eqpwh.append(currentcountry)
+                    else: print('Check '+mat+' MFGing by Country file OR add to country grid mix file. We dont have a grid mix for: '+matcountry)
+    
+                matmfg_gco2eqpwh_bycountry = pd.DataFrame(countrycarbon_matmfg_gco2eqpwh).T #
+                matmfg_gco2eqpwh_bycountry['Global_gCO2eqpwh'] = matmfg_gco2eqpwh_bycountry.sum(axis=1) #annual carbon intensity of elec country wtd 
+        
+                #carbon impacts mat mfging wtd by country
+                #electric
+                demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']-demat['mat_MFG_virgin_fuel']
+                dcmat = matmfg_gco2eqpwh_bycountry.mul(demat['mat_MFG_virgin_elec'],axis=0)
+                dcmat.rename(columns={'Global_gCO2eqpwh':'Global'}, inplace=True)
+                dcmat = dcmat.add_suffix('_vmfg_elec_gCO2eq')
                 
-                    #sum carbon stuff
-                    #dcmat['mat_vMFG_energy_gCO2eq'] = dcmat['Global_vmfg_elec_gCO2eq']+dcmat['mat_vmfg_fuel_gCO2eq']
-                    #dcmat['mat_vMFG_total_gCO2eq'] = dcmat['mat_vMFG_energy_gCO2eq']+dcmat['mat_vMFG_p_gCO2eq']
-                    #dcmat['mat_Recycle_e_p_gCO2eq'] = dcmat['mat_HQ_p_gCO2eq'] + dcmat['mat_LQ_p_gCO2eq'] + dcmat['mat_MFGScrap_HQ_fuel_gCO2eq']+dcmat['mat_Recycled_LQ_gCO2eq']+dcmat['mat_Recycled_HQ_elec_gCO2eq']
-                    #dcmat['mat_landfill_total_gCO2eq'] = dcmat['mat_landfill_elec_gCO2eq'] + dcmat['mat_landfill_fuel_gCO2eq']
+                #fuel CO2 impacts
+                steamHeat = list(gridemissionfactors[gridemissionfactors['Energy Source']=='SteamAndHeat']['CO2_gpWh_EPA'])[0]
+                dcmat['mat_vmfg_fuel_gCO2eq'] = demat['mat_MFG_virgin_fuel']*steamHeat #CO2 from mfging fuels
+                dcmat['mat_MFGScrap_HQ_fuel_gCO2eq'] = demat['mat_MFGScrap_HQ_fuel']*steamHeat #CO2 from mfging scrap recycling fuels
+                dcmat['mat_landfill_fuel_gCO2eq'] = demat['mat_Landfill_fuel']*steamHeat
+                dcmat['mat_Recycled_HQ_fuel_gCO2eq'] = demat['mat_Recycled_HQ_fuel']*steamHeat #co2 from eol recycling fuels
                 
-                    self.scenario[scen].material[mat].matdataOut_c = dcmat
+                #circular paths electricity in target country
+                dcmat['mat_landfill_elec_gCO2eq'] = (demat['mat_Landfill']-demat['mat_Landfill_fuel'])*country_carbonpwh[country_deploy]
+                dcmat['mat_EoL_ReMFG_clean_elec_gCO2eq'] = demat['mat_EoL_ReMFG_clean']*country_carbonpwh[country_deploy]
+                dcmat['mat_Recycled_LQ_elec_gCO2eq'] = demat['mat_Recycled_LQ']*country_carbonpwh[country_deploy]
+                dcmat['mat_Recycled_HQ_elec_gCO2eq'] = demat['mat_Recycled_HQ_elec']*country_carbonpwh[country_deploy]
+                
+                #CO2 process emissions from MFGing (v, lq, hq)
+                #mass of material being processed in each stream * CO2 intensity of that process
+                dcmat['mat_vMFG_p_gCO2eq'] = dm['mat_Virgin_Stock']*materialprocesscarbon.loc[mat,'v_MFG_gCO2eqpg']
+                dcmat['mat_LQmfg_p_gCO2eq'] = dm['mat_MFG_Scrap_Sentto_Recycling']*materialprocesscarbon.loc[mat,'LQ_Recycle_gCO2eqpg']
+                dcmat['mat_LQeol_p_gCO2eq'] = dm['mat_recycled_target']*materialprocesscarbon.loc[mat,'LQ_Recycle_gCO2eqpg']
+                #dcmat['mat_LQ_p_gCO2eq'] = dcmat['mat_LQmfg_p_gCO2eq']+dcmat['mat_LQeol_p_gCO2eq']
+                dcmat['mat_HQmfg_p_gCO2eq'] = dm['mat_MFG_Recycled_into_HQ']*materialprocesscarbon.loc[mat,'HQ_Recycle_gCO2eqpg']
+                dcmat['mat_HQeol_p_gCO2eq'] = dm['mat_EOL_Recycled_2_HQ']*materialprocesscarbon.loc[mat,'HQ_Recycle_gCO2eqpg']
+                #dcmat['mat_HQ_p_gCO2eq'] = dcmat['mat_HQmfg_p_gCO2eq']+dcmat['mat_HQeol_p_gCO2eq'] 
+            
+                #sum carbon stuff
+                #dcmat['mat_vMFG_energy_gCO2eq'] = dcmat['Global_vmfg_elec_gCO2eq']+dcmat['mat_vmfg_fuel_gCO2eq']
+                #dcmat['mat_vMFG_total_gCO2eq'] = dcmat['mat_vMFG_energy_gCO2eq']+dcmat['mat_vMFG_p_gCO2eq']
+                #dcmat['mat_Recycle_e_p_gCO2eq'] = dcmat['mat_HQ_p_gCO2eq'] + dcmat['mat_LQ_p_gCO2eq'] + dcmat['mat_MFGScrap_HQ_fuel_gCO2eq']+dcmat['mat_Recycled_LQ_gCO2eq']+dcmat['mat_Recycled_HQ_elec_gCO2eq']
+                #dcmat['mat_landfill_total_gCO2eq'] = dcmat['mat_landfill_elec_gCO2eq'] + dcmat['mat_landfill_fuel_gCO2eq']
+
+                return dcmat
+
+            for mat in materials:
+                if _inputFrame(self.scenario[scen].material[mat],
+                               'matdataIn_e') is None:
+                    print("==> No Carbon intensity found for Material : ", mat, ". Skipping Carbon calculations.")
+                else:
+                    print("==> Working on Carbon for Material : ", mat)
+                    self.scenario[scen].material[mat].matdataOut_c = materialCarbon(mat)
                 
     def scenMod_IRENIFY(self, scenarios=None, ELorRL='RL'):
 
@@ -2174,7 +2992,11 @@ class Simulation:
         keywd1='new_Installed_Capacity_[MW]'
 
         for scen in scenarios:
-            USyearly['newInstalledCapacity_'+self.name+'_'+scen+'_[MW]'] = self.scenario[scen].dataIn_m[keywd1]
+            # Installs solved by capacitytarget are kept on the outputs.
+            if keywd1 in self.scenario[scen].dataOut_m:
+                USyearly['newInstalledCapacity_'+self.name+'_'+scen+'_[MW]'] = self.scenario[scen].dataOut_m[keywd1]
+            else:
+                USyearly['newInstalledCapacity_'+self.name+'_'+scen+'_[MW]'] = self.scenario[scen].dataIn_m[keywd1]
 
         # Creating c umulative results
         UScum = USyearly.copy()
@@ -2522,6 +3344,57 @@ class Scenario(Simulation):
         if energymodulefile is not None:
             self.addEnergytoModule(energymodulefile)
 
+    @property
+    def dataDebug_m(self):
+        '''
+        Generation (rows) by year debug matrices of the last mass flow
+        calculated with ``debugflag=True``: path good (`EOL_PG_Year_`),
+        landfill 0 including path bads not collected (`EOL_L0_Year_`) and
+        path bads collected (`EOL_BS_Year`). The DataFrame is built from the
+        cohort matrices the first time it is read.
+        '''
+        if '_dataDebug_m' in self.__dict__:
+            return self._dataDebug_m
+        if 'dataDebug_m' in self.__dict__:
+            # Scenarios pickled before dataDebug_m was built on demand.
+            return self.__dict__['dataDebug_m']
+        if '_debugMatrices_m' not in self.__dict__:
+            raise AttributeError("'Scenario' object has no attribute "
+                                 "'dataDebug_m'. Run calculateMassFlow "
+                                 "with debugflag=True.")
+
+        debug = self._debugMatrices_m
+        index = debug['index']
+        # Updating Path Bad for collection efficiency. What doesn't get
+        # collected of Path Bad, goes to Landfill 0 and what goes on forward
+        # to Path Bads EoL Pathways is PBC.
+        PB = debug['PB'].toDense()
+        PBC = PB*(debug['collection_eff']*0.01).astype(PB.dtype)
+        L0 = debug['L0'].toDense() + (PB - PBC)
+        PG = pd.DataFrame(debug['PG'].toDense(), columns=index, index=index)
+        if 'lifetime' in debug:
+            # Years in which no generation reaches its project lifetime
+            # have integer path good columns, as when the matrices were
+            # built from lists of the yearly values.
+            lifetime = np.floor(debug['lifetime']).astype(int)
+            eol = np.arange(len(index)) + lifetime
+            eol = eol[(lifetime > 0) & (eol < len(index))]
+            noeol = np.setdiff1d(np.arange(len(index)), eol)
+            PG = PG.astype({index[ii]: 'int64' for ii in noeol})
+        self._dataDebug_m = pd.concat(
+            [matrix.add_prefix(prefix)
+             for matrix, prefix in [
+                 (PG, "EOL_PG_Year_"),
+                 (pd.DataFrame(L0, columns=index, index=index),
+                  "EOL_L0_Year_"),
+                 (pd.DataFrame(PBC, columns=index, index=index),
+                  "EOL_BS_Year")]], axis=1)
+        return self._dataDebug_m
+
+    @dataDebug_m.setter
+    def dataDebug_m(self, value):
+        self._dataDebug_m = value
+
     def addEnergytoModule(self, energymodulefile):
         data, meta = _readPVICEFile(energymodulefile)
 
@@ -2602,246 +3475,2875 @@ class Scenario(Simulation):
                                           energymatfile = energymatfile)
 
 
-    def modifyMaterials(self, materials, stage, value, start_year=None):
+    def modifyMaterials(self, materials, stage, value, start_year=None):
+
+        if start_year is None:
+            start_year = int(datetime.datetime.now().year)
+
+        if materials is None:
+            materials = list(self.material.keys())
+        else:
+            if isinstance(materials, str):
+                materials = [materials]
+
+        # Overlays store the change as an edit
+        for mat in materials:
+            if isinstance(self.material[mat], MaterialOverlay):
+                self.material[mat].addEdit(stage, value, start_year,
+                                           attribute='matdataIn_m')
+        materials = [mat for mat in materials
+                     if not isinstance(self.material[mat], MaterialOverlay)]
+        if not materials:
+            return
+
+        selectyears = self.dataIn_m['year']>=start_year
+
+        for mat in materials:
+            _ownColumns(self.material[mat], 'matdataIn_m', stage)
+
+        if isinstance(value, (pd.Series)):
+            for mat in materials:
+                timeshift = start_year - self.dataIn_m.iloc[0,0]
+                self.material[mat].matdataIn_m.loc[timeshift:, stage] = value.values
+            
+        else:
+            for mat in materials:
+                self.material[mat].matdataIn_m.loc[selectyears, stage] = value
+
+
+    def modifyMaterialEnergy(self, materials, stage, value, start_year=None):
+
+        if start_year is None:
+            start_year = int(datetime.datetime.now().year)
+
+        if materials is None:
+            materials = list(self.material.keys())
+        else:
+            if isinstance(materials, str):
+                materials = [materials]
+
+        # Overlays store the change as an edit
+        for mat in materials:
+            if isinstance(self.material[mat], MaterialOverlay):
+                self.material[mat].addEdit(stage, value, start_year,
+                                           attribute='matdataIn_e')
+        materials = [mat for mat in materials
+                     if not isinstance(self.material[mat], MaterialOverlay)]
+        if not materials:
+            return
+
+        selectyears = self.dataIn_e['year']>=start_year
+
+        for mat in materials:
+            _ownColumns(self.material[mat], 'matdataIn_e', stage)
+
+        if isinstance(value, (pd.Series)):
+            for mat in materials:
+                timeshift = start_year - self.dataIn_e.iloc[0,0]
+                self.material[mat].matdataIn_e.loc[timeshift:, stage] = value.values
+            
+        else:
+            for mat in materials:
+                self.material[mat].matdataIn_e.loc[selectyears, stage] = value
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key):
+        return setattr(self, key)
+
+
+class Material:
+
+    def __init__(self, materialname, massmatfile, energymatfile=None):
+        self.materialname = materialname
+
+        if massmatfile is None:
+            try:
+                massmatfile = _interactive_load('Select material baseline ' +
+                                                'file')
+            except:
+                raise Exception('Interactive load failed. Tkinter not ' +
+                                'supported on this system. Try installing ' +
+                                'X-Quartz and reloading')
+
+        data, meta = _readPVICEFile(massmatfile)
+
+        self.massmatfile = massmatfile
+        self.matmetdataIn_m = meta
+        self.matdataIn_m = data
+
+        # SAVING A COPY TO RAW
+        # Joining the metdata back in
+        foometa = pd.DataFrame(meta, index=[0])
+        foodata = pd.concat([foometa, data], axis=0)
+        # Removing the path to just get the filename
+        # TODO - find fancy python way, this will probably break on a mac
+        try:
+            foomassmatfile = massmatfile.split('\\')[-1]
+            foodata.to_csv(os.path.join('raw', materialname + '_' +
+                                        foomassmatfile))
+        except:
+            print("Can't save raw files on macs yet.")
+        if energymatfile is not None:
+            self.addEnergytoMaterial(energymatfile)
+        else:
+            self.energymatfile = None
+            self.matmetdataIn_e = None
+            self.matdataIn_e = None
+
+    def addEnergytoMaterial(self, energymatfile):
+
+        data, meta = _readPVICEFile(energymatfile)
+
+        self.energymatfile = energymatfile
+        self.matmetdataIn_e = meta
+        self.matdataIn_e = data
+
+
+def _overlayInput(attribute):
+    r'''
+    Property for the input dataframe ``attribute`` of an overlay, resolved
+    from its snapshot of the base and its edits, into a dataframe the
+    overlay owns, the first time it is read.
+    '''
+    def getter(self):
+        if attribute not in self._resolved:
+            # Dicts are replaced instead of updated so shallow copies of the
+            # overlay do not share them.
+            self._resolved = dict(self._resolved)
+            self._resolved[attribute] = _resolveOverlay(self, attribute)
+        return self._resolved[attribute]
+
+    def setter(self, value):
+        self._resolved = dict(self._resolved)
+        self._resolved[attribute] = value
+
+    return property(getter, setter)
+
+
+class _Overlay:
+    r'''
+    Edits and fingerprint shared by ``ScenarioOverlay`` and
+    ``MaterialOverlay``.
+    '''
+
+    def addEdit(self, field, value, start_year=None, end_year=None,
+                attribute=None):
+        '''
+        Adds an edit setting input column ``field`` to ``value`` from
+        ``start_year`` to ``end_year``, both included.
+
+        Parameters
+        ----------
+        field : str
+            Input column to edit.
+        value : float, array or pd.Series
+            Value for the selected years, or one value per selected year.
+        start_year, end_year : int
+            First and last years edited. None (default) leaves that end open.
+        attribute : str
+            Input dataframe of ``field``, i.e. 'dataIn_e'. Defaults to the
+            first input dataframe of the base with that column.
+        '''
+        if attribute is None:
+            attribute = next((attribute for attribute in self._inputs
+                              if self._snapshot.get(attribute) is not None
+                              and field in self._snapshot[attribute]),
+                             None)
+            if attribute is None:
+                raise ValueError("No input column '{}' to edit".format(field))
+        if isinstance(value, pd.Series):
+            value = value.values
+
+        edit = (attribute, field, start_year, end_year, value)
+        self.edits = self.edits + [edit]
+        if self._resolved.get(attribute) is not None:
+            _applyEdit(self._resolved[attribute], *edit)
+
+    def _fingerprintItems(self):
+        yield self._baseName()
+        for attribute, field, start_year, end_year, value in self.edits:
+            yield (attribute, field, start_year, end_year)
+            value = np.asarray(value)
+            yield (value.dtype.str, value.shape, value.tobytes())
+
+    def fingerprint(self):
+        '''
+        Hexadecimal hash of the base name and the edits, a cheap key for
+        caching results. Changes made directly on the resolved dataframes
+        are not part of it.
+        '''
+        sha = hashlib.sha1()
+        for item in self._fingerprintItems():
+            sha.update(repr(item).encode())
+        return sha.hexdigest()
+
+
+class ScenarioOverlay(_Overlay, Scenario):
+    '''
+    Scenario stored as a base scenario plus a sparse list of edits of its
+    module and material inputs, as added by ``Simulation.overlayScenario``.
+
+    The overlay sees the base inputs as they were when it was created:
+    later changes of the base do not reach it. Overlays created while the
+    base is unchanged share one private copy of its inputs. The input
+    dataframes are resolved from that copy and the edits the first time
+    they are read, into dataframes the overlay owns, so writing into them
+    does not change the base or other overlays. Edits added after that are
+    applied on the resolved dataframes.
+
+    Parameters
+    ----------
+    name : str
+        Name of the scenario.
+    base : Scenario
+        Scenario the edits apply to.
+
+    Attributes
+    ----------
+    edits : list
+        (attribute, field, start_year, end_year, value) edits, in order.
+    '''
+
+    _inputs = _SCENARIO_INPUTS
+    dataIn_m = _overlayInput('dataIn_m')
+    dataIn_e = _overlayInput('dataIn_e')
+
+    def __init__(self, name, base):
+        self.name = name
+        self.base = base
+        self.edits = []
+        self._resolved = {}
+        self._snapshot = {attribute: _overlaySnapshot(base, attribute)
+                          for attribute in self._inputs}
+        for attribute in ['baselinefile', 'metdataIn_m', 'energyfile',
+                          'metdataIn_e']:
+            if attribute in base.__dict__:
+                setattr(self, attribute, base.__dict__[attribute])
+        self.material = {mat: MaterialOverlay(material)
+                         for mat, material in base.material.items()}
+
+    def _baseName(self):
+        return self.base.name
+
+    def _fingerprintItems(self):
+        yield from _Overlay._fingerprintItems(self)
+        for mat in sorted(self.material):
+            if isinstance(self.material[mat], MaterialOverlay):
+                yield mat
+                yield from self.material[mat]._fingerprintItems()
+
+
+class MaterialOverlay(_Overlay, Material):
+    '''
+    Material stored as a base material plus a sparse list of edits of its
+    inputs. See ``ScenarioOverlay``.
+
+    Parameters
+    ----------
+    base : Material
+        Material the edits apply to.
+    '''
+
+    _inputs = _MATERIAL_INPUTS
+    matdataIn_m = _overlayInput('matdataIn_m')
+    matdataIn_e = _overlayInput('matdataIn_e')
+
+    def __init__(self, base):
+        self.base = base
+        self.edits = []
+        self._resolved = {}
+        self._snapshot = {attribute: _overlaySnapshot(base, attribute)
+                          for attribute in self._inputs}
+        for attribute in ['materialname', 'massmatfile', 'matmetdataIn_m',
+                          'energymatfile', 'matmetdataIn_e']:
+            if attribute in base.__dict__:
+                setattr(self, attribute, base.__dict__[attribute])
+
+    def _baseName(self):
+        return self.base.materialname
+
+
+def weibull_params(keypoints):
+    r'''Returns shape parameter `alpha` and scale parameter `beta`
+    for a Weibull distribution whose CDF passes through the
+    two time: value pairs in `keypoints`
+
+    Parameters
+    ----------
+    keypoints : list
+        Two lists of t50 and 590 values, where t50 is the year since deployment
+        that the cohort has lost 50% of originally installed modules, and t90
+        is the year since deployment that the cohort has lost 90% of the originally
+        installed modules. These values are used to calcualte the shape and scale
+        parameters for the weibull distribution.
+
+    Returns
+    -------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
+        like in Irena 2016, beta = 30.
+
+    '''
+
+    t1, t2 = tuple(keypoints.keys())
+    cdf1, cdf2 = tuple(keypoints.values())
+    alpha = np.ndarray.item(np.real_if_close(
+        (np.log(np.log(1 - cdf1)+0j) - np.log(np.log(1 - cdf2)+0j))/(np.log(t1) - np.log(t2))
+    ))
+    beta = np.abs(np.exp(
+        (
+            np.log(t2)*((0+1j)*np.pi + np.log(np.log(1 - cdf1)+0j))
+            + np.log(t1)*(((0-1j))*np.pi - np.log(np.log(1 - cdf2)+0j))
+        )/(
+            np.log(np.log(1 - cdf1)+0j) - np.log(np.log(1 - cdf2)+0j)
+        )
+    ))
+    return {'alpha': alpha, 'beta': beta}
+
+def weibull_cdf(alpha, beta):
+    '''Return the CDF for a Weibull distribution having:
+    shape parameter `alpha`
+    scale parameter `beta`
+
+    Parameters
+    ----------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
+        like in Irena 2016, beta = 30.
+
+    '''
+
+    def cdf(x):
+        return 1 - np.exp(-(np.array(x)/beta)**alpha)
+    return cdf
+
+def weibull_pdf(alpha, beta):
+    r'''Return the PDF for a Weibull distribution having:
+        shape parameter `alpha`
+        scale parameter `beta`
+
+    Parameters
+    ----------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
+        like in Irena 2016, beta = 30.
+
+    '''
+
+    def pdf(x):
+        return (alpha/np.array(x)) * ((np.array(x)/beta)**alpha) * (np.exp(-(np.array(x)/beta)**alpha))
+
+    return pdf
+
+def weibull_pdf_vis(alpha, beta, xlim=56):
+    r''' Returns the CDF for a weibull distribution of 1 generation
+    so it can be plotted.
+
+    Parameters
+    ----------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
+        like in Irena 2016, beta = 30.
+    xlim : int
+        Number of years to calculate the distribution for. i.e. x-axis limit.
+
+    Returns
+    -------
+    idf : list
+        List of weibull cumulative distribution values for year 0 until xlim.
+
+    '''
+
+    dfindex = pd.RangeIndex(0,xlim,1)
+    x = np.clip(dfindex - 0, 0, np.inf)
+
+    if alpha and beta:
+        i = weibull_pdf(alpha, beta)
+
+    idf = list(map(i, x))
+
+    return idf
+
+
+def weibull_cdf_vis(alpha, beta, xlim=56):
+    r''' Returns the CDF for a weibull distribution of 1 generation
+    so it can be plotted.
+
+    Parameters
+    ----------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
+        like in Irena 2016, beta = 30.
+    xlim : int
+        Number of years to calculate the distribution for. i.e. x-axis limit.
+
+    Returns
+    -------
+    idf : list
+        List of weibull cumulative distribution values for year 0 until xlim.
+
+    '''
+
+    dfindex = pd.RangeIndex(0,xlim,1)
+    x = np.clip(dfindex - 0, 0, np.inf)
+
+    if alpha and beta:
+        i = weibull_cdf(alpha, beta)
+
+    idf = list(map(i, x))
+
+    return idf
+
+
+def _cloneInputs(obj, inputs, share=False):
+    r'''
+    Copy of a Scenario or Material ``obj`` without its results. Unless
+    ``share``, all its other attributes are deep copies. If ``share``, the
+    ``inputs`` dataframes share their columns with ``obj``; the shared
+    columns are recorded on both objects so ``_ownColumns`` copies them
+    before they are modified in place.
+    '''
+    clone = copy.copy(obj)
+    for attribute in list(clone.__dict__):
+        if (attribute in _SCENARIO_OUTPUTS or attribute in _MATERIAL_OUTPUTS
+                or attribute in ['_dataDebug_m', 'dataDebug_m']):
+            del clone.__dict__[attribute]
+        elif attribute == '_overlaySnapshots':
+            del clone.__dict__[attribute]
+        elif not share and attribute not in ['material', '_sharedColumns']:
+            clone.__dict__[attribute] = copy.deepcopy(obj.__dict__[attribute])
+    if not share:
+        clone._sharedColumns = set()
+        return clone
+
+    clone._sharedColumns = set(getattr(obj, '_sharedColumns', ()))
+    obj._sharedColumns = set(getattr(obj, '_sharedColumns', ()))
+    for attribute in inputs:
+        df = getattr(obj, attribute, None)
+        if df is None:
+            continue
+        setattr(clone, attribute, df.copy(deep=False))
+        shared = {(attribute, col) for col in df.columns}
+        clone._sharedColumns |= shared
+        obj._sharedColumns |= shared
+    return clone
+
+
+def _ownColumns(obj, attribute, columns):
+    r'''
+    Gives ``obj`` its own copy of the ``columns`` of dataframe ``attribute``
+    it still shares with a clone, before they are modified in place.
+    '''
+    shared = getattr(obj, '_sharedColumns', None)
+    if not shared:
+        return
+    if isinstance(columns, str):
+        columns = [columns]
+
+    df = getattr(obj, attribute)
+    for col in columns:
+        if (attribute, col) in shared:
+            df[col] = df[col].copy()
+            shared.discard((attribute, col))
+
+
+def _overlaySnapshot(base, attribute):
+    r'''
+    Private copy of the input dataframe ``attribute`` of ``base`` as it is
+    now, for the overlays created on it. The copy is kept on the base and
+    shared by the overlays created while that dataframe is unchanged.
+    '''
+    df = getattr(base, attribute, None)
+    if df is None:
+        return None
+    snapshots = base.__dict__.setdefault('_overlaySnapshots', {})
+    frame, snapshot = snapshots.get(attribute, (None, None))
+    if frame is not df or not df.equals(snapshot):
+        snapshot = df.copy()
+        snapshots[attribute] = (df, snapshot)
+    return snapshot
+
+
+def _resolveOverlay(overlay, attribute, owned=True):
+    r'''
+    Input dataframe ``attribute`` of ``overlay``: its snapshot of the base
+    dataframe with the edits applied. Unless ``owned``, only the edited
+    columns are copied, and the dataframe must not be written into.
+    '''
+    df = overlay._snapshot.get(attribute)
+    if df is None:
+        return None
+
+    df = df.copy(deep=owned)
+    for edit in overlay.edits:
+        if edit[0] == attribute:
+            _applyEdit(df, *edit)
+    return df
+
+
+def _inputFrame(obj, attribute):
+    r'''
+    Input dataframe ``attribute`` of a Scenario or Material ``obj``, to be
+    read only. Overlays not resolved yet are resolved without keeping the
+    result, so calculating them does not copy their unedited columns.
+    '''
+    if isinstance(obj, _Overlay) and attribute not in obj._resolved:
+        return _resolveOverlay(obj, attribute, owned=False)
+    return getattr(obj, attribute, None)
+
+
+def _applyEdit(df, attribute, field, start_year, end_year, value):
+    r'''
+    Applies one overlay edit of input dataframe ``attribute`` on ``df``. The
+    edited column is replaced by a copy first, so memory it shares is not
+    written into.
+    '''
+    # Upcasts i.e. integer columns for float edits
+    dtype = np.result_type(df[field].dtype, np.asarray(value).dtype)
+    df[field] = df[field].astype(dtype)
+
+    select = np.ones(len(df), dtype=bool)
+    if start_year is not None:
+        select &= (df['year'] >= start_year).values
+    if end_year is not None:
+        select &= (df['year'] <= end_year).values
+    df.loc[select, field] = value
+
+
+def _leverBounds(levers):
+    r'''
+    Labels (source, field, start_year, end_year), lower and upper bounds of
+    (field, lower, upper, start_year, end_year) levers, where ``field`` is a
+    module input column or a (material, column) tuple and the years are
+    optional.
+    '''
+    labels, lower, upper = [], [], []
+    for lever in levers:
+        field, low, high, start_year, end_year = (
+            tuple(lever) + (None,)*(5 - len(lever)))
+        source, field = (('module', field) if isinstance(field, str)
+                         else tuple(field))
+        labels.append((source, field, start_year, end_year))
+        lower.append(low)
+        upper.append(high)
+    return labels, np.array(lower, dtype=float), np.array(upper, dtype=float)
+
+
+def _dropOutputs(scenario):
+    r'''
+    Deletes the outputs of ``scenario`` and its materials.
+    '''
+    for attribute in _SCENARIO_OUTPUTS + ['_dataDebug_m', 'dataDebug_m']:
+        scenario.__dict__.pop(attribute, None)
+    for material in scenario.material.values():
+        for attribute in _MATERIAL_OUTPUTS:
+            material.__dict__.pop(attribute, None)
+
+
+def aggregateScenario(scenario, materials=None):
+    r'''
+    Yearly totals of one calculated scenario, with the columns of
+    ``Simulation.aggregateResults`` without the simulation and scenario
+    names. Can be passed as a reducer to ``calculateFlows``.
+
+    Parameters
+    ----------
+    scenario : Scenario
+        Scenario with mass flows calculated.
+    materials : list
+        Materials to add. Defaults to all the scenario materials.
+
+    Returns
+    -------
+    yearly : pd.DataFrame
+        Virgin stock and waste by material and module [Tonnes], and new
+        installed, active and decommissioned capacity [MW], by year.
+    '''
+    if materials is None:
+        materials = list(scenario.material.keys())
+
+    keywds = ['mat_Virgin_Stock', 'mat_Total_Landfilled', 'mat_Total_EOL_Landfilled', 'mat_Total_MFG_Landfilled']
+    nice_keywds = ['VirginStock', 'WasteAll', 'WasteEOL', 'WasteMFG']
+
+    yearly = {}
+    for keywd, nicekey in zip(keywds, nice_keywds):
+        module = 0
+        for mat in materials:
+            # grams to Metric tonnes
+            matyearly = scenario.material[mat].matdataOut_m[keywd].values/1000000
+            yearly[nicekey+'_'+mat+'_[Tonnes]'] = matyearly
+            module = module + matyearly
+        yearly[nicekey+'_Module_[Tonnes]'] = module
+
+    if 'new_Installed_Capacity_[MW]' in scenario.dataOut_m:
+        # Installs solved by capacitytarget
+        installed = scenario.dataOut_m['new_Installed_Capacity_[MW]'].values
+    else:
+        installed = scenario.dataIn_m['new_Installed_Capacity_[MW]'].values
+    yearly['newInstalledCapacity_[MW]'] = installed
+    yearly['ActiveCapacity_[MW]'] = (
+        scenario.dataOut_m['Effective_Capacity_[W]'].values/1e6)
+    yearly['DecommisionedCapacity_[MW]'] = (installed.cumsum() -
+                                           yearly['ActiveCapacity_[MW]'])
+
+    return pd.DataFrame(yearly, index=scenario.dataIn_m['year'].values)
+
+
+def reducedPercentiles(reduced, percentiles=(5, 50, 95)):
+    r'''
+    Percentiles across scenarios of the values of one reducer.
+
+    Parameters
+    ----------
+    reduced : dict
+        {scenario: value} as kept in ``Simulation.reduced[name]``, with
+        values that are numbers, Series or DataFrames with matching index.
+    percentiles : list
+        Percentiles to calculate, from 0 to 100.
+
+    Returns
+    -------
+    Series or pd.DataFrame
+        Percentiles of each value, with the percentile as the last level of
+        the index.
+    '''
+    values = list(reduced.values())
+    quantiles = [percentile/100 for percentile in percentiles]
+    if np.isscalar(values[0]):
+        return pd.Series(values).quantile(quantiles)
+    stacked = pd.concat(values, keys=range(len(values)))
+    return stacked.groupby(level=1, sort=False).quantile(quantiles)
+
+
+def _checkpointFingerprint(scenario, materials, kwargs):
+    r'''
+    Hexadecimal hash of the module and ``materials`` inputs of ``scenario``
+    (resolved, for overlays) and the ``calculateFlows`` arguments that change
+    its results, so checkpoints of other inputs are not loaded back.
+    '''
+    sha = hashlib.sha1()
+
+    def _update(value):
+        if isinstance(value, pd.DataFrame):
+            sha.update(repr((list(value.columns),
+                             [str(dt) for dt in value.dtypes])).encode())
+            sha.update(pd.util.hash_pandas_object(
+                value, index=True).values.tobytes())
+        elif isinstance(value, (pd.Series, np.ndarray)):
+            _update(pd.DataFrame(np.asarray(value).reshape(len(value), -1)))
+        elif isinstance(value, dict):
+            for key in sorted(value, key=repr):
+                sha.update(repr(key).encode())
+                _update(value[key])
+        else:
+            sha.update(repr(value).encode())
+
+    for attribute in _SCENARIO_INPUTS:
+        _update(_inputFrame(scenario, attribute))
+    for mat in materials:
+        sha.update(repr(mat).encode())
+        for attribute in _MATERIAL_INPUTS:
+            _update(_inputFrame(scenario.material[mat], attribute))
+    # Arguments that only change how the flows are run
+    _update({key: value for key, value in kwargs.items() if key not in
+             ['n_jobs', 'sharedmemory', 'n_threads', 'debugflag']})
+    return sha.hexdigest()
+
+
+def _saveCheckpoint(scenario, materials, filename):
+    r'''
+    Saves the output dataframes of ``scenario`` and its ``materials`` to the
+    ``.npz`` file ``filename``, written under a temporary name first.
+    '''
+    arrays = {}
+    for prefix, obj, attributes in (
+            [('', scenario, _SCENARIO_OUTPUTS)] +
+            [(mat, scenario.material[mat], _MATERIAL_OUTPUTS)
+             for mat in materials]):
+        for attribute in attributes:
+            df = obj.__dict__.get(attribute)
+            if not isinstance(df, pd.DataFrame):
+                continue
+            key = '{}/{}/'.format(prefix, attribute)
+            numeric = np.array([isinstance(dt, np.dtype) and dt.kind in 'biuf'
+                                for dt in df.dtypes])
+            arrays[key + 'columns'] = np.array(df.columns, dtype=str)
+            arrays[key + 'dtypes'] = np.array([str(dt) for dt in df.dtypes])
+            arrays[key + 'index'] = df.index.to_numpy()
+            arrays[key + 'numeric'] = numeric
+            arrays[key + 'values'] = df.loc[:, numeric].to_numpy()
+            # Other columns, like WeibullParams, are pickled
+            arrays[key + 'objects'] = df.loc[:, ~numeric].to_numpy()
+
+    partial = filename[:-len('.npz')] + '.tmp.npz'
+    np.savez_compressed(partial, **arrays)
+    os.replace(partial, filename)
+
+
+def _loadCheckpoint(scenario, filename):
+    r'''
+    Sets the output dataframes saved by ``_saveCheckpoint`` back on
+    ``scenario`` and its materials.
+    '''
+    with np.load(filename, allow_pickle=True) as data:
+        for key in data.files:
+            prefix, attribute, part = key.split('/')
+            if part != 'values':
+                continue
+            key = '{}/{}/'.format(prefix, attribute)
+            columns = data[key + 'columns']
+            dtypes = data[key + 'dtypes']
+            numeric = data[key + 'numeric']
+            index = data[key + 'index']
+            df = pd.concat(
+                [pd.DataFrame(data[key + 'values'], columns=columns[numeric],
+                              index=index),
+                 pd.DataFrame(data[key + 'objects'], columns=columns[~numeric],
+                              index=index)], axis=1)[columns]
+            df = df.astype(dict(zip(columns, dtypes)))
+            obj = scenario.material[prefix] if prefix else scenario
+            setattr(obj, attribute, df)
+
+
+def runShards(folder, maxshards=None, timeout=None):
+    r'''
+    Calculates the shards written by ``Simulation.writeShards`` in
+    ``folder`` that no other worker has claimed yet. Any number of processes
+    or hosts sharing the folder can run this at the same time.
+
+    Each shard ``shard_#.pkl`` is claimed by atomically creating
+    ``shard_#.lock``, with the host, process id and time of the claim, and
+    its results are written to ``result_#.pkl``. The lock of a worker that
+    died is reclaimed if that worker ran on the same host, or once it is
+    older than ``timeout``. Deleting a lock also releases its shard.
+
+    Parameters
+    ----------
+    folder : str
+        Folder with the shards.
+    maxshards : int
+        Maximum number of shards to calculate. Default None runs until no
+        unclaimed shards are left.
+    timeout : float
+        Seconds after which the locks of other hosts are taken as stale and
+        reclaimed. Default None only reclaims the locks of processes of this
+        host that are no longer running.
+
+    Returns
+    -------
+    done : list
+        Paths of the shards calculated by this call.
+    '''
+    import pickle
+
+    done = []
+    bases = None
+    for shard in sorted(Path(folder).glob('shard_*.pkl')):
+        if maxshards is not None and len(done) >= maxshards:
+            break
+        result = _shardResultPath(shard)
+        if result.exists():
+            continue
+        if not _claimShard(shard.with_suffix('.lock'), timeout):
+            continue
+
+        if bases is None:
+            bases = []
+            if (Path(folder) / 'bases.pkl').exists():
+                with open(Path(folder) / 'bases.pkl', 'rb') as inp:
+                    bases = pickle.load(inp)
+        with open(shard, 'rb') as inp:
+            unpickler = pickle.Unpickler(inp)
+            unpickler.persistent_load = bases.__getitem__
+            sim, method, materials, kwargs = unpickler.load()
+        outputs = _calculateScenarios(sim, method, materials, kwargs)
+
+        # Written under a temporary name so reducers never read half a file
+        partial = result.with_name(result.name + '.{}.tmp'.format(os.getpid()))
+        with open(partial, 'wb') as outp:
+            pickle.dump(outputs, outp, pickle.HIGHEST_PROTOCOL)
+        os.replace(partial, result)
+        done.append(str(shard))
+    return done
+
+
+def _claimShard(lock, timeout=None):
+    r'''
+    Claims a shard by atomically creating its ``lock`` file, with the host,
+    process id and time of the claim. Returns False if the shard is claimed
+    by a worker that is still running, or whose lock is not older than
+    ``timeout`` seconds if it ran on another host.
+    '''
+    import socket
+    import time
+
+    host = socket.gethostname()
+    for attempt in range(2):
+        try:
+            claim = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if attempt or not _releaseStaleLock(lock, host, timeout):
+                return False
+            continue
+        with os.fdopen(claim, 'w') as outp:
+            outp.write('{} {} {}\n'.format(host, os.getpid(), time.time()))
+        return True
+    return False
+
+
+def _releaseStaleLock(lock, host, timeout=None):
+    r'''
+    Removes ``lock`` if the worker that wrote it is no longer running on
+    this ``host``, or if it is older than ``timeout`` seconds. Returns
+    whether it was removed.
+    '''
+    import time
+
+    try:
+        with open(lock) as inp:
+            content = inp.read()
+        age = time.time() - os.path.getmtime(lock)
+    except FileNotFoundError:
+        # Released meanwhile
+        return True
+    fields = content.split()
+    if len(fields) >= 3:
+        age = time.time() - float(fields[2])
+
+    stale = timeout is not None and age > timeout
+    if not stale and len(fields) >= 2 and fields[0] == host \
+            and os.name == 'posix':
+        try:
+            os.kill(int(fields[1]), 0)
+        except ProcessLookupError:
+            stale = True
+        except (PermissionError, ValueError):
+            pass
+    if not stale:
+        return False
+
+    # Moved aside first, so of the workers finding the same stale lock only
+    # one removes it. If the lock moved is not the one read, another worker
+    # has just claimed the shard again, and its lock is put back.
+    aside = '{}.{}.stale'.format(lock, os.getpid())
+    try:
+        os.rename(lock, aside)
+    except FileNotFoundError:
+        return True
+    with open(aside) as inp:
+        moved = inp.read()
+    if moved != content:
+        try:
+            os.link(aside, lock)
+        except FileExistsError:
+            pass
+        os.remove(aside)
+        return False
+    os.remove(aside)
+    return True
+
+
+def _withoutOutputs(obj, stripped):
+    r'''
+    Shallow copy of a Scenario or Material ``obj`` and its materials without
+    their results. ``stripped`` keeps the copies made by id of the originals,
+    so each object is copied once.
+    '''
+    if id(obj) not in stripped:
+        clone = _cloneInputs(obj, [], share=True)
+        if isinstance(getattr(obj, 'material', None), dict):
+            clone.material = {mat: _withoutOutputs(material, stripped)
+                              for mat, material in obj.material.items()}
+        stripped[id(obj)] = clone
+    return stripped[id(obj)]
+
+
+def _shardResultPath(shard):
+    shard = Path(shard)
+    return shard.with_name(shard.name.replace('shard_', 'result_', 1))
+
+
+def _threadMap(function, items, n_threads=None):
+    r'''
+    ``[function(item) for item in items]``, spread over a thread pool of
+    ``n_threads`` when given (-1 uses all the CPUs). Results keep the order of
+    ``items``.
+    '''
+    if n_threads is not None and n_threads < 0:
+        n_threads = os.cpu_count()
+    if n_threads in (None, 1) or len(items) < 2:
+        return [function(item) for item in items]
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(n_threads, len(items))) as pool:
+        return list(pool.map(function, items))
+
+
+def _materialChunks(nmaterials, n_threads=None):
+    r'''
+    Contiguous slices splitting ``nmaterials`` materials in one chunk per
+    thread, or a single chunk without ``n_threads``.
+    '''
+    if n_threads is not None and n_threads < 0:
+        n_threads = os.cpu_count()
+    if n_threads in (None, 1):
+        return [slice(None)]
+
+    nchunks = max(1, min(n_threads, nmaterials))
+    bounds = np.round(np.linspace(0, nmaterials, nchunks + 1)).astype(int)
+    return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _calculateScenarios(sim, method, materials, kwargs, shared=None):
+    r'''
+    Process pool worker of ``Simulation._calculateParallel``. Runs ``method``
+    on all the scenarios of ``sim`` and returns their outputs by scenario,
+    as (scenario outputs, {material: material outputs}).
+
+    If ``shared`` is given as (block name, layout), the inputs are read from
+    that shared memory block, and the output dataframes are packed into a new
+    block, returned as (block name, layout, outputs without those dataframes).
+    '''
+    if shared is None:
+        getattr(sim, method)(scenarios=list(sim.scenario),
+                             materials=materials, **kwargs)
+        return _scenarioOutputs(sim, materials)
+
+    name, layout = shared
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        _attachInputs(sim, _unpackFrames(shm, layout))
+        getattr(sim, method)(scenarios=list(sim.scenario),
+                             materials=materials, **kwargs)
+    finally:
+        # Drop the views on the block before closing it.
+        _detachInputs(sim, shallowcopy=False)
+        shm.close()
+
+    outputs = _scenarioOutputs(sim, materials)
+    frames = {}
+    for scen, (scenoutputs, matoutputs) in outputs.items():
+        for attribute in list(scenoutputs):
+            if isinstance(scenoutputs[attribute], pd.DataFrame):
+                frames[(scen, None, attribute)] = scenoutputs.pop(attribute)
+        for mat, attributes in matoutputs.items():
+            for attribute in list(attributes):
+                if isinstance(attributes[attribute], pd.DataFrame):
+                    frames[(scen, mat, attribute)] = attributes.pop(attribute)
+    shm, layout = _packFrames(frames)
+    shm.close()
+    return shm.name, layout, outputs
+
+
+def _scenarioOutputs(sim, materials):
+    r'''
+    Output attributes of every scenario of ``sim``, as
+    {scenario: (scenario outputs, {material: material outputs})}.
+    '''
+    outputs = {}
+    for scen, scenario in sim.scenario.items():
+        outputs[scen] = (
+            {attribute: scenario.__dict__[attribute]
+             for attribute in _SCENARIO_OUTPUTS
+             if attribute in scenario.__dict__},
+            {mat: {attribute: scenario.material[mat].__dict__[attribute]
+                   for attribute in _MATERIAL_OUTPUTS
+                   if attribute in scenario.material[mat].__dict__}
+             for mat in materials})
+    return outputs
+
+
+def _collectOutputs(name, layout, outputs):
+    r'''
+    Copies the output dataframes packed by ``_calculateScenarios`` out of
+    their shared memory block back into ``outputs``, and frees the block.
+    '''
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        frames = _unpackFrames(shm, layout)
+        for (scen, mat, attribute), df in frames.items():
+            if mat is None:
+                outputs[scen][0][attribute] = df.copy()
+            else:
+                outputs[scen][1][mat][attribute] = df.copy()
+        del frames, df
+    finally:
+        shm.close()
+        shm.unlink()
+    return outputs
+
+
+def _detachInputs(sim, shallowcopy=True):
+    r'''
+    Takes the input dataframes out of the scenarios and materials of ``sim``.
+
+    With ``shallowcopy`` the scenarios and materials are shallow copies, so the
+    original simulation keeps its inputs. Returns the simulation and the
+    removed dataframes, keyed by (scenario, material or None, attribute).
+    '''
+    frames = {}
+    for scen in list(sim.scenario):
+        scenario = sim.scenario[scen]
+        if shallowcopy:
+            scenario = copy.copy(scenario)
+            scenario.material = {mat: copy.copy(material)
+                                 for mat, material in scenario.material.items()}
+            sim.scenario[scen] = scenario
+        for attribute in _SCENARIO_INPUTS:
+            df = _inputFrame(scenario, attribute)
+            if df is not None:
+                frames[(scen, None, attribute)] = df
+                setattr(scenario, attribute, None)
+        for mat, material in scenario.material.items():
+            for attribute in _MATERIAL_INPUTS:
+                df = _inputFrame(material, attribute)
+                if df is not None:
+                    frames[(scen, mat, attribute)] = df
+                    setattr(material, attribute, None)
+    return sim, frames
+
+
+def _attachInputs(sim, frames):
+    r'''
+    Sets the dataframes removed by ``_detachInputs`` back on ``sim``.
+    '''
+    for (scen, mat, attribute), df in frames.items():
+        if mat is None:
+            setattr(sim.scenario[scen], attribute, df)
+        else:
+            setattr(sim.scenario[scen].material[mat], attribute, df)
+
+
+def _packFrames(frames):
+    r'''
+    Packs the numeric columns of a dict of DataFrames back to back into one
+    ``multiprocessing.shared_memory`` block, so other processes can read
+    them without pickling or copying.
+
+    Parameters
+    ----------
+    frames : dict
+        DataFrames by any picklable key.
+
+    Returns
+    -------
+    shm : SharedMemory
+        Block with the numeric columns. The caller closes and unlinks it.
+    layout : dict
+        Small picklable index of the block. For every key, the DataFrame
+        index, its columns, and its columns grouped by dtype as
+        (dtype, positions, offset) for packed groups, stored column by column,
+        or (None, positions, values) for non numeric columns.
+    '''
+    layout = {}
+    offset = 0
+    for key, df in frames.items():
+        groups = {}
+        for ii, dt in enumerate(df.dtypes):
+            if isinstance(dt, np.dtype) and dt.kind in 'biuf':
+                groups.setdefault(dt.str, []).append(ii)
+            else:
+                groups.setdefault(None, []).append(ii)
+        packed = []
+        for dt, positions in groups.items():
+            if dt is None:
+                packed.append((None, positions,
+                               df.iloc[:, positions].to_numpy().T))
+            else:
+                offset += -offset % 8
+                packed.append((dt, positions, offset))
+                offset += np.dtype(dt).itemsize*len(positions)*len(df)
+        layout[key] = (df.index, df.columns, packed)
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, df in frames.items():
+        packed = layout[key][2]
+        if len(packed) == 1 and packed[0][0] is not None:
+            dt, positions, offset = packed[0]
+            _packedGroup(shm, dt, positions, offset, len(df))[:] = (
+                df.to_numpy().T)
+            continue
+        columns = [values.to_numpy() for col, values in df.items()]
+        for dt, positions, offset in packed:
+            if dt is not None:
+                group = _packedGroup(shm, dt, positions, offset, len(df))
+                for ii, jj in enumerate(positions):
+                    group[ii] = columns[jj]
+    return shm, layout
+
+
+def _packedGroup(shm, dt, positions, offset, nrows):
+    return np.ndarray((len(positions), nrows), dtype=dt, buffer=shm.buf,
+                      offset=offset)
+
+
+def _unpackFrames(shm, layout):
+    r'''
+    DataFrames packed by ``_packFrames``. Numeric columns are views on the
+    shared memory block, so the frames have to be dropped before closing it.
+    '''
+    frames = {}
+    for key, (index, columns, packed) in layout.items():
+        if len(packed) == 1 and packed[0][0] is not None:
+            # Single dtype frames are one block, built straight on the view
+            dt, positions, offset = packed[0]
+            values = _packedGroup(shm, dt, positions, offset, len(index))
+            frames[key] = pd.DataFrame(values.T, index=index, columns=columns,
+                                       copy=False)
+            continue
+        data = {}
+        for dt, positions, values in packed:
+            if dt is not None:
+                values = _packedGroup(shm, dt, positions, values, len(index))
+            for ii, column in zip(positions, values):
+                data[ii] = column
+        df = pd.DataFrame({ii: data[ii] for ii in range(len(columns))},
+                          index=index, copy=False)
+        df.columns = columns
+        frames[key] = df
+    return frames
+
+
+def _moduleEnergyFlows(df, modEnergy, insolation=4800, PR=0.85):
+    r'''
+    Module energy flows [Wh] by year. Inputs can be dataframes of one
+    scenario or dictionaries of scenario x year arrays.
+
+    Parameters
+    ----------
+    df : DataFrame or dict
+        Module mass flow outputs (dataOut_m).
+    modEnergy : DataFrame or dict
+        Module energy inputs (dataIn_e).
+    insolation : float
+        Insolation received in the location modeled [Wh/m2-year].
+    PR : float
+        Performance ratio.
+
+    Returns
+    -------
+    de : dict
+        Energy flows by process, same shape as the inputs.
+    '''
+    de = {}
+    de['mod_MFG'] = df['ModuleTotal_MFG']*modEnergy['e_mod_MFG']
+    de['mod_Install'] = df['Area']*modEnergy['e_mod_Install']
+    de['mod_OandM'] = df['Cumulative_Active_Area']*modEnergy['e_mod_OandM']
+    de['mod_Repair'] = df['Repaired_Area']*modEnergy['e_mod_Repair']
+    de['mod_Demount'] = (df['Resold_Area']+df['Yearly_Sum_Area_PathsBad']+df['Landfill_0_ProjLife']
+                       +df['Yearly_Sum_Area_PathsGood'])*modEnergy['e_mod_Demount']
+    de['mod_Store'] = df['P2_stored']*modEnergy['e_mod_Store']
+    de['mod_Resell_Certify'] = df['Resold_Area']*modEnergy['e_mod_Resell_Certify']
+    de['mod_ReMFG_Disassembly'] = df['P3_reMFG']*modEnergy['e_mod_ReMFG_Disassembly']
+    de['mod_Recycle_Crush'] = df['P4_recycled']*modEnergy['e_mod_Recycle_Crush']
+
+    #Energy Generation, Energy_out = Insolation (adjusted for bifi) * ActivePower/Irradience * time * PR
+    de['e_out_annual_[Wh]'] = insolation*(df['irradiance_stc']/1000) * (df['Effective_Capacity_[W]']/1000) * 365 * PR
+
+    return de
+
+
+def _materialEnergyFlows(dm, matEnergy):
+    r'''
+    Material energy flows [Wh] by year. Inputs can be dataframes of one
+    scenario or dictionaries of scenario x year arrays.
+
+    Parameters
+    ----------
+    dm : DataFrame or dict
+        Material mass flow outputs (matdataOut_m).
+    matEnergy : DataFrame or dict
+        Material energy inputs (matdataIn_e).
+
+    Returns
+    -------
+    demat : dict
+        Energy flows by process, same shape as the inputs.
+    '''
+    demat = {}
+    demat['mat_extraction'] = dm['mat_Virgin_Stock_Raw']*matEnergy['e_mat_extraction']
+    demat['mat_MFG_virgin'] = dm['mat_Virgin_Stock']*matEnergy['e_mat_MFG'] #multiply only the virgin input
+    demat['mat_MFG_virgin_fuel'] = demat['mat_MFG_virgin']*matEnergy['e_mat_MFG_fuelfraction']*0.01 #fuel fraction of the virgin energy demands
+    #demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']*(1-matEnergy['e_mat_MFG_fuelfraction'])*0.01 
+    demat['mat_MFGScrap_LQ'] = dm['mat_MFG_Scrap_Sentto_Recycling']*matEnergy['e_mat_MFGScrap_LQ'] #OQ only - everything that goes into mfgscrap recycle
+    demat['mat_MFGScrap_HQ'] = dm['mat_MFG_Recycled_into_HQ']*(matEnergy['e_mat_MFGScrap_HQ']) #the additional energy required for HQ
+    demat['mat_MFGScrap_HQ_fuel'] = demat['mat_MFGScrap_HQ']*matEnergy['e_mat_Recycled_HQ_fuelfraction']*0.01 #fraction of HQ energy attributable to fuel
+    #demat['mat_MFG_virgin_elec'] = demat['mat_MFG_virgin']*(1-matEnergy['e_mat_MFG_fuelfraction'])*0.01 
+
+    demat['mat_Landfill'] = dm['mat_Total_Landfilled']*matEnergy['e_mat_Landfill']
+    demat['mat_Landfill_fuel'] = demat['mat_Landfill']*matEnergy['e_mat_Landfill_fuelfraction']*0.01 #fuel fraction of landfilling
+    demat['mat_EoL_ReMFG_clean'] = dm['mat_reMFG_target']*matEnergy['e_mat_EoL_ReMFG_clean']
+    demat['mat_Recycled_LQ'] = dm['mat_recycled_target']*matEnergy['e_mat_Recycled_LQ']
+    demat['mat_Recycled_HQ'] = dm['mat_EOL_Recycled_2_HQ']*matEnergy['e_mat_Recycled_HQ']
+    demat['mat_Recycled_HQ_fuel'] = demat['mat_Recycled_HQ']*matEnergy['e_mat_Recycled_HQ_fuelfraction']*0.01
+    demat['mat_Recycled_HQ_elec'] = demat['mat_Recycled_HQ']-demat['mat_Recycled_HQ_fuel']
+
+    return demat
+
+
+def _stackColumns(frames, dtype=np.float64):
+    r'''
+    Stacks the numeric columns shared by all the dataframes as arrays of
+    shape (S, N) for a list of S dataframes (scenarios), or (S, k, N) for
+    S lists of k dataframes (scenarios x materials), keyed by column name.
+    Each dataframe is converted to an array only once.
+    '''
+    nested = isinstance(frames[0], (list, tuple))
+    flat = [frame for group in frames for frame in group] if nested else frames
+    columns = [key for key in flat[0].columns
+               if flat[0][key].dtype.kind in 'biuf' and
+               all(key in frame for frame in flat[1:])]
+    values = np.stack([frame[columns].to_numpy(dtype=dtype)
+                       for frame in flat])
+    values = np.ascontiguousarray(np.moveaxis(values, -1, 0))
+    if nested:
+        values = values.reshape((len(columns), len(frames), -1) +
+                                values.shape[-1:])
+    return dict(zip(columns, values))
+
+
+def _derivativeSeeds(derivatives, years, materials, landfills, dtype):
+    r'''
+    Derivatives of the inputs of a batch of scenarios along each of the D
+    ``derivatives`` of ``calculateMassFlow``: 1 on the field and year of its
+    (source, field, year). Landfill paths set to the remainder of the other
+    EOL paths (see ``_EOL_PATH_GROUPS``) follow those paths instead.
+
+    Parameters
+    ----------
+    derivatives : list
+        (source, field, year) of each direction, where source is 'module'
+        or a material name.
+    years : numpy array
+        Years of each scenario, of shape (S, N).
+    materials : list
+        Materials of the batch, k of them.
+    landfills : list
+        Landfill paths set to the remainder for each scenario.
+    dtype : numpy dtype
+        Floating point type of the derivatives.
+
+    Returns
+    -------
+    tangents : dict
+        Derivatives of the module fields, of shape (D, S, N), and of the
+        material fields, of shape (D, S, k, N).
+    '''
+    years = np.asarray(years)
+    shape = (len(derivatives),) + years.shape
+    tangents = {}
+    for dd, (source, field, year) in enumerate(derivatives):
+        select = years == year
+        if not select.any():
+            raise ValueError("Year %s is not simulated." % year)
+        if source == 'module':
+            if field not in _DERIVATIVE_INPUTS:
+                raise ValueError("The mass flows are not differentiable by "
+                                 "%s." % field)
+            tangents.setdefault(field, np.zeros(shape, dtype=dtype))
+            tangents[field][dd][select] = 1
+        else:
+            if field not in _MATERIAL_DERIVATIVE_INPUTS:
+                raise ValueError("The mass flows are not differentiable by "
+                                 "%s of %s." % (field, source))
+            if source not in materials:
+                raise ValueError("Material %s is not calculated." % source)
+            tangents.setdefault(field, np.zeros(
+                shape[:2] + (len(materials),) + shape[2:], dtype=dtype))
+            tangents[field][dd][:, materials.index(source)][select] = 1
+
+    for ss, fixed in enumerate(landfills):
+        for landfill in fixed:
+            tangents.setdefault(landfill, np.zeros(shape, dtype=dtype))
+            tangents[landfill][:, ss] = -sum(
+                tangents[path][:, ss] for path in _EOL_PATH_GROUPS[landfill]
+                if path in tangents)
+    return tangents
+
+
+def _castFloatColumns(df, dtype):
+    r'''
+    Casts the numeric columns of a dataframe to the floating point
+    ``dtype``, leaving object columns (i.e. Weibull parameters) untouched.
+    '''
+    numcols = [col for col, coltype in df.dtypes.items()
+               if coltype.kind in 'biuf' and coltype != dtype]
+    if not numcols:
+        return df
+    return df.astype({col: dtype for col in numcols})
+
+
+def _weibullCache(func):
+    r'''
+    Least-recently-used cache of `func` results by arguments, holding up to
+    ``WEIBULL_CACHE_SIZE`` entries. The size is read on every call, so it
+    can be changed at any time; ``cache_clear`` empties the cache.
+    '''
+    cache = collections.OrderedDict()
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def cached(*args):
+        with lock:
+            result = cache.get(args)
+        if result is None:
+            result = func(*args)
+        with lock:
+            cache[args] = result
+            cache.move_to_end(args)
+            while len(cache) > max(WEIBULL_CACHE_SIZE, 0):
+                cache.popitem(last=False)
+        return result
+
+    cached.cache_clear = cache.clear
+    return cached
+
+
+@_weibullCache
+def _weibullTable(alpha, beta, nyears):
+    r'''
+    Returns the Weibull CDF and PDF by age (0 to nyears-1) for one set of
+    parameters. Results are kept on a shared least-recently-used cache, so
+    cohorts, scenarios and simulations with the same `alpha`, `beta` and
+    horizon reuse the same read-only arrays.
+
+    Parameters
+    ----------
+    alpha : float
+        Shape parameter `alpha` for weibull distribution.
+    beta : float
+        Scale parameter `beta` for weibull distribution.
+    nyears : int
+        Number of years (ages) to tabulate.
+
+    Returns
+    -------
+    cdf : numpy array
+        Cumulative failure probability by age.
+    pdf : numpy array
+        Failure probability on each age. Age 0 never fails.
+    '''
+
+    ages = np.arange(nyears, dtype=float)
+    cdf = weibull_cdf(alpha, beta)(ages)
+    pdf = np.zeros(nyears)
+    pdf[1:] = cdf[1:] - cdf[:-1]
+
+    cdf.flags.writeable = False
+    pdf.flags.writeable = False
 
-        if start_year is None:
-            start_year = int(datetime.datetime.now().year)
+    return cdf, pdf
 
-        if materials is None:
-            materials = list(self.material.keys())
-        else:
-            if isinstance(materials, str):
-                materials = [materials]
 
-        selectyears = self.dataIn_m['year']>=start_year
-        
-        if isinstance(value, (pd.Series)):
-            for mat in materials:
-                timeshift = start_year - self.dataIn_m.iloc[0,0]
-                self.material[mat].matdataIn_m.loc[timeshift:, stage] = value.values
-            
-        else:
-            for mat in materials:
-                self.material[mat].matdataIn_m.loc[selectyears, stage] = value
+@_weibullCache
+def _weibullParamsCached(t50, t90):
+    r'''
+    Cached `weibull_params` for a t50, t90 pair.
+    '''
+    return weibull_params({t50: 0.50, t90: 0.90})
 
 
-    def modifyMaterialEnergy(self, materials, stage, value, start_year=None):
+def _weibullPDFs(weibullalpha, weibullbeta, nyears):
+    r'''
+    Builds the failure probability by age of each cohort from the cached
+    Weibull tables. Each different (alpha, beta) pair is tabulated once and
+    the cohorts index into the table.
 
-        if start_year is None:
-            start_year = int(datetime.datetime.now().year)
+    Parameters
+    ----------
+    weibullalpha, weibullbeta : array-like
+        Weibull parameters of each cohort.
+    nyears : int
+        Number of years (ages) to tabulate.
 
-        if materials is None:
-            materials = list(self.material.keys())
-        else:
-            if isinstance(materials, str):
-                materials = [materials]
+    Returns
+    -------
+    pdf : numpy array
+        Array of shape weibullalpha.shape + (nyears,).
+    '''
 
-        selectyears = self.dataIn_e['year']>=start_year
-        
-        if isinstance(value, (pd.Series)):
-            for mat in materials:
-                timeshift = start_year - self.dataIn_e.iloc[0,0]
-                self.material[mat].matdataIn_e.loc[timeshift:, stage] = value.values
-            
-        else:
-            for mat in materials:
-                self.material[mat].matdataIn_e.loc[selectyears, stage] = value
+    alpha = np.asarray(weibullalpha, dtype=float)
+    beta = np.asarray(weibullbeta, dtype=float)
+    params = np.stack([alpha.ravel(), beta.ravel()], axis=1)
+    unique, inverse = np.unique(params, axis=0, return_inverse=True)
+    tables = np.stack([_weibullTable(a, b, nyears)[1] for a, b in unique])
 
-    def __getitem__(self, key):
-        return getattr(self, key)
+    return tables[inverse.ravel()].reshape(alpha.shape + (nyears,))
 
-    def __setitem__(self, key):
-        return setattr(self, key)
 
+class RegionResults:
+    '''
+    Results of ``Simulation.calculateRegions``, kept as one scenario x
+    region x year x metric array.
 
-class Material:
+    Attributes
+    ----------
+    values : np.ndarray
+        Array of shape (scenarios, regions, years, metrics).
+    scenarios, regions, years, metrics : list
+        Labels of each axis of ``values``.
+    '''
 
-    def __init__(self, materialname, massmatfile, energymatfile=None):
-        self.materialname = materialname
+    def __init__(self, values, scenarios, regions, years, metrics):
+        self.values = values
+        self.scenarios = scenarios
+        self.regions = regions
+        self.years = years
+        self.metrics = metrics
 
-        if massmatfile is None:
-            try:
-                massmatfile = _interactive_load('Select material baseline ' +
-                                                'file')
-            except:
-                raise Exception('Interactive load failed. Tkinter not ' +
-                                'supported on this system. Try installing ' +
-                                'X-Quartz and reloading')
+    def frame(self, metric, scenario=None):
+        '''
+        Year by region DataFrame of one ``metric``, for ``scenario`` or the
+        first scenario.
+        '''
+        ss = 0 if scenario is None else self.scenarios.index(scenario)
+        return pd.DataFrame(
+            self.values[ss, :, :, self.metrics.index(metric)].T,
+            index=self.years, columns=self.regions)
 
-        data, meta = _readPVICEFile(massmatfile)
 
-        self.massmatfile = massmatfile
-        self.matmetdataIn_m = meta
-        self.matdataIn_m = data
+class Surrogate:
+    '''
+    Polynomial chaos emulator of ``aggregateScenario`` metrics over a box
+    of levers, as trained by ``Simulation.trainSurrogate``. The yearly
+    metrics of the training runs are reduced to their principal
+    components, and each component is fitted by least squares on Legendre
+    polynomials of the levers scaled to [-1, 1]. Queries are a small
+    matrix product, with the leave-one-out error of the fit as error
+    estimate.
 
-        # SAVING A COPY TO RAW
-        # Joining the metdata back in
-        foometa = pd.DataFrame(meta, index=[0])
-        foodata = pd.concat([foometa, data], axis=0)
-        # Removing the path to just get the filename
-        # TODO - find fancy python way, this will probably break on a mac
-        try:
-            foomassmatfile = massmatfile.split('\\')[-1]
-            foodata.to_csv(os.path.join('raw', materialname + '_' +
-                                        foomassmatfile))
-        except:
-            print("Can't save raw files on macs yet.")
-        if energymatfile is not None:
-            self.addEnergytoMaterial(energymatfile)
+    Parameters
+    ----------
+    labels : list
+        (source, field, start_year, end_year) of each lever.
+    lower, upper : np.ndarray
+        Bounds of the levers.
+    metrics : list
+        Metrics emulated.
+    years : list
+        Years of the metrics.
+    exponents : np.ndarray
+        Legendre degree of each lever (columns) in each polynomial term.
+    settings : dict
+        'scenario', 'materials' and 'method' of the training runs.
+
+    Attributes
+    ----------
+    mean, components, coefficients : np.ndarray
+        Mean of the flattened year x metric outputs, principal components
+        kept, and polynomial coefficients of each component.
+    errors : np.ndarray
+        Leave-one-out root mean square error of each year x metric output
+        over the training runs.
+    '''
+
+    def __init__(self, labels, lower, upper, metrics, years, exponents,
+                 settings=None):
+        self.labels = [tuple(label) for label in labels]
+        self.lower = np.asarray(lower, dtype=float)
+        self.upper = np.asarray(upper, dtype=float)
+        self.metrics = list(metrics)
+        self.years = list(years)
+        self.exponents = np.asarray(exponents, dtype=int)
+        self.settings = settings or {}
+        self.kwargs = {}
+
+    def _basis(self, x):
+        x = np.atleast_2d(np.asarray(x, dtype=float))
+        width = np.where(self.upper > self.lower, self.upper - self.lower, 1)
+        scaled = 2*(x - self.lower)/width - 1
+        basis = np.ones((len(x), len(self.exponents)))
+        degree = self.exponents.max(initial=0)
+        for ii in range(x.shape[1]):
+            vander = np.polynomial.legendre.legvander(scaled[:, ii], degree)
+            basis *= vander[:, self.exponents[:, ii]]
+        return basis
+
+    def fit(self, points, outputs, tol=1e-10):
+        '''
+        Fits the emulator to the engine ``outputs`` (runs x years x metrics)
+        at lever values ``points`` (runs x levers). Components below ``tol``
+        of the largest one are dropped.
+        '''
+        outputs = np.asarray(outputs, dtype=float)
+        values = outputs.reshape(len(outputs), -1)
+        self.mean = values.mean(axis=0)
+        _, singular, vt = np.linalg.svd(values - self.mean,
+                                        full_matrices=False)
+        keep = singular > tol*singular.max(initial=0)
+        self.components = vt[keep]
+        scores = (values - self.mean) @ self.components.T
+
+        basis = self._basis(points)
+        self.coefficients = np.linalg.lstsq(basis, scores, rcond=None)[0]
+
+        # Leave-one-out residuals of a least squares fit, from the leverage
+        # of each run.
+        leverage = np.einsum('ij,ji->i', basis, np.linalg.pinv(basis))
+        residuals = (values - self.mean -
+                     basis @ self.coefficients @ self.components)
+        residuals /= np.maximum(1 - leverage, 1e-12)[:, None]
+        self.errors = np.sqrt((residuals**2).mean(axis=0)).reshape(
+            outputs.shape[1:])
+        return self
+
+    def predict(self, x, errors=False):
+        '''
+        Emulated metrics at lever values ``x``, one value per lever or one
+        row of them per query.
+
+        Returns
+        -------
+        values : pd.DataFrame
+            Year x metric values, indexed by (query, year) for several
+            queries.
+        errors : pd.DataFrame
+            With ``errors``, the leave-one-out error estimate of each value.
+        '''
+        x = np.asarray(x, dtype=float)
+        single = x.ndim == 1
+        x = np.atleast_2d(x)
+        if ((x < self.lower) | (x > self.upper)).any():
+            print("Warning: levers outside of the training bounds, the "
+                  "surrogate is extrapolating.")
+        values = self.mean + self._basis(x) @ self.coefficients @ self.components
+        values = values.reshape(len(x)*len(self.years), len(self.metrics))
+        if single:
+            index = pd.Index(self.years, name='year')
         else:
-            self.energymatfile = None
-            self.matmetdataIn_e = None
-            self.matdataIn_e = None
+            index = pd.MultiIndex.from_product([range(len(x)), self.years],
+                                               names=['query', 'year'])
+        values = pd.DataFrame(values, index=index, columns=self.metrics)
+        if not errors:
+            return values
+        return values, pd.DataFrame(np.tile(self.errors, (len(x), 1)),
+                                    index=index, columns=self.metrics)
+
+    def validate(self, sim, nsamples=10, seed=None, scenario=None,
+                 **kwargs):
+        '''
+        Checks the emulator against the engine on ``nsamples`` new random
+        lever values, calculated on ``scenario`` of ``sim`` (defaults to
+        the training scenario) with the training arguments updated with
+        ``kwargs``.
 
-    def addEnergytoMaterial(self, energymatfile):
+        Returns
+        -------
+        pd.DataFrame
+            By metric, 'max_error' and 'rms_error' of the emulator over the
+            runs and years, 'estimated_error' (root mean square of the
+            leave-one-out estimates over the years) and 'scale' (largest
+            absolute value calculated).
+        '''
+        if scenario is None:
+            scenario = self.settings['scenario']
+        rng = np.random.default_rng(seed)
+        points = self.lower + rng.random((nsamples, len(self.labels)))*(
+            self.upper - self.lower)
+        materials = self.settings.get('materials')
+        outputs = sim._evaluateLevers(
+            scenario, self.labels, points,
+            lambda scen: aggregateScenario(scen, materials)[self.metrics],
+            materials, self.settings.get('method', 'calculateMassFlow'),
+            **{**self.kwargs, **kwargs})
+        done = [ii for ii, output in enumerate(outputs) if output is not None]
+
+        actual = np.stack([outputs[ii].values for ii in done])
+        predicted = self.predict(points[done]).values.reshape(actual.shape)
+        error = np.abs(predicted - actual)
+        return pd.DataFrame({
+            'max_error': error.max(axis=(0, 1)),
+            'rms_error': np.sqrt((error**2).mean(axis=(0, 1))),
+            'estimated_error': np.sqrt((self.errors**2).mean(axis=0)),
+            'scale': np.abs(actual).max(axis=(0, 1))}, index=self.metrics)
+
+    def save(self, filename):
+        '''
+        Saves the emulator to a ``.npz`` file. Training ``kwargs`` are not
+        saved.
+        '''
+        import json
+
+        header = {'labels': self.labels, 'metrics': self.metrics,
+                  'years': self.years, 'settings': self.settings}
+        np.savez_compressed(
+            filename, header=np.array(json.dumps(header, default=_jsonValue)),
+            lower=self.lower, upper=self.upper, exponents=self.exponents,
+            mean=self.mean, components=self.components,
+            coefficients=self.coefficients, errors=self.errors)
+
+    @staticmethod
+    def load(filename):
+        '''
+        Loads an emulator saved with ``save``.
+        '''
+        import json
 
-        data, meta = _readPVICEFile(energymatfile)
+        with np.load(filename) as data:
+            header = json.loads(str(data['header']))
+            surrogate = Surrogate(header['labels'], data['lower'],
+                                  data['upper'], header['metrics'],
+                                  header['years'], data['exponents'],
+                                  settings=header['settings'])
+            for attribute in ['mean', 'components', 'coefficients', 'errors']:
+                setattr(surrogate, attribute, data[attribute])
+        return surrogate
 
-        self.energymatfile = energymatfile
-        self.matmetdataIn_e = meta
-        self.matdataIn_e = data
 
+def _jsonValue(value):
+    # numpy scalars in the surrogate labels and years
+    return value.item()
 
-def weibull_params(keypoints):
-    r'''Returns shape parameter `alpha` and scale parameter `beta`
-    for a Weibull distribution whose CDF passes through the
-    two time: value pairs in `keypoints`
 
-    Parameters
-    ----------
-    keypoints : list
-        Two lists of t50 and 590 values, where t50 is the year since deployment
-        that the cohort has lost 50% of originally installed modules, and t90
-        is the year since deployment that the cohort has lost 90% of the originally
-        installed modules. These values are used to calcualte the shape and scale
-        parameters for the weibull distribution.
+def _totalDegreeExponents(nlevers, degree):
+    r'''
+    Exponents (terms x levers) of the polynomials of total degree up to
+    ``degree`` on ``nlevers`` variables, by increasing total degree.
+    '''
+    exponents = [exponent for exponent in
+                 itertools.product(range(degree + 1), repeat=nlevers)
+                 if sum(exponent) <= degree]
+    exponents.sort(key=sum)
+    return np.array(exponents, dtype=int).reshape(len(exponents), nlevers)
 
-    Returns
-    -------
-    alpha : float
-        Shape parameter `alpha` for weibull distribution.
-    beta : float
-        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
-        like in Irena 2016, beta = 30.
 
+def _latinHypercube(nsamples, ndims, rng):
+    r'''
+    Latin hypercube sample of shape (nsamples, ndims) on [0, 1): each
+    dimension has one point in each of ``nsamples`` equal intervals.
     '''
+    strata = rng.permuted(np.tile(np.arange(nsamples), (ndims, 1)), axis=1)
+    return (strata.T + rng.random((nsamples, ndims)))/nsamples
 
-    t1, t2 = tuple(keypoints.keys())
-    cdf1, cdf2 = tuple(keypoints.values())
-    alpha = np.ndarray.item(np.real_if_close(
-        (np.log(np.log(1 - cdf1)+0j) - np.log(np.log(1 - cdf2)+0j))/(np.log(t1) - np.log(t2))
-    ))
-    beta = np.abs(np.exp(
-        (
-            np.log(t2)*((0+1j)*np.pi + np.log(np.log(1 - cdf1)+0j))
-            + np.log(t1)*(((0-1j))*np.pi - np.log(np.log(1 - cdf2)+0j))
-        )/(
-            np.log(np.log(1 - cdf1)+0j) - np.log(np.log(1 - cdf2)+0j)
-        )
-    ))
-    return {'alpha': alpha, 'beta': beta}
 
-def weibull_cdf(alpha, beta):
-    '''Return the CDF for a Weibull distribution having:
-    shape parameter `alpha`
-    scale parameter `beta`
+class CohortMatrix:
+    r'''
+    Generation x year cohort matrix stored packed by age. Modules do not
+    retire before they are installed, so the [generation, year] matrices
+    of the mass flows are upper-triangular; only the N-age cohorts still
+    inside the simulation horizon are kept for each age. If nothing
+    retires after ``bandwidth`` years of age, only the first ``bandwidth``
+    ages are stored.
 
     Parameters
     ----------
-    alpha : float
-        Shape parameter `alpha` for weibull distribution.
-    beta : float
-        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
-        like in Irena 2016, beta = 30.
-
+    nyears : int
+        Number of years (generations) simulated.
+    bandwidth : int
+        Number of ages stored, age 0 included. Defaults to ``nyears``
+        (full triangle).
+    batchshape : tuple
+        Leading dimensions of independent matrices stored together, i.e.
+        scenarios.
+    dtype : numpy dtype
+        Data type of the stored values.
     '''
 
-    def cdf(x):
-        return 1 - np.exp(-(np.array(x)/beta)**alpha)
-    return cdf
+    def __init__(self, nyears, bandwidth=None, batchshape=(), dtype=float):
+        if bandwidth is None:
+            bandwidth = nyears
+        self.nyears = nyears
+        self.bandwidth = int(min(max(bandwidth, 1), nyears))
+        ages = np.arange(self.bandwidth)
+        self._offsets = np.concatenate([[0], np.cumsum(nyears - ages)])
+        self.data = np.zeros(tuple(batchshape) + (self._offsets[-1],),
+                             dtype=dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape[:-1] + (self.nyears, self.nyears)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def __getitem__(self, index):
+        r'''
+        Matrices of the batch ``index`` (leading dimensions only), sharing
+        the stored values.
+        '''
+        if self.data.ndim == 1:
+            raise IndexError('Cohort matrix has no batch dimensions.')
+        matrix = CohortMatrix.__new__(CohortMatrix)
+        matrix.nyears = self.nyears
+        matrix.bandwidth = self.bandwidth
+        matrix._offsets = self._offsets
+        matrix.data = self.data[index]
+        return matrix
+
+    def _indices(self):
+        ages = np.repeat(np.arange(self.bandwidth),
+                         self.nyears - np.arange(self.bandwidth))
+        generations = np.arange(self._offsets[-1]) - self._offsets[ages]
+        return generations, generations + ages
+
+    def age(self, age):
+        r'''
+        Values of all the cohorts at ``age``, view of shape
+        (..., nyears-age) indexed by generation.
+        '''
+        return self.data[..., self._offsets[age]:self._offsets[age+1]]
+
+    def setAge(self, age, values):
+        r'''
+        Sets the values of the cohorts 0 to nyears-age-1 at ``age``.
+        '''
+        if age >= self.bandwidth:
+            raise IndexError('Age %s is outside of the bandwidth (%s) of the'
+                             ' cohort matrix.' % (age, self.bandwidth))
+        self.age(age)[...] = values
+
+    def colsum(self, weights=None):
+        r'''
+        Yearly sums over all generations, optionally weighted by generation
+        (i.e. mass per m2 of each material).
+
+        Parameters
+        ----------
+        weights : numpy array
+            Weights of shape (..., k, nyears) indexed by generation.
+
+        Returns
+        -------
+        colsum : numpy array
+            Sums of shape (..., nyears), or (..., k, nyears) with weights.
+            NaN entries are skipped, as in pandas sums.
+        '''
+        generations, years = self._indices()
+        values = self.data
+        if weights is not None:
+            weights = np.asarray(weights)
+            values = weights[..., generations] * values[..., None, :]
+        values = np.nan_to_num(values, copy=weights is None)
+        batch = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1])
+        bins = (years + self.nyears*np.arange(values.shape[0])[:, None])
+        colsum = np.bincount(bins.ravel(), weights=values.ravel(),
+                             minlength=values.shape[0]*self.nyears)
+        return colsum.reshape(batch + (self.nyears,)).astype(self.dtype,
+                                                             copy=False)
+
+    def toDense(self):
+        r'''
+        Returns the upper-triangular array of shape (..., nyears, nyears)
+        indexed by [generation, year].
+        '''
+        generations, years = self._indices()
+        dense = np.zeros(self.shape, dtype=self.data.dtype)
+        dense[..., generations, years] = self.data
+        return dense
+
+    @classmethod
+    def fromDense(cls, dense, bandwidth=None):
+        r'''
+        Packs an array of shape (..., N, N) indexed by [generation, year].
+        Values below the diagonal, or beyond the bandwidth, are dropped.
+        '''
+        dense = np.asarray(dense)
+        matrix = cls(dense.shape[-1], bandwidth=bandwidth,
+                     batchshape=dense.shape[:-2], dtype=dense.dtype)
+        generations, years = matrix._indices()
+        matrix.data[...] = dense[..., generations, years]
+        return matrix
 
-def weibull_pdf(alpha, beta):
-    r'''Return the PDF for a Weibull distribution having:
-        shape parameter `alpha`
-        scale parameter `beta`
+
+def _degradationRetirementAge(degbase, limit, nyears):
+    r'''
+    First age at which the nameplate power of a cohort degrading
+    geometrically, ``degbase**age``, falls below ``limit``. The age is
+    found in closed form from ``log(limit)/log(degbase)`` and corrected by
+    one year when the logarithm rounds across an integer.
 
     Parameters
     ----------
-    alpha : float
-        Shape parameter `alpha` for weibull distribution.
-    beta : float
-        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
-        like in Irena 2016, beta = 30.
+    degbase : numpy array
+        Yearly fraction of nameplate power kept, ``1-mod_degradation*0.01``.
+    limit : float
+        Fraction of the nameplate power under which modules are trashed.
+    nyears : int
+        Number of years simulated. Cohorts that never fall below the limit
+        get this age, which is outside of the simulation.
 
+    Returns
+    -------
+    age : numpy array
+        Retirement age by degradation of each cohort (integers >= 1).
     '''
 
-    def pdf(x):
-        return (alpha/np.array(x)) * ((np.array(x)/beta)**alpha) * (np.exp(-(np.array(x)/beta)**alpha))
+    degbase = np.asarray(degbase, dtype=float)
+    limit = np.asarray(limit, dtype=float)
+    decaying = (degbase > 0) & (degbase < 1) & (limit > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        estimate = np.floor(np.log(limit)/np.log(degbase)) + 1
+    estimate = np.clip(np.where(decaying, estimate, nyears), 1, nyears)
+    estimate = np.where((estimate > 1) & (degbase**(estimate-1) < limit),
+                        estimate-1, estimate)
+    estimate = np.where((estimate < nyears) & ~(degbase**estimate < limit),
+                        estimate+1, estimate)
+    age = np.where(degbase < limit, 1, np.where(decaying, estimate, nyears))
+    return age.astype(int)
+
+
+def _cohortMassFlows(area, mod_eff, irradiance_stc, mod_degradation,
+                     mod_lifetime, weibullalpha, weibullbeta,
+                     mod_EOL_collection_eff, mod_MerchantTail,
+                     mod_EOL_pg0_resell, mod_Repair, nameplatedeglimit=0.8,
+                     secondlifenameplatedeglimit=0.5, dtype=np.float64,
+                     prunearea=0.0, responses=False, tangents=None):
+    r'''
+    Vectorized cohort-by-age engine for the module mass flows. All the
+    cohorts (generations) are advanced together one age at a time, so the
+    generation x year grid is filled with NumPy operations instead of a
+    scalar loop per cohort and year.
+
+    Per cohort, each year after installation is evaluated in this order:
+    degradation below the nameplate limit (first or second life), end of
+    project lifetime (merchant tail, collection and resale), and Weibull
+    failures (capped to the remaining area) with repairs. The retirement
+    ages by degradation of the first and second life are precalculated for
+    all cohorts, so degradation is only a mask on each age.
+
+    Only live cohorts are advanced: a cohort is dropped once its remaining
+    active area is at or below ``prunearea`` (fully retired by default),
+    and the loop ends when no cohort is left.
 
-    return pdf
+    Parameters
+    ----------
+    area : numpy array
+        Area installed on each generation [m2]. Last axis is the year axis;
+        leading axes, if any, are treated as independent batches.
+    mod_eff, irradiance_stc, mod_degradation, mod_lifetime : numpy array
+        Module characteristics of each generation.
+    weibullalpha, weibullbeta : numpy array
+        Weibull shape and scale parameters of each generation.
+    mod_EOL_collection_eff, mod_MerchantTail, mod_EOL_pg0_resell, mod_Repair : numpy array
+        Yearly values [%] applied to the cohorts retiring or failing on
+        that year.
+    nameplatedeglimit : float
+        Fraction of the nameplate power under which modules are trashed.
+    secondlifenameplatedeglimit : float
+        Fraction of the nameplate power under which modules on their
+        second life (merchant tail) are trashed.
+    dtype : numpy dtype
+        Floating point type of the flows calculated, i.e. np.float32 to
+        halve memory on large sweeps. Retirement ages are always decided
+        in float64.
+    prunearea : float
+        Remaining active area [m2] at or below which a cohort stops being
+        tracked. With the default 0, only fully retired cohorts are dropped
+        and results are exact; above 0, the remaining area of the pruned
+        cohorts (at most ``prunearea`` each) leaves the active area without
+        going to any EOL path, and is kept in 'area_pruned' on the year it
+        leaves.
+    responses : bool
+        If True, a cohort matrix is also kept for every yearly sum, so the
+        flows of any other install vector can be obtained by scaling the
+        cohorts (see ``Simulation._impulseCohorts``). Meant to be used with
+        a unit area.
+    tangents : dict
+        Derivatives of any of `mod_EOL_collection_eff`, `mod_MerchantTail`,
+        `mod_EOL_pg0_resell` and `mod_Repair` along D directions, arrays of
+        shape (D, ..., N). The derivatives of the flows are then carried
+        along the cohorts, with the failures cap and the retirement ages on
+        their calculated branch, but for the area going into merchant tail,
+        which retires on its second life.
 
-def weibull_pdf_vis(alpha, beta, xlim=56):
-    r''' Returns the CDF for a weibull distribution of 1 generation
-    so it can be plotted.
+    Returns
+    -------
+    yearly : dict
+        Yearly sums over all cohorts, arrays of shape (..., N), with keys
+        'area_active', 'power_active', 'power_degraded', 'area_failure',
+        'power_failure', 'area_repaired', 'power_repaired',
+        'area_degradation', 'power_degradation', 'area_merchantTail',
+        'power_merchantTail', 'area_resold', 'power_resold',
+        'area_projLife', 'power_projLife', 'area_PG', 'power_PG',
+        'area_L0', 'power_L0' and 'area_pruned'.
+    matrices : dict
+        Cohort area matrices (``CohortMatrix``) indexed by
+        [generation, year] feeding the EOL pathways: 'area_PG' (path good,
+        collected at end of project lifetime), 'area_L0' (not collected at
+        end of project lifetime) and 'area_PB' (path bad, degradation and
+        failures not repaired). Path good and L0 only happen at the end of
+        project lifetime, so they are stored up to the longest lifetime.
+        With ``responses``, it also has the cohort matrix of each of the
+        yearly keys.
+    dyearly, dmatrices : dict
+        Only with ``tangents``: derivatives of the yearly sums (but
+        'area_pruned') and of the EOL cohort matrices, with the D
+        directions as leading axis.
+    '''
+
+    area = np.nan_to_num(np.asarray(area, dtype=dtype))
+    nyears = area.shape[-1]
+    generation = np.arange(nyears)
+    mod_eff, irradiance_stc, mod_EOL_collection_eff, mod_MerchantTail, \
+        mod_EOL_pg0_resell, mod_Repair = (
+            np.asarray(value, dtype=dtype) for value in
+            [mod_eff, irradiance_stc, mod_EOL_collection_eff,
+             mod_MerchantTail, mod_EOL_pg0_resell, mod_Repair])
+    powerinitgen = mod_eff*0.01*irradiance_stc
+    degbase64 = 1-np.asarray(mod_degradation, dtype=float)*0.01
+    degbase = degbase64.astype(dtype)
+    lifetimeage = (np.trunc(np.asarray(mod_lifetime, dtype=float) +
+                            generation) - generation)
+
+    # Weibull failure probability of each cohort by age, shared between
+    # cohorts with the same parameters.
+    pdf = _weibullPDFs(weibullalpha, weibullbeta, nyears).astype(
+        dtype, copy=False)
+
+    keys = ['area_active', 'power_active', 'power_degraded', 'area_failure',
+            'power_failure', 'area_repaired', 'power_repaired',
+            'area_degradation', 'power_degradation', 'area_merchantTail',
+            'power_merchantTail', 'area_resold', 'power_resold',
+            'area_projLife', 'power_projLife', 'area_PG', 'power_PG',
+            'area_L0', 'power_L0']
+    yearly = {key: np.zeros(area.shape, dtype=dtype) for key in keys}
+    yearly['area_pruned'] = np.zeros(area.shape, dtype=dtype)
+    lifetimes = lifetimeage[np.isfinite(lifetimeage)]
+    lifeband = int(lifetimes.max()) + 1 if lifetimes.size else 1
+    matrices = {'area_PG': CohortMatrix(nyears, lifeband, area.shape[:-1],
+                                        dtype),
+                'area_L0': CohortMatrix(nyears, lifeband, area.shape[:-1],
+                                        dtype),
+                'area_PB': CohortMatrix(nyears, batchshape=area.shape[:-1],
+                                        dtype=dtype)}
+    if responses:
+        for key in keys:
+            if key not in matrices:
+                matrices[key] = CohortMatrix(nyears, batchshape=area.shape[:-1],
+                                             dtype=dtype)
+    if tangents is not None:
+        tangents = {key: np.asarray(value, dtype=dtype)
+                    for key, value in tangents.items()}
+        dshape = (len(next(iter(tangents.values()))),) + area.shape
+        dyearly = {key: np.zeros(dshape, dtype=dtype) for key in keys}
+        dmatrices = {name: CohortMatrix(nyears, matrix.bandwidth, dshape[:-1],
+                                        dtype)
+                     for name, matrix in matrices.items()
+                     if name in ['area_PG', 'area_L0', 'area_PB']}
+        dactivearea = np.zeros(dshape, dtype=dtype)
+
+        def _tangent(key, year):
+            # Derivatives of a yearly input on the years of the live cohorts
+            if key not in tangents:
+                return 0.0
+            return tangents[key][year]
+
+    # Age 0: the installation year, nothing dies <3
+    yearly['area_active'] += area
+    yearly['power_active'] += area * mod_eff * 0.01 * irradiance_stc
+    if responses:
+        matrices['area_active'].setAge(0, area)
+        matrices['power_active'].setAge(0, area * mod_eff * 0.01 *
+                                        irradiance_stc)
+
+    # Age at which each cohort is trashed by degradation; cohorts that go
+    # into merchant tail switch to the second life age after their project
+    # lifetime.
+    firstlifeage = _degradationRetirementAge(degbase64, nameplatedeglimit,
+                                             nyears)
+    secondlifeage = np.broadcast_to(_degradationRetirementAge(
+        degbase64, secondlifenameplatedeglimit, nyears), area.shape)
+    retirementage = np.broadcast_to(firstlifeage, area.shape).copy()
+    if tangents is not None:
+        # Retirement ages of the derivatives on each direction
+        dretirementage = np.broadcast_to(retirementage, dshape).copy()
+
+    activearea = area.copy()
+
+    def _alive(values):
+        # Cohorts with area left in any of the batches (NaN stays alive)
+        alive = ~(values <= prunearea)
+        return alive.reshape(-1, alive.shape[-1]).any(axis=0)
+
+    def _prune(cohorts, values, age):
+        # Area left on the pruned cohorts, on the year after the last one
+        # they were tracked on
+        year = cohorts + age + 1
+        inside = year < nyears
+        yearly['area_pruned'][..., year[inside]] += values[..., inside]
+
+    alive = _alive(activearea)
+    _prune(np.flatnonzero(~alive), activearea[..., ~alive], 0)
+    live = np.flatnonzero(alive)
+
+    for age in range(1, nyears):
+        # Live cohorts still inside the horizon at this age, and the year
+        # each of them is in.
+        live = live[live < nyears - age]
+        if live.size == 0:
+            break
+        cohort = (Ellipsis, live)
+        year = (Ellipsis, live + age)
+
+        active = activearea[cohort]
+        deg_nameplate = degbase[cohort]**age
+        poweragegen = powerinitgen[cohort]*deg_nameplate
+
+        yearly['power_degraded'][year] += active*(
+            powerinitgen[cohort] - poweragegen)
+        if responses:
+            matrices['power_degraded'].age(age)[cohort] = active*(
+                powerinitgen[cohort] - poweragegen)
+
+        # 1. Degradation below nameplate limit
+        killed = retirementage[cohort] == age
+        area_degradation = np.where(killed, active, 0.0)
+        active = np.where(killed, 0.0, active)
+
+        # 2. End of project lifetime
+        eol = lifetimeage[cohort] == age
+        area_merchantTail = np.where(
+            eol, active*(mod_MerchantTail[year]*0.01), 0.0)
+        retirementage[cohort] = np.where(
+            eol & (area_merchantTail > 0),
+            np.maximum(secondlifeage[cohort], age+1),
+            retirementage[cohort])
+        area_removed = active - area_merchantTail
+        area_collected = area_removed*(
+            mod_EOL_collection_eff[year]*0.01)
+        area_L0 = np.where(eol, area_removed - area_collected, 0.0)
+        area_resold = np.where(
+            eol, area_collected*(mod_EOL_pg0_resell[year]*0.01),
+            0.0)
+        area_PG = np.where(eol, area_collected - area_resold, 0.0)
+        active = np.where(eol, area_merchantTail + area_resold, active)
+        area_projLife = area_PG + area_L0
+
+        # 3. Failures, capped to what is still active
+        capacity = area[cohort]*pdf[cohort + (age,)]
+        failures = np.minimum(capacity, active)
+        area_repaired = failures*mod_Repair[year]*0.01
+        area_failure = failures - area_repaired
+        active = active - area_failure
+
+        activearea[cohort] = active
+
+        if tangents is not None:
+            # Same steps on the derivatives of the live cohorts
+            dactive = dactivearea[cohort]
+            dyearly['power_degraded'][year] += dactive*(
+                powerinitgen[cohort] - poweragegen)
+
+            dkilled = dretirementage[cohort] == age
+            darea_degradation = np.where(dkilled, dactive, 0.0)
+            dactive = np.where(dkilled, 0.0, dactive)
+
+            darea_merchantTail = np.where(eol, dactive*(
+                mod_MerchantTail[year]*0.01) + (
+                area_removed + area_merchantTail)*(
+                _tangent('mod_MerchantTail', year)*0.01), 0.0)
+            dretirementage[cohort] = np.where(
+                eol & ((area_merchantTail > 0) | (darea_merchantTail != 0)),
+                np.maximum(secondlifeage[cohort], age+1),
+                dretirementage[cohort])
+            darea_removed = dactive - darea_merchantTail
+            darea_collected = darea_removed*(
+                mod_EOL_collection_eff[year]*0.01) + area_removed*(
+                _tangent('mod_EOL_collection_eff', year)*0.01)
+            darea_L0 = np.where(eol, darea_removed - darea_collected, 0.0)
+            darea_resold = np.where(eol, darea_collected*(
+                mod_EOL_pg0_resell[year]*0.01) + area_collected*(
+                _tangent('mod_EOL_pg0_resell', year)*0.01), 0.0)
+            darea_PG = np.where(eol, darea_collected - darea_resold, 0.0)
+            dactive = np.where(eol, darea_merchantTail + darea_resold,
+                               dactive)
+
+            dfailures = np.where(failures < capacity, dactive, 0.0)
+            darea_repaired = dfailures*mod_Repair[year]*0.01 + failures*(
+                _tangent('mod_Repair', year)*0.01)
+            darea_failure = dfailures - darea_repaired
+            dactive = dactive - darea_failure
+
+            dactivearea[cohort] = dactive
+
+            for key, value in [('area_degradation', darea_degradation),
+                               ('area_merchantTail', darea_merchantTail),
+                               ('area_resold', darea_resold),
+                               ('area_L0', darea_L0), ('area_PG', darea_PG),
+                               ('area_projLife', darea_PG + darea_L0),
+                               ('area_repaired', darea_repaired),
+                               ('area_failure', darea_failure),
+                               ('area_active', dactive)]:
+                dyearly[key][year] += value
+                dyearly[key.replace('area_', 'power_')][year] += (
+                    value*poweragegen)
+
+            if age < lifeband:
+                dmatrices['area_PG'].age(age)[cohort] = darea_PG
+                dmatrices['area_L0'].age(age)[cohort] = darea_L0
+            dmatrices['area_PB'].age(age)[cohort] = (darea_degradation +
+                                                     darea_failure)
+
+        for key, value in [('area_degradation', area_degradation),
+                           ('area_merchantTail', area_merchantTail),
+                           ('area_resold', area_resold),
+                           ('area_L0', area_L0), ('area_PG', area_PG),
+                           ('area_projLife', area_projLife),
+                           ('area_repaired', area_repaired),
+                           ('area_failure', area_failure),
+                           ('area_active', active)]:
+            yearly[key][year] += value
+            yearly[key.replace('area_', 'power_')][year] += value*poweragegen
+            if responses:
+                for name, values in [(key, value), (key.replace(
+                        'area_', 'power_'), value*poweragegen)]:
+                    if age < matrices[name].bandwidth:
+                        matrices[name].age(age)[cohort] = values
+
+        if age < lifeband:
+            matrices['area_PG'].age(age)[cohort] = area_PG
+            matrices['area_L0'].age(age)[cohort] = area_L0
+        matrices['area_PB'].age(age)[cohort] = area_degradation + area_failure
+
+        alive = _alive(active)
+        if tangents is not None:
+            # Retired cohorts may still change with the inputs
+            alive |= (dactive != 0).reshape(-1, alive.size).any(axis=0)
+        _prune(live[~alive], active[..., ~alive], age)
+        live = live[alive]
+
+    if tangents is not None:
+        return yearly, matrices, dyearly, dmatrices
+    return yearly, matrices
+
+
+def _moduleMassOutputs(yearly, flows, index):
+    r'''
+    Module output columns of ``calculateMassFlow`` for the scenario
+    ``index`` of a batch, from the yearly cohort sums of
+    ``_cohortMassFlows`` and the EOL flows of ``_eolPathways``.
+    '''
+    out = {}
+
+    # This used to be labeled as cumulative; but in the sense that
+    # they cumulate yearly deaths for all cohorts that die.
+    out['Yearly_Sum_Area_EOLby_Failure'] = yearly['area_failure'][index]
+    out['Yearly_Sum_Power_EOLby_Failure'] = yearly['power_failure'][index]
+    out['Yearly_Sum_Area_EOLby_Degradation'] = (
+        yearly['area_degradation'][index])
+    out['Yearly_Sum_Power_EOLby_Degradation'] = (
+        yearly['power_degradation'][index])
+    out['Yearly_Sum_Area_EOLby_ProjectLifetime'] = (
+        yearly['area_projLife'][index])
+    out['Yearly_Sum_Power_EOLby_ProjectLifetime'] = (
+        yearly['power_projLife'][index])
+
+    # Failure + Degradation + ProjcLife
+    out['Yearly_Sum_Area_atEOL'] = (yearly['area_failure'][index] +
+                                   yearly['area_projLife'][index] +
+                                   yearly['area_degradation'][index])
+    out['Yearly_Sum_Power_atEOL'] = (yearly['power_failure'][index] +
+                                    yearly['power_projLife'][index] +
+                                    yearly['power_degradation'][index])
+    # should be degradation, failures not fixed
+    out['Yearly_Sum_Area_PathsBad'] = (yearly['area_degradation'][index] +
+                                      yearly['area_failure'][index])
+    out['Yearly_Sum_Power_PathsBad'] = (yearly['power_degradation'][index] +
+                                       yearly['power_failure'][index])
+    # should be proj lifetimes
+    out['Yearly_Sum_Area_PathsGood'] = yearly['area_PG'][index]
+    out['Yearly_Sum_Power_PathsGood'] = yearly['power_PG'][index]
+
+    out['Landfill_0_ProjLife'] = yearly['area_L0'][index]  # non collected
+
+    out['Repaired_Area'] = yearly['area_repaired'][index]
+    out['Repaired_[W]'] = yearly['power_repaired'][index]
+
+    out['Resold_Area'] = yearly['area_resold'][index]
+    out['Resold_[W]'] = yearly['power_resold'][index]
+
+    out['MerchantTail_Area'] = yearly['area_merchantTail'][index]
+    out['MerchantTail_[W]'] = yearly['power_merchantTail'][index]
+
+    # Effective installed area and capacity,
+    # i.e  installed - degrad - fails - eol PL ..
+    out['Cumulative_Active_Area'] = yearly['area_active'][index]
+    out['Effective_Capacity_[W]'] = yearly['power_active'][index]
+
+    # The way it is calculated it is 'cumulative' or relative from
+    # the nameplate to each year.
+    out['Power_Degraded_[W]'] = yearly['power_degraded'][index]
+
+    for key in ['EOL_Landfill0', 'EOL_BadStatus', 'EOL_PG',
+                'EOL_PATHS', 'PG1_landfill', 'PG2_stored', 'PG3_reMFG',
+                'PG3_reMFG_yield', 'PG3_reMFG_unyield', 'PG4_recycled',
+                'PB1_landfill', 'PB2_stored', 'PB3_reMFG',
+                'PB3_reMFG_yield', 'PB3_reMFG_unyield', 'PB4_recycled',
+                'P2_stored', 'P3_reMFG', 'P4_recycled']:
+        out[key] = flows[key][index]
+
+    return out
+
+
+def _eolPathways(PG, L0, PB, inputs, weights=None, tangents=None):
+    r'''
+    Fused end-of-life pathway reductions. Every pathway matrix (collected
+    path goods and path bads split into landfill, stored, reMFG and
+    recycled, plus the non-collected landfill) is a per-year rescaling of
+    the cohort matrices PG, L0 and PB, so their column sums are obtained
+    from three matrix-vector (or matrix-matrix) products instead of
+    building each generation x year matrix.
 
     Parameters
     ----------
-    alpha : float
-        Shape parameter `alpha` for weibull distribution.
-    beta : float
-        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
-        like in Irena 2016, beta = 30.
-    xlim : int
-        Number of years to calculate the distribution for. i.e. x-axis limit.
+    PG, L0, PB : CohortMatrix or numpy array
+        Cohort area matrices indexed by [generation, year], as returned by
+        ``_cohortMassFlows``, or dense arrays of shape (..., N, N).
+    inputs : DataFrame or dict
+        Module inputs by year, with the `mod_EOL_collection_eff`,
+        `mod_EOL_pg*`, `mod_EOL_pb*` and `mod_EOL_reMFG_yield` columns [%].
+    weights : numpy array
+        Weights by generation of shape (..., k, N), i.e. the mass per m2 of
+        k materials. If None, the module area sums are returned.
+    tangents : dict
+        Derivatives along D directions of any of the cohort matrices
+        'area_PG', 'area_L0' and 'area_PB', the 'weights' and the module
+        inputs, with the directions as leading axis. Missing ones have no
+        derivatives. The derivatives of the flows are then returned too.
 
     Returns
     -------
-    idf : list
-        List of weibull cumulative distribution values for year 0 until xlim.
+    flows : dict
+        Yearly flows of shape (..., k, N), or (..., N) if no weights were
+        passed.
+    dflows : dict
+        Only with ``tangents``: derivatives of the flows, of shape
+        (D, ...) + the shape of the flows.
+    '''
+
+    dtype = PG.dtype
 
+    def _field(key):
+        return np.asarray(inputs[key], dtype=dtype)[..., None, :]
+
+    def _colsum(w, matrix):
+        if isinstance(matrix, CohortMatrix):
+            return matrix.colsum(w)
+        return np.matmul(w, np.nan_to_num(matrix))
+
+    if weights is None:
+        w = np.ones(PG.shape[:-2] + (1, PG.shape[-1]), dtype=dtype)
+    else:
+        w = np.nan_to_num(np.asarray(weights, dtype=dtype))
+
+    # Re-scaling Path Good Matrix, becuase Resold modules already got
+    # resold in the cohort loop.
+    # 'originalMatrix' = reducedMatrix x 100 / (100-p2)
+    # Blank generations are left out of the sums, as pandas sums skip NaN.
+    PGrescale = np.nan_to_num(100/(100-_field('mod_EOL_pg0_resell')))
+
+    sumL0 = _colsum(w, L0)
+    sumPG = _colsum(w, PG)
+    sumPGrescaled = _colsum(w*PGrescale, PG)
+    sumPB = _colsum(w, PB)
+
+    # What doesn't get collected of Path Bad, goes to Landfill 0.
+    collection = _field('mod_EOL_collection_eff')*0.01
+    sumPBC = sumPB*collection
+
+    flows = {}
+    flows['EOL_Landfill0'] = sumL0 + (sumPB - sumPBC)
+    flows['EOL_BadStatus'] = sumPBC
+    flows['EOL_PG'] = sumPG
+    flows['EOL_PATHS'] = sumPBC + sumPG
+
+    # PATHS GOOD
+    flows['PG1_landfill'] = sumPGrescaled*(_field('mod_EOL_pg1_landfill')*0.01)
+    flows['PG2_stored'] = sumPGrescaled*(_field('mod_EOL_pg2_stored')*0.01)
+    flows['PG3_reMFG'] = sumPGrescaled*(_field('mod_EOL_pg3_reMFG')*0.01)
+    flows['PG3_reMFG_yield'] = flows['PG3_reMFG']*(
+        _field('mod_EOL_reMFG_yield')*0.01)
+    flows['PG3_reMFG_unyield'] = flows['PG3_reMFG']-flows['PG3_reMFG_yield']
+    flows['PG4_recycled'] = sumPGrescaled*(_field('mod_EOL_pg4_recycled')*0.01)
+
+    # PATH BADS
+    flows['PB1_landfill'] = sumPBC*(_field('mod_EOL_pb1_landfill')*0.01)
+    # TODO: Path bad stored uses the path good stored fraction.
+    flows['PB2_stored'] = sumPBC*(_field('mod_EOL_pg2_stored')*0.01)
+    flows['PB3_reMFG'] = sumPBC*(_field('mod_EOL_pb3_reMFG')*0.01)
+    flows['PB3_reMFG_yield'] = flows['PB3_reMFG']*(
+        _field('mod_EOL_reMFG_yield')*0.01)
+    flows['PB3_reMFG_unyield'] = flows['PB3_reMFG']-flows['PB3_reMFG_yield']
+    flows['PB4_recycled'] = sumPBC*(_field('mod_EOL_pb4_recycled')*0.01)
+
+    # Path goods and bads added, becuase we don't need to distinguish on the
+    # source of the material stream.
+    flows['P1_landfill'] = flows['PG1_landfill'] + flows['PB1_landfill']
+    flows['P2_stored'] = flows['PG2_stored'] + flows['PB2_stored']
+    flows['P3_reMFG_yield'] = (flows['PG3_reMFG_yield'] +
+                               flows['PB3_reMFG_yield'])
+    flows['P3_reMFG_unyield'] = (flows['PG3_reMFG_unyield'] +
+                                 flows['PB3_reMFG_unyield'])
+    flows['P3_reMFG'] = flows['P3_reMFG_yield'] + flows['P3_reMFG_unyield']
+    flows['P4_recycled'] = flows['PG4_recycled'] + flows['PB4_recycled']
+
+    if tangents is not None:
+        # Same reductions on the derivatives, by the product rule
+        ndirections = next(iter(tangents.values())).shape[0]
+
+        def _dfield(key):
+            if key not in tangents:
+                return 0.0
+            return np.asarray(tangents[key], dtype=dtype)[..., None, :]
+
+        def _dcolsum(w, dw, matrix, key):
+            dsum = np.zeros((ndirections,) + sumPG.shape, dtype=dtype)
+            if dw is not None:
+                dsum += _colsum(dw, matrix)
+            if key in tangents:
+                dsum += _colsum(w, tangents[key])
+            return dsum
+
+        def _dpath(total, dtotal, key):
+            # Derivative of total*key%
+            return dtotal*(_field(key)*0.01) + total*(_dfield(key)*0.01)
+
+        dw = dwrescaled = None
+        if 'weights' in tangents:
+            dw = np.nan_to_num(np.asarray(tangents['weights'], dtype=dtype))
+            dwrescaled = dw*PGrescale
+        if 'mod_EOL_pg0_resell' in tangents:
+            dPGrescale = np.nan_to_num(
+                PGrescale**2*0.01*_dfield('mod_EOL_pg0_resell'))
+            dwrescaled = w*dPGrescale + (0.0 if dw is None else dwrescaled)
+
+        dsumL0 = _dcolsum(w, dw, L0, 'area_L0')
+        dsumPG = _dcolsum(w, dw, PG, 'area_PG')
+        dsumPGrescaled = _dcolsum(w*PGrescale, dwrescaled, PG, 'area_PG')
+        dsumPB = _dcolsum(w, dw, PB, 'area_PB')
+        dsumPBC = _dpath(sumPB, dsumPB, 'mod_EOL_collection_eff')
+
+        dflows = {}
+        dflows['EOL_Landfill0'] = dsumL0 + (dsumPB - dsumPBC)
+        dflows['EOL_BadStatus'] = dsumPBC
+        dflows['EOL_PG'] = dsumPG
+        dflows['EOL_PATHS'] = dsumPBC + dsumPG
+
+        for key, path in [('PG1_landfill', 'mod_EOL_pg1_landfill'),
+                          ('PG2_stored', 'mod_EOL_pg2_stored'),
+                          ('PG3_reMFG', 'mod_EOL_pg3_reMFG'),
+                          ('PG4_recycled', 'mod_EOL_pg4_recycled')]:
+            dflows[key] = _dpath(sumPGrescaled, dsumPGrescaled, path)
+        for key, path in [('PB1_landfill', 'mod_EOL_pb1_landfill'),
+                          ('PB2_stored', 'mod_EOL_pg2_stored'),
+                          ('PB3_reMFG', 'mod_EOL_pb3_reMFG'),
+                          ('PB4_recycled', 'mod_EOL_pb4_recycled')]:
+            dflows[key] = _dpath(sumPBC, dsumPBC, path)
+        for path in ['PG3', 'PB3']:
+            dflows[path + '_reMFG_yield'] = _dpath(
+                flows[path + '_reMFG'], dflows[path + '_reMFG'],
+                'mod_EOL_reMFG_yield')
+            dflows[path + '_reMFG_unyield'] = (dflows[path + '_reMFG'] -
+                                               dflows[path + '_reMFG_yield'])
+
+        for key in ['1_landfill', '2_stored', '3_reMFG_yield',
+                    '3_reMFG_unyield', '4_recycled']:
+            dflows['P' + key] = dflows['PG' + key] + dflows['PB' + key]
+        dflows['P3_reMFG'] = (dflows['P3_reMFG_yield'] +
+                              dflows['P3_reMFG_unyield'])
+
+    # A blank yearly input blanks the generation x year pathway matrices on
+    # that year, which pandas summed to 0.
+    flows = {key: np.nan_to_num(value) for key, value in flows.items()}
+
+    if weights is None:
+        flows = {key: value[..., 0, :] for key, value in flows.items()}
+
+    if tangents is None:
+        return flows
+
+    dflows = {key: np.nan_to_num(value) for key, value in dflows.items()}
+    if weights is None:
+        dflows = {key: value[..., 0, :] for key, value in dflows.items()}
+
+    return flows, dflows
+
+
+def _previousYear(values):
+    r'''
+    Shifts yearly values (last axis) one year forward, with 0 on the first
+    year.
     '''
+    previous = np.zeros_like(values)
+    previous[..., 1:] = values[..., :-1]
+    return previous
 
-    dfindex = pd.RangeIndex(0,xlim,1)
-    x = np.clip(dfindex - 0, 0, np.inf)
 
-    if alpha and beta:
-        i = weibull_pdf(alpha, beta)
+def _carryoverSurplus(balance):
+    r'''
+    Surplus carried to the next year when material available in a vat
+    (plus what was carried from the previous year) exceeds the needs.
+    The carry-forward is the Lindley recursion
 
-    idf = list(map(i, x))
+        carry[n] = max(0, carry[n-1] + balance[n])
 
-    return idf
+    which is evaluated as a scan over the last axis,
 
+        carry[n] = S[n] - min(0, S[0], ..., S[n]),  S = cumsum(balance)
 
-def weibull_cdf_vis(alpha, beta, xlim=56):
-    r''' Returns the CDF for a weibull distribution of 1 generation
-    so it can be plotted.
+    so all years (and materials, scenarios) are calculated at once. Years
+    with a NaN balance have no surplus, so the carry-forward restarts
+    after them.
 
     Parameters
     ----------
-    alpha : float
-        Shape parameter `alpha` for weibull distribution.
-    beta : float
-        Scale parameter `beta` for weibull distribution. Often exchanged with ``lifetime``
-        like in Irena 2016, beta = 30.
-    xlim : int
-        Number of years to calculate the distribution for. i.e. x-axis limit.
+    balance : numpy array
+        Material available minus material needed each year, without any
+        carry-forward. Year on the last axis.
 
     Returns
     -------
-    idf : list
-        List of weibull cumulative distribution values for year 0 until xlim.
+    carry : numpy array
+        Surplus of each year carried to the next year. The last year value
+        is the surplus at the end of the simulation.
+    '''
+
+    # The running sums cancel each other, so they are kept in float64
+    # whatever the precision of the flows.
+    dtype = np.asarray(balance).dtype
+    balance = np.asarray(balance, dtype=np.float64)
+    cumulative = np.cumsum(balance, axis=-1)
+    carry = cumulative - np.minimum(
+        np.minimum.accumulate(cumulative, axis=-1), 0)
+
+    restarts = np.isnan(balance)
+    if restarts.any():
+        # Rows with missing values are carried year by year.
+        rows = restarts.any(axis=-1)
+        partial = np.zeros(balance[rows].shape[:-1], dtype=balance.dtype)
+        rowscarry = np.zeros_like(balance[rows])
+        for year in range(balance.shape[-1]):
+            partial = partial + balance[rows][..., year]
+            partial = np.where(partial > 0, partial, 0)
+            rowscarry[..., year] = partial
+        carry[rows] = rowscarry
+
+    return carry.astype(dtype, copy=False)
+
+
+def _carryoverDerivative(carry, dbalance):
+    r'''
+    Derivatives of the surplus of ``_carryoverSurplus`` along derivatives
+    of its balance. The surplus follows the balance on the years it is
+    carried, and restarts from 0 on the others, the only kink of the
+    material flows:
+
+        dcarry[n] = dcarry[n-1] + dbalance[n]  if carry[n] > 0, else 0
+
+    Parameters
+    ----------
+    carry : numpy array
+        Surplus carried each year, as returned by ``_carryoverSurplus``.
+    dbalance : numpy array
+        Derivatives of the balance along D directions, of shape
+        (D,) + carry.shape.
 
+    Returns
+    -------
+    dcarry : numpy array
+        Derivatives of the surplus, same shape as ``dbalance``.
     '''
+    dbalance = np.asarray(dbalance)
+    dcarry = np.zeros_like(dbalance)
+    partial = 0.0
+    for year in range(carry.shape[-1]):
+        partial = np.where(carry[..., year] > 0,
+                           partial + dbalance[..., year], 0.0)
+        dcarry[..., year] = partial
+    return dcarry
+
+
+def _materialMassFlows(cohorts, inputs, matinputs, carryoverReMFG=True,
+                       carryoverVat=True, tangents=None):
+    r'''
+    Material mass flows for all the materials of a scenario at once. The
+    mass per m2 of the materials is stacked into a materials x generation
+    matrix, so each EOL pathway is a single matrix-matrix product with the
+    cohort matrices, and the rest of the material stage (landfills L0-L4,
+    reMFG, recycling yields, HQ/OQ splits and manufacturing scrap) is
+    calculated on materials x year arrays.
 
-    dfindex = pd.RangeIndex(0,xlim,1)
-    x = np.clip(dfindex - 0, 0, np.inf)
+    Parameters
+    ----------
+    cohorts : dict
+        Cohort area matrices 'area_PG', 'area_L0' and 'area_PB' of shape
+        (..., N, N), as returned by ``_cohortMassFlows``.
+    inputs : DataFrame or dict
+        Module inputs by year, including the calculated 'Area' [m2].
+    matinputs : dict
+        Material inputs (matdataIn_m columns) stacked as arrays of shape
+        (..., k, N) for k materials.
+    carryoverReMFG : bool
+        If True, surplus of successfully remanufactured material is carried
+        to the following years.
+    carryoverVat : bool
+        If True, surplus of recycled high quality material going back into
+        manufacturing is carried to the following years.
+    tangents : dict
+        Derivatives along D directions of any of the cohort matrices, the
+        module inputs, of shape (D, ..., N), and the material inputs, of
+        shape (D, ..., k, N). Missing ones have no derivatives. The
+        derivatives of the outputs are then carried along the flows.
 
-    if alpha and beta:
-        i = weibull_cdf(alpha, beta)
+    Returns
+    -------
+    dm : dict
+        Material outputs, arrays of shape (..., k, N).
+    surplusEndofSim : dict
+        'reMFG' and 'recycled' surplus left at the end of the simulation
+        for each material, arrays of shape (..., k).
+    ddm : dict
+        Only with ``tangents``: derivatives of the material outputs, arrays
+        of shape (D, ..., k, N).
+    '''
 
-    idf = list(map(i, x))
+    dtype = cohorts['area_PG'].dtype
 
-    return idf
+    def _field(key):
+        return np.asarray(inputs[key], dtype=dtype)[..., None, :]
+
+    mat = {key: np.asarray(value, dtype=dtype)
+           for key, value in matinputs.items()}
+
+    # SWITCH TO MASS UNITS FOR THE MATERIAL NOW:
+    # THIS IS DIFFERENT MULTIPLICATION THAN THE REST
+    # BECAUSE IT DEPENDS TO THE ORIGINAL MASS OF EACH MODULE
+    # WHEN INSTALLED
+    # [M1  * [  G1_1   G1_2    G1_3   G2_4 ...]
+    #  M2     [    0    G2_1    G2_2   G2_3 ...]
+    #  M3]    [    0      0     G3_1   G3_2 ...]
+    #
+    #           EQUAL
+    # mat_EOL_sentoRecycling =
+    #     [  G1_1*M1   G1_2*M1    G1_3*M1   G2_4*M1 ...]
+    #     [    0       G2_1*M2    G2_2*M2   G2_3*M2 ...]
+    #     [    0           0      G3_1*M3   G3_2*M3 ...]
+    #
+    # with all materials stacked as rows of the weights matrix.
+    if tangents is None:
+        matflows = _eolPathways(cohorts['area_PG'], cohorts['area_L0'],
+                                cohorts['area_PB'], inputs,
+                                weights=mat['mat_massperm2'])
+    else:
+        pathtangents = dict(tangents)
+        if 'mat_massperm2' in tangents:
+            pathtangents['weights'] = tangents['mat_massperm2']
+        matflows, dmatflows = _eolPathways(
+            cohorts['area_PG'], cohorts['area_L0'], cohorts['area_PB'],
+            inputs, weights=mat['mat_massperm2'], tangents=pathtangents)
+
+    dm = {}
+    dm['mat_L0'] = matflows['EOL_Landfill0']
+    dm['mat_PG2_stored'] = matflows['P2_stored']
+    dm['mat_L1'] = matflows['P1_landfill']
+
+    # PATH 3
+    dm['mat_reMFG'] = matflows['P3_reMFG_yield']
+    dm['mat_reMFG_mod_unyield'] = matflows['P3_reMFG_unyield']
+
+    dm['mat_reMFG_target'] = dm['mat_reMFG'] * mat['mat_PG3_ReMFG_target'] * 0.01
+    dm['mat_reMFG_untarget'] = dm['mat_reMFG']-dm['mat_reMFG_target']
+
+    dm['mat_reMFG_yield'] = dm['mat_reMFG_target'] * mat['mat_ReMFG_yield'] * 0.01
+    dm['mat_reMFG_unyield'] = dm['mat_reMFG_target'] - dm['mat_reMFG_yield']
+
+    # SUBPATH 1: ReMFG to Recycling
+    dm['mat_reMFG_all_unyields'] = dm['mat_reMFG_mod_unyield'] + dm['mat_reMFG_untarget'] + dm['mat_reMFG_unyield']
+    dm['mat_reMFG_2_recycle'] = dm['mat_reMFG_all_unyields'] * _field('mod_EOL_sp_reMFG_recycle') * 0.01
+    dm['mat_L2'] = dm['mat_reMFG_all_unyields']-dm['mat_reMFG_2_recycle']
+
+    # PATH 4
+    dm['mat_recycled_PG4'] = matflows['P4_recycled']
+    dm['mat_recycled_all'] = dm['mat_recycled_PG4'] + dm['mat_reMFG_2_recycle']
+
+    dm['mat_recycled_target'] = dm['mat_recycled_all'] * mat['mat_PG4_Recycling_target'] * 0.01
+    dm['mat_L3'] = dm['mat_recycled_all'] - dm['mat_recycled_target']  # material un-target
+
+    dm['mat_recycled_yield'] = dm['mat_recycled_target'] * mat['mat_Recycling_yield'] * 0.01
+    dm['mat_L4'] = dm['mat_recycled_target'] - dm['mat_recycled_yield']  # material un-target
+
+    # HQ and OQ reycling paths:
+    dm['mat_EOL_Recycled_2_HQ'] = dm['mat_recycled_yield'] * mat['mat_EOL_Recycled_into_HQ'] * 0.01
+    dm['mat_EOL_Recycled_2_OQ'] = dm['mat_recycled_yield'] - dm['mat_EOL_Recycled_2_HQ']
+
+    dm['mat_EOL_Recycled_HQ_into_MFG'] = dm['mat_EOL_Recycled_2_HQ'] * mat['mat_EOL_RecycledHQ_Reused4MFG'] * 0.01
+    dm['mat_EOL_Recycled_HQ_into_OU'] = dm['mat_EOL_Recycled_2_HQ'] - dm['mat_EOL_Recycled_HQ_into_MFG']
+
+    ## Beginning of Life Calculations Now
+    ######################################
+    dm['mat_EnteringModuleManufacturing_total'] = (_field('Area') * mat['mat_massperm2']*100/_field('mod_MFG_eff'))
+    dm['mat_UsedSuccessfullyinModuleManufacturing'] = (_field('Area') * mat['mat_massperm2'])
+    dm['mat_LostinModuleManufacturing'] = dm['mat_EnteringModuleManufacturing_total'] - dm['mat_UsedSuccessfullyinModuleManufacturing']
+
+    # Input from Successful ReMFG to offset Module Manufacturing Material Needs.
+    # Vat of the remanufactured yield, carrying the surplus of each year
+    # to the next one.
+    if carryoverReMFG:
+        reMFGcarry = _carryoverSurplus(
+            dm['mat_reMFG_yield'] -
+            dm['mat_EnteringModuleManufacturing_total'])
+        dm['mat_EOL_ReMFG_VAT'] = (dm['mat_reMFG_yield'] +
+                                   _previousYear(reMFGcarry) - reMFGcarry)
+        reMFGsurplusEndofSim = reMFGcarry[..., -1]
+    else:
+        dm['mat_EOL_ReMFG_VAT'] = dm['mat_reMFG_yield'].copy()
+        reMFGsurplusEndofSim = np.zeros(dm['mat_reMFG_yield'].shape[:-1])
+
+    # input from REMFG to offset material
+    dm['mat_EnteringModuleManufacturing_virgin'] = (
+        dm['mat_EnteringModuleManufacturing_total'] -
+        dm['mat_EOL_ReMFG_VAT'])
+
+    # Material Manufacturing Stage
+    dm['mat_Manufacturing_Input'] = dm['mat_EnteringModuleManufacturing_virgin'] / (mat['mat_MFG_eff'] * 0.01)
+
+    # Scrap = Lost to Material manufacturing losses + Module manufacturing losses
+    dm['mat_MFG_Scrap'] = (dm['mat_Manufacturing_Input'] - dm['mat_EnteringModuleManufacturing_virgin'] +
+                           dm['mat_LostinModuleManufacturing'])
+    dm['mat_MFG_Scrap_Sentto_Recycling'] = dm['mat_MFG_Scrap'] * mat['mat_MFG_scrap_Recycled'] * 0.01
+
+    dm['mat_MFG_Scrap_Landfilled'] = dm['mat_MFG_Scrap'] - dm['mat_MFG_Scrap_Sentto_Recycling']
+    dm['mat_MFG_Scrap_Recycled_Successfully'] = (dm['mat_MFG_Scrap_Sentto_Recycling'] *
+                                                 mat['mat_MFG_scrap_Recycling_eff'] * 0.01)
+    dm['mat_MFG_Scrap_Recycled_Losses_Landfilled'] = (dm['mat_MFG_Scrap_Sentto_Recycling'] -
+                                                      dm['mat_MFG_Scrap_Recycled_Successfully'])
+    dm['mat_MFG_Recycled_into_HQ'] = (dm['mat_MFG_Scrap_Recycled_Successfully'] *
+                                      mat['mat_MFG_scrap_Recycled_into_HQ'] * 0.01)
+    dm['mat_MFG_Recycled_into_OQ'] = dm['mat_MFG_Scrap_Recycled_Successfully'] - dm['mat_MFG_Recycled_into_HQ']
+    dm['mat_MFG_Recycled_HQ_into_MFG'] = (dm['mat_MFG_Recycled_into_HQ'] *
+                                          mat['mat_MFG_scrap_Recycled_into_HQ_Reused4MFG'] * 0.01)
+    dm['mat_MFG_Recycled_HQ_into_OU'] = dm['mat_MFG_Recycled_into_HQ'] - dm['mat_MFG_Recycled_HQ_into_MFG']
+
+    if carryoverVat:
+        # Previous years recycled material closes the loop, carrying the
+        # surplus over manufacturing needs of each year to the next one.
+        recycledcarry = _carryoverSurplus(
+            dm['mat_MFG_Recycled_HQ_into_MFG'] +  # mfg scrap in that year
+            dm['mat_EOL_Recycled_HQ_into_MFG'] -  # plus EOL scrap in that year
+            dm['mat_Manufacturing_Input'])  # minus mfging needs
+        dm['mat_EOL_Recycled_VAT'] = (dm['mat_EOL_Recycled_HQ_into_MFG'] +
+                                      _previousYear(recycledcarry) -
+                                      recycledcarry)
+        recycledsurplusEndofSim = recycledcarry[..., -1]
+
+        # Input from Successful Recycling to offset Material
+        # Manufacturing Virgin Needs:
+        dm['mat_Virgin_Stock'] = (dm['mat_Manufacturing_Input'] -
+                                  dm['mat_EOL_Recycled_VAT'] -
+                                  dm['mat_MFG_Recycled_HQ_into_MFG'])
+        # This is what goes into OU in the 'else' statement.
+        dm['mat_EOL_Recycled_HQ_into_MFG_notUSED'] = (
+            dm['mat_EOL_Recycled_HQ_into_MFG'] - dm['mat_EOL_Recycled_VAT'])
+    else:
+        dm['mat_EOL_Recycled_VAT'] = dm['mat_EOL_Recycled_HQ_into_MFG'].copy()
+        recycledsurplusEndofSim = np.zeros(
+            dm['mat_Manufacturing_Input'].shape[:-1])
+        # Input from Successful Recycling to offset Material
+        # Manufacturing Virgin Needs:
+        dm['mat_Virgin_Stock'] = (dm['mat_Manufacturing_Input'] -
+                                  dm['mat_EOL_Recycled_HQ_into_MFG'] -
+                                  dm['mat_MFG_Recycled_HQ_into_MFG'])
+
+        # TO DO: rename 2 to original one, just using it for the
+        # sanity check
+        negative = dm['mat_Virgin_Stock'] < 0
+        dm['mat_MFG_Recycled_HQ_into_OU2'] = np.where(
+            negative,
+            dm['mat_MFG_Recycled_HQ_into_OU'] - dm['mat_Virgin_Stock'],
+            dm['mat_MFG_Recycled_HQ_into_OU'])
+        dm['mat_Virgin_Stock'] = np.where(negative, 0.0,
+                                          dm['mat_Virgin_Stock'])
+
+    # Calculate raw virgin needs before mining and refining efficiency losses
+    dm['mat_Virgin_Stock_Raw'] = (dm['mat_Virgin_Stock'] * 100 / mat['mat_virgin_eff'])
+
+    # Add Wastes
+    dm['mat_Total_EOL_Landfilled'] = (dm['mat_L0'] +  # 'mat_modules_NotCollected'] +
+                                      dm['mat_L1'] +  # 'mat Path Good Chosen to be Landfilled +
+                                      dm['mat_L2'] +  # mat not reMFG (yields module, target, or yieldds matr) NOT sent to recycling
+                                      dm['mat_L3'] +  # mat in recycling not TARGET so landfilled +
+                                      dm['mat_L4'])  # mat in EOL_Recycled_Losses_Landfilled
+
+    dm['mat_Total_MFG_Landfilled'] = (dm['mat_MFG_Scrap_Landfilled'] +
+                                      dm['mat_MFG_Scrap_Recycled_Losses_Landfilled'])
+
+    dm['mat_Total_Landfilled'] = (dm['mat_Total_EOL_Landfilled'] +
+                                  dm['mat_Total_MFG_Landfilled'])
+
+    dm['mat_Total_Recycled_OU'] = (dm['mat_EOL_Recycled_2_OQ'] +
+                                   dm['mat_EOL_Recycled_HQ_into_OU'] +
+                                   dm['mat_MFG_Recycled_into_OQ'] +
+                                   dm['mat_MFG_Recycled_HQ_into_OU'])
+
+    surplusEndofSim = {'reMFG': reMFGsurplusEndofSim,
+                       'recycled': recycledsurplusEndofSim}
+    if tangents is None:
+        return dm, surplusEndofSim
+
+    # Same flows on the derivatives, by the product rule
+    def _dinput(key):
+        if key not in tangents:
+            return 0.0
+        value = np.asarray(tangents[key], dtype=dtype)
+        return value if key in mat else value[..., None, :]
+
+    def _dpercent(key, factor):
+        # Derivative of dm[key]*factor*0.01
+        value = mat[factor] if factor in mat else _field(factor)
+        return (ddm[key]*value + dm[key]*_dinput(factor))*0.01
+
+    def _dquotient(key, dnumerator, denominator):
+        # Derivative of dm[key] = numerator/denominator
+        return (dnumerator - dm[key]*_dinput(denominator))/(
+            mat[denominator] if denominator in mat else _field(denominator))
+
+    ddm = {}
+    ddm['mat_L0'] = dmatflows['EOL_Landfill0']
+    ddm['mat_PG2_stored'] = dmatflows['P2_stored']
+    ddm['mat_L1'] = dmatflows['P1_landfill']
+
+    ddm['mat_reMFG'] = dmatflows['P3_reMFG_yield']
+    ddm['mat_reMFG_mod_unyield'] = dmatflows['P3_reMFG_unyield']
+    ddm['mat_reMFG_target'] = _dpercent('mat_reMFG', 'mat_PG3_ReMFG_target')
+    ddm['mat_reMFG_untarget'] = ddm['mat_reMFG'] - ddm['mat_reMFG_target']
+    ddm['mat_reMFG_yield'] = _dpercent('mat_reMFG_target', 'mat_ReMFG_yield')
+    ddm['mat_reMFG_unyield'] = (ddm['mat_reMFG_target'] -
+                                ddm['mat_reMFG_yield'])
+
+    ddm['mat_reMFG_all_unyields'] = (ddm['mat_reMFG_mod_unyield'] +
+                                     ddm['mat_reMFG_untarget'] +
+                                     ddm['mat_reMFG_unyield'])
+    ddm['mat_reMFG_2_recycle'] = _dpercent('mat_reMFG_all_unyields',
+                                           'mod_EOL_sp_reMFG_recycle')
+    ddm['mat_L2'] = ddm['mat_reMFG_all_unyields'] - ddm['mat_reMFG_2_recycle']
+
+    ddm['mat_recycled_PG4'] = dmatflows['P4_recycled']
+    ddm['mat_recycled_all'] = (ddm['mat_recycled_PG4'] +
+                               ddm['mat_reMFG_2_recycle'])
+    ddm['mat_recycled_target'] = _dpercent('mat_recycled_all',
+                                           'mat_PG4_Recycling_target')
+    ddm['mat_L3'] = ddm['mat_recycled_all'] - ddm['mat_recycled_target']
+    ddm['mat_recycled_yield'] = _dpercent('mat_recycled_target',
+                                          'mat_Recycling_yield')
+    ddm['mat_L4'] = ddm['mat_recycled_target'] - ddm['mat_recycled_yield']
+
+    ddm['mat_EOL_Recycled_2_HQ'] = _dpercent('mat_recycled_yield',
+                                             'mat_EOL_Recycled_into_HQ')
+    ddm['mat_EOL_Recycled_2_OQ'] = (ddm['mat_recycled_yield'] -
+                                    ddm['mat_EOL_Recycled_2_HQ'])
+    ddm['mat_EOL_Recycled_HQ_into_MFG'] = _dpercent(
+        'mat_EOL_Recycled_2_HQ', 'mat_EOL_RecycledHQ_Reused4MFG')
+    ddm['mat_EOL_Recycled_HQ_into_OU'] = (ddm['mat_EOL_Recycled_2_HQ'] -
+                                          ddm['mat_EOL_Recycled_HQ_into_MFG'])
+
+    ddm['mat_UsedSuccessfullyinModuleManufacturing'] = (
+        _field('Area')*_dinput('mat_massperm2'))
+    ddm['mat_EnteringModuleManufacturing_total'] = _dquotient(
+        'mat_EnteringModuleManufacturing_total',
+        ddm['mat_UsedSuccessfullyinModuleManufacturing']*100, 'mod_MFG_eff')
+    ddm['mat_LostinModuleManufacturing'] = (
+        ddm['mat_EnteringModuleManufacturing_total'] -
+        ddm['mat_UsedSuccessfullyinModuleManufacturing'])
+
+    if carryoverReMFG:
+        dcarry = _carryoverDerivative(
+            reMFGcarry, ddm['mat_reMFG_yield'] -
+            ddm['mat_EnteringModuleManufacturing_total'])
+        ddm['mat_EOL_ReMFG_VAT'] = (ddm['mat_reMFG_yield'] +
+                                    _previousYear(dcarry) - dcarry)
+    else:
+        ddm['mat_EOL_ReMFG_VAT'] = ddm['mat_reMFG_yield']
+    ddm['mat_EnteringModuleManufacturing_virgin'] = (
+        ddm['mat_EnteringModuleManufacturing_total'] -
+        ddm['mat_EOL_ReMFG_VAT'])
+
+    ddm['mat_Manufacturing_Input'] = _dquotient(
+        'mat_Manufacturing_Input',
+        ddm['mat_EnteringModuleManufacturing_virgin']*100, 'mat_MFG_eff')
+    ddm['mat_MFG_Scrap'] = (ddm['mat_Manufacturing_Input'] -
+                            ddm['mat_EnteringModuleManufacturing_virgin'] +
+                            ddm['mat_LostinModuleManufacturing'])
+    ddm['mat_MFG_Scrap_Sentto_Recycling'] = _dpercent(
+        'mat_MFG_Scrap', 'mat_MFG_scrap_Recycled')
+    ddm['mat_MFG_Scrap_Landfilled'] = (ddm['mat_MFG_Scrap'] -
+                                       ddm['mat_MFG_Scrap_Sentto_Recycling'])
+    ddm['mat_MFG_Scrap_Recycled_Successfully'] = _dpercent(
+        'mat_MFG_Scrap_Sentto_Recycling', 'mat_MFG_scrap_Recycling_eff')
+    ddm['mat_MFG_Scrap_Recycled_Losses_Landfilled'] = (
+        ddm['mat_MFG_Scrap_Sentto_Recycling'] -
+        ddm['mat_MFG_Scrap_Recycled_Successfully'])
+    ddm['mat_MFG_Recycled_into_HQ'] = _dpercent(
+        'mat_MFG_Scrap_Recycled_Successfully',
+        'mat_MFG_scrap_Recycled_into_HQ')
+    ddm['mat_MFG_Recycled_into_OQ'] = (
+        ddm['mat_MFG_Scrap_Recycled_Successfully'] -
+        ddm['mat_MFG_Recycled_into_HQ'])
+    ddm['mat_MFG_Recycled_HQ_into_MFG'] = _dpercent(
+        'mat_MFG_Recycled_into_HQ',
+        'mat_MFG_scrap_Recycled_into_HQ_Reused4MFG')
+    ddm['mat_MFG_Recycled_HQ_into_OU'] = (
+        ddm['mat_MFG_Recycled_into_HQ'] - ddm['mat_MFG_Recycled_HQ_into_MFG'])
+
+    if carryoverVat:
+        dcarry = _carryoverDerivative(
+            recycledcarry, ddm['mat_MFG_Recycled_HQ_into_MFG'] +
+            ddm['mat_EOL_Recycled_HQ_into_MFG'] -
+            ddm['mat_Manufacturing_Input'])
+        ddm['mat_EOL_Recycled_VAT'] = (ddm['mat_EOL_Recycled_HQ_into_MFG'] +
+                                       _previousYear(dcarry) - dcarry)
+        ddm['mat_Virgin_Stock'] = (ddm['mat_Manufacturing_Input'] -
+                                   ddm['mat_EOL_Recycled_VAT'] -
+                                   ddm['mat_MFG_Recycled_HQ_into_MFG'])
+        ddm['mat_EOL_Recycled_HQ_into_MFG_notUSED'] = (
+            ddm['mat_EOL_Recycled_HQ_into_MFG'] - ddm['mat_EOL_Recycled_VAT'])
+    else:
+        ddm['mat_EOL_Recycled_VAT'] = ddm['mat_EOL_Recycled_HQ_into_MFG']
+        ddm['mat_Virgin_Stock'] = (ddm['mat_Manufacturing_Input'] -
+                                   ddm['mat_EOL_Recycled_HQ_into_MFG'] -
+                                   ddm['mat_MFG_Recycled_HQ_into_MFG'])
+        # Virgin needs clipped at 0 go to other uses
+        ddm['mat_MFG_Recycled_HQ_into_OU2'] = np.where(
+            negative, ddm['mat_MFG_Recycled_HQ_into_OU'] -
+            ddm['mat_Virgin_Stock'], ddm['mat_MFG_Recycled_HQ_into_OU'])
+        ddm['mat_Virgin_Stock'] = np.where(negative, 0.0,
+                                           ddm['mat_Virgin_Stock'])
+
+    ddm['mat_Virgin_Stock_Raw'] = _dquotient(
+        'mat_Virgin_Stock_Raw', ddm['mat_Virgin_Stock']*100, 'mat_virgin_eff')
+
+    ddm['mat_Total_EOL_Landfilled'] = (ddm['mat_L0'] + ddm['mat_L1'] +
+                                       ddm['mat_L2'] + ddm['mat_L3'] +
+                                       ddm['mat_L4'])
+    ddm['mat_Total_MFG_Landfilled'] = (
+        ddm['mat_MFG_Scrap_Landfilled'] +
+        ddm['mat_MFG_Scrap_Recycled_Losses_Landfilled'])
+    ddm['mat_Total_Landfilled'] = (ddm['mat_Total_EOL_Landfilled'] +
+                                   ddm['mat_Total_MFG_Landfilled'])
+    ddm['mat_Total_Recycled_OU'] = (ddm['mat_EOL_Recycled_2_OQ'] +
+                                    ddm['mat_EOL_Recycled_HQ_into_OU'] +
+                                    ddm['mat_MFG_Recycled_into_OQ'] +
+                                    ddm['mat_MFG_Recycled_HQ_into_OU'])
+
+    # Derivatives not depending on any direction are broadcast to all
+    ndirections = next(iter(tangents.values())).shape[0]
+    ddm = {key: np.nan_to_num(np.broadcast_to(
+        value, (ndirections,) + dm[key].shape)) for key, value in ddm.items()}
+
+    return dm, surplusEndofSim, ddm
 
 
 def sens_StageImprovement(df, stage, improvement=1.3, start_year=None):
@@ -12,8 +12,15 @@ to run coverage tests, run py.test --cov-report term-missing --cov=PV_ICE
 
 import PV_ICE
 import numpy as np
+import pandas as pd
 import pytest
 import os
+import json
+import shutil
+import socket
+import subprocess
+import sys
+import time
 
 
 # try navigating to tests directory so tests run from here.
@@ -89,3 +96,869 @@ def test_landfilledArea_vs_AreafromWaste():
     A = A*2 # convert to area if each module is ~2 m2
     A = A*1e-6 # Convert to km 2
     assert (round(A,0) == (round(B,0))) 
+
+
+def test_cohort_area_conservation():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.scenario['standard'].dataIn_m['mod_MerchantTail'] = 30.0
+    r1.scenario['standard'].dataIn_m['mod_EOL_pg0_resell'] = 20.0
+    r1.scenario['standard'].dataIn_m['mod_EOL_pg4_recycled'] = 80.0
+    r1.scenario['standard'].dataIn_m['mod_Repair'] = 25.0
+    r1.calculateMassFlow()
+    data = r1.scenario['standard'].dataOut_m
+    # Everything installed is either still active or has reached EOL, since
+    # repaired, resold and merchant tail modules go back to active.
+    installed = data['Area'].sum()
+    eol = data['Yearly_Sum_Area_atEOL'].sum()
+    active = data['Cumulative_Active_Area'].iloc[-1]
+    assert installed == pytest.approx(eol + active)
+
+
+def test_weibull_table_cache():
+    from PV_ICE.main import _weibullTable, _weibullPDFs
+    cdf, pdf = _weibullTable(5.3759, 30.0, 50)
+    # Same parameters and horizon reuse the cached table
+    assert _weibullTable(5.3759, 30.0, 50)[1] is pdf
+    assert not pdf.flags.writeable
+    np.testing.assert_allclose(cdf, PV_ICE.weibull_cdf(5.3759, 30.0)(np.arange(50.)))
+    np.testing.assert_allclose(pdf.sum(), cdf[-1])
+    pdfs = _weibullPDFs([5.3759, 2.4928, 5.3759], [30.0, 30.0, 30.0], 50)
+    assert pdfs.shape == (3, 50)
+    np.testing.assert_array_equal(pdfs[0], pdfs[2])
+
+
+def test_weibull_cache_size(monkeypatch):
+    from PV_ICE.main import _weibullTable
+    # The cache size is read on each call, not at import
+    monkeypatch.setattr(PV_ICE.main, 'WEIBULL_CACHE_SIZE', 1)
+    pdf = _weibullTable(5.3759, 30.0, 50)[1]
+    assert _weibullTable(5.3759, 30.0, 50)[1] is pdf
+    _weibullTable(2.4928, 30.0, 50)
+    assert _weibullTable(5.3759, 30.0, 50)[1] is not pdf
+    _weibullTable.cache_clear()
+
+
+def test_eol_pathways_fused():
+    from PV_ICE.main import _eolPathways
+    rng = np.random.default_rng(42)
+    N = 12
+    PG, L0, PB = (np.triu(rng.random((N, N))) for _ in range(3))
+    inputs = {key: rng.uniform(0, 25, N) for key in
+              ['mod_EOL_pg0_resell', 'mod_EOL_pg1_landfill', 'mod_EOL_pg2_stored',
+               'mod_EOL_pg3_reMFG', 'mod_EOL_pg4_recycled', 'mod_EOL_pb1_landfill',
+               'mod_EOL_pb3_reMFG', 'mod_EOL_pb4_recycled']}
+    inputs['mod_EOL_collection_eff'] = rng.uniform(0, 100, N)
+    inputs['mod_EOL_reMFG_yield'] = rng.uniform(0, 100, N)
+    massperm2 = rng.uniform(1, 100, (2, N))
+    flows = _eolPathways(PG, L0, PB, inputs)
+    matflows = _eolPathways(PG, L0, PB, inputs, weights=massperm2)
+
+    # Same as building each of the generation x year pathway matrices
+    PBC = PB*inputs['mod_EOL_collection_eff']*0.01
+    PGrescaled = PG*(100/(100-inputs['mod_EOL_pg0_resell']))[:, None]
+    P4 = (PGrescaled*inputs['mod_EOL_pg4_recycled']*0.01 +
+          PBC*inputs['mod_EOL_pb4_recycled']*0.01)
+    np.testing.assert_allclose(flows['EOL_Landfill0'], (L0 + PB - PBC).sum(axis=0))
+    np.testing.assert_allclose(flows['EOL_PATHS'], (PBC + PG).sum(axis=0))
+    np.testing.assert_allclose(flows['P4_recycled'], P4.sum(axis=0))
+    np.testing.assert_allclose(matflows['P4_recycled'], massperm2 @ P4)
+
+
+def test_eol_pathways_nan():
+    from PV_ICE.main import _eolPathways
+    rng = np.random.default_rng(1)
+    N = 12
+    PG, L0, PB = (np.triu(rng.random((N, N))) for _ in range(3))
+    inputs = {key: rng.uniform(0, 25, N) for key in
+              ['mod_EOL_pg0_resell', 'mod_EOL_pg1_landfill', 'mod_EOL_pg2_stored',
+               'mod_EOL_pg3_reMFG', 'mod_EOL_pg4_recycled', 'mod_EOL_pb1_landfill',
+               'mod_EOL_pb3_reMFG', 'mod_EOL_pb4_recycled']}
+    inputs['mod_EOL_collection_eff'] = rng.uniform(0, 100, N)
+    inputs['mod_EOL_reMFG_yield'] = rng.uniform(0, 100, N)
+    inputs['mod_EOL_collection_eff'][4] = np.nan
+    inputs['mod_EOL_pg0_resell'][2] = np.nan
+    inputs['mod_EOL_reMFG_yield'][7] = np.nan
+    flows = _eolPathways(PG, L0, PB, inputs)
+
+    # Blank cells are skipped by the pandas sums of the pathway matrices
+    PG, L0, PB = (pd.DataFrame(matrix) for matrix in (PG, L0, PB))
+    PBC = PB.mul(inputs['mod_EOL_collection_eff']*0.01)
+    PGrescaled = PG.mul(100/(100-inputs['mod_EOL_pg0_resell']), axis=0)
+    PG3 = PGrescaled.mul(inputs['mod_EOL_pg3_reMFG']*0.01)
+    PG3_yield = PG3.mul(inputs['mod_EOL_reMFG_yield']*0.01)
+    np.testing.assert_allclose(flows['EOL_Landfill0'], (L0 + PB - PBC).sum())
+    np.testing.assert_allclose(flows['EOL_PATHS'], (PBC + PG).sum())
+    np.testing.assert_allclose(flows['PG3_reMFG_yield'], PG3_yield.sum())
+    np.testing.assert_allclose(flows['PG3_reMFG_unyield'],
+                               (PG3 - PG3_yield).sum())
+
+    # A blank path input year blanks its pathways on that year, which are
+    # summed to 0, and every output stays finite
+    results = []
+    for value in [np.nan, 0.0]:
+        r1 = PV_ICE.Simulation()
+        r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+        r1.scenario['standard'].addMaterial('glass',
+                                            massmatfile=MATERIALBASELINE)
+        r1.scenario['standard'].dataIn_m.loc[35, 'mod_EOL_pb4_recycled'] = value
+        r1.calculateMassFlow()
+        results.append([r1.scenario['standard'].dataOut_m,
+                        r1.scenario['standard'].material['glass'].matdataOut_m])
+    for df in results[0]:
+        assert not df.select_dtypes('number').isna().any().any()
+    blank, zero = results[0][0], results[1][0]
+    assert blank.loc[35, 'PB4_recycled'] == blank.loc[35, 'P4_recycled'] == 0
+    assert zero.loc[35, 'P4_recycled'] > 0
+    pd.testing.assert_frame_equal(blank.drop(columns='P4_recycled'),
+                                  zero.drop(columns='P4_recycled'))
+
+
+@pytest.fixture
+def tmp_cwd(tmp_path, monkeypatch):
+    # Runs in tmp_path with copies of the test baselines, so the raw copies
+    # of the materials added are not written to the tests folder.
+    for file in [MODULEBASELINE, MATERIALBASELINE]:
+        shutil.copy(os.path.join(TESTDIR, file), tmp_path)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_materials_stacked_vs_single(tmp_cwd):
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.scenario['standard'].addMaterial('glass2', massmatfile=MATERIALBASELINE)
+    r1.scenario['standard'].material['glass2'].matdataIn_m['mat_massperm2'] *= 3
+    r1.calculateMassFlow()
+    stacked = r1.scenario['standard'].material['glass2'].matdataOut_m
+    r1.calculateMassFlow(materials='glass2')
+    single = r1.scenario['standard'].material['glass2'].matdataOut_m
+    np.testing.assert_allclose(stacked.values, single.values, atol=1e-3)
+    np.testing.assert_allclose(
+        stacked['mat_Total_Landfilled'],
+        3*r1.scenario['standard'].material['glass'].matdataOut_m['mat_Total_Landfilled'],
+        atol=1e-3)
+
+
+def test_carryover_surplus_scan():
+    from PV_ICE.main import _carryoverSurplus
+    rng = np.random.default_rng(7)
+    balance = rng.normal(0, 10, (3, 40))
+    balance[2, 15] = np.nan
+
+    expected = np.zeros_like(balance)
+    for row in range(balance.shape[0]):
+        carry = 0
+        for year in range(balance.shape[1]):
+            carry = carry + balance[row, year]
+            carry = carry if carry > 0 else 0
+            expected[row, year] = carry
+    np.testing.assert_allclose(_carryoverSurplus(balance), expected,
+                               atol=1e-9)
+
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.calculateMassFlow(carryoverVat=False, carryoverReMFG=False)
+    matdf = r1.scenario['standard'].material['glass'].matdataOut_m
+    assert (matdf['mat_Virgin_Stock'] >= 0).all()
+    np.testing.assert_allclose(matdf['mat_EOL_Recycled_VAT'],
+                               matdf['mat_EOL_Recycled_HQ_into_MFG'])
+
+
+def test_degradation_retirement_age():
+    from PV_ICE.main import _degradationRetirementAge
+    nyears = 60
+    mod_degradation = np.concatenate([np.linspace(0, 5, 501),
+                                      [-0.5, 50, 100, 120, np.nan]])
+    degbase = 1-mod_degradation*0.01
+    for limit in [0.8, 0.5]:
+        expected = np.full(degbase.shape, nyears)
+        for ii, base in enumerate(degbase):
+            for age in range(1, nyears):
+                if base**age < limit:
+                    expected[ii] = age
+                    break
+        np.testing.assert_array_equal(
+            _degradationRetirementAge(degbase, limit, nyears), expected)
+
+
+def test_cohort_matrix_packed():
+    rng = np.random.default_rng(3)
+    N = 10
+    dense = np.triu(rng.random((2, N, N)))
+    packed = PV_ICE.CohortMatrix.fromDense(dense)
+    assert packed.data.shape == (2, N*(N+1)//2)
+    np.testing.assert_array_equal(packed.toDense(), dense)
+    np.testing.assert_allclose(packed.colsum(), dense.sum(axis=-2))
+    weights = rng.random((2, 3, N))
+    np.testing.assert_allclose(packed.colsum(weights), weights @ dense)
+
+    # Band-limited to 4 ages
+    banded = PV_ICE.CohortMatrix.fromDense(dense, bandwidth=4)
+    np.testing.assert_array_equal(banded.toDense(),
+                                  np.triu(np.tril(dense, 3)))
+    np.testing.assert_array_equal(banded.age(2), dense[:, np.arange(N-2),
+                                                       np.arange(2, N)])
+
+
+def test_float32_engine():
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        r1 = PV_ICE.Simulation(dtype=dtype)
+        r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+        r1.scenario['standard'].addMaterial('glass',
+                                            massmatfile=MATERIALBASELINE)
+        r1.calculateMassFlow(debugflag=True)
+        results[dtype] = [r1.scenario['standard'].dataOut_m,
+                          r1.scenario['standard'].material['glass'].matdataOut_m]
+
+    for df64, df32 in zip(results[np.float64], results[np.float32]):
+        cols = df64.select_dtypes(include='number').columns
+        assert (df32[cols].dtypes == np.float32).all()
+        ref = df64[cols].values
+        error = np.nanmax(np.abs(df32[cols].values - ref), axis=0)
+        peak = np.nanmax(np.abs(ref), axis=0)
+        assert (error < 1e-6*peak.max()).all()
+        flows = peak >= 1e-3*peak.max()
+        assert (error[flows] < 1e-5*peak[flows]).all()
+
+    debug = r1.scenario['standard'].dataDebug_m
+    assert set(debug.dtypes) == {np.dtype(np.float32), np.dtype(np.int64)}
+
+
+def test_cohort_pruning():
+    from PV_ICE.main import _cohortMassFlows
+    N = 120
+    inputs = dict(area=np.linspace(0, 3, N), mod_eff=np.full(N, 20.0),
+                  irradiance_stc=np.full(N, 1000.0),
+                  mod_degradation=np.full(N, 0.5),
+                  mod_lifetime=np.full(N, 30.0),
+                  weibullalpha=np.full(N, 5.0), weibullbeta=np.full(N, 40.0),
+                  mod_EOL_collection_eff=np.full(N, 80.0),
+                  mod_MerchantTail=np.full(N, 10.0),
+                  mod_EOL_pg0_resell=np.zeros(N), mod_Repair=np.zeros(N))
+    exact, _ = _cohortMassFlows(**inputs)
+    pruned, _ = _cohortMassFlows(**inputs, prunearea=1.0)
+    # Generations installed with less than 1 m2 are not tracked
+    small = inputs['area'] <= 1.0
+    assert small.any()
+    np.testing.assert_allclose(pruned['area_active'][:N//3],
+                               inputs['area'][:N//3])
+    assert (pruned['area_PG'] <= exact['area_PG'] + 1e-9).all()
+
+    # Area is conserved, with the area of the pruned generations reported
+    # on the year they leave
+    assert (exact['area_pruned'] == 0).all()
+    for yearly in [exact, pruned]:
+        eol = (yearly['area_failure'] + yearly['area_projLife'] +
+               yearly['area_degradation'])
+        np.testing.assert_allclose(
+            np.cumsum(inputs['area']),
+            np.cumsum(eol + yearly['area_pruned']) + yearly['area_active'])
+    # Active area lost is at most the area pruned so far
+    lost = exact['area_active'] - pruned['area_active']
+    assert (lost >= -1e-9).all()
+    assert (lost <= np.cumsum(pruned['area_pruned']) + 1e-9).all()
+    assert 0 < pruned['area_pruned'].sum() <= 1.0*N
+
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.scenario['standard'].dataIn_m['mod_MerchantTail'] = 30.0
+    r1.calculateMassFlow(prunearea=5e5)
+    data = r1.scenario['standard'].dataOut_m
+    assert data['Yearly_Sum_Area_Pruned'].sum() > 0
+    assert data['Area'].sum() == pytest.approx(
+        data['Yearly_Sum_Area_atEOL'].sum() +
+        data['Yearly_Sum_Area_Pruned'].sum() +
+        data['Cumulative_Active_Area'].iloc[-1])
+
+
+def test_dataDebug_lazy():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.calculateMassFlow()
+    assert not hasattr(r1.scenario['standard'], 'dataDebug_m')
+
+    r1.calculateMassFlow(debugflag=True)
+    scen = r1.scenario['standard']
+    assert not scen.dataOut_m.filter(regex='EOL_PG_Year_').columns.size
+    assert '_dataDebug_m' not in scen.__dict__
+    data = scen.dataDebug_m
+    N = len(scen.dataIn_m)
+    assert data.shape == (N, 3*N)
+    np.testing.assert_allclose(
+        data.filter(regex='EOL_PG_Year_').sum(axis=0).values,
+        scen.dataOut_m['Yearly_Sum_Area_PathsGood'].values)
+    assert scen.dataDebug_m is data
+    # Path good columns of years before any project lifetime end are
+    # integer, as the matrices built from lists of the yearly values were
+    first = int((scen.dataIn_m['mod_lifetime'] + np.arange(N)).min())
+    assert (data.filter(regex='EOL_PG_Year_').dtypes.iloc[:first]
+            == 'int64').all()
+    assert data['EOL_PG_Year_'+str(first)].dtype == 'float64'
+
+
+def test_batched_scenarios():
+    r1 = PV_ICE.Simulation()
+    for scen, lifetime in [('short', 15.0), ('standard', None),
+                           ('long', 45.0)]:
+        r1.createScenario(scen, massmodulefile=MODULEBASELINE)
+        r1.scenario[scen].addMaterial('glass', massmatfile=MATERIALBASELINE)
+        if lifetime:
+            r1.scenario[scen].dataIn_m['mod_lifetime'] = lifetime
+    r1.scenario['long'].dataIn_m['mod_Repair'] = 30.0
+    # Fewer years run on their own batch
+    r1.createScenario('trimmed', massmodulefile=MODULEBASELINE)
+    r1.scenario['trimmed'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.scenario['trimmed'].dataIn_m = r1.scenario['trimmed'].dataIn_m.iloc[:40]
+    r1.scenario['trimmed'].material['glass'].matdataIn_m = (
+        r1.scenario['trimmed'].material['glass'].matdataIn_m.iloc[:40])
+
+    r1.calculateMassFlow()
+    batched = {scen: (r1.scenario[scen].dataOut_m.copy(),
+                      r1.scenario[scen].material['glass'].matdataOut_m.copy())
+               for scen in r1.scenario}
+    for scen in r1.scenario:
+        r1.calculateMassFlow(scenarios=scen)
+        pd.testing.assert_frame_equal(batched[scen][0],
+                                      r1.scenario[scen].dataOut_m)
+        pd.testing.assert_frame_equal(
+            batched[scen][1], r1.scenario[scen].material['glass'].matdataOut_m)
+    assert len(batched['trimmed'][0]) == 40
+
+
+def test_parallel_scenarios():
+    r1 = PV_ICE.Simulation()
+    for scen, lifetime in [('short', 15.0), ('standard', None),
+                           ('long', 45.0)]:
+        r1.createScenario(scen, massmodulefile=MODULEBASELINE)
+        r1.scenario[scen].addMaterial('glass', massmatfile=MATERIALBASELINE)
+        if lifetime:
+            r1.scenario[scen].dataIn_m['mod_lifetime'] = lifetime
+
+    r1.calculateMassFlow(n_jobs=2, debugflag=True)
+    parallel = {scen: (r1.scenario[scen].dataOut_m.copy(),
+                       r1.scenario[scen].material['glass'].matdataOut_m.copy(),
+                       r1.scenario[scen].dataDebug_m.copy())
+                for scen in r1.scenario}
+    r1.calculateMassFlow(debugflag=True)
+    for scen in r1.scenario:
+        pd.testing.assert_frame_equal(parallel[scen][0],
+                                      r1.scenario[scen].dataOut_m)
+        pd.testing.assert_frame_equal(
+            parallel[scen][1], r1.scenario[scen].material['glass'].matdataOut_m)
+        pd.testing.assert_frame_equal(parallel[scen][2],
+                                      r1.scenario[scen].dataDebug_m)
+
+
+def test_shared_memory_frames():
+    frames = {('a', None, 'dataIn_m'): pd.DataFrame(
+                  {'year': [2000, 2001, 2002], 'x': [0.5, 1.5, 2.5],
+                   'name': ['p', 'q', 'r']}),
+              ('a', 'glass', 'matdataIn_m'): pd.DataFrame(
+                  {'y': np.arange(4, dtype=np.float32)}, index=[3, 4, 5, 6])}
+    shm, layout = PV_ICE.main._packFrames(frames)
+    try:
+        unpacked = PV_ICE.main._unpackFrames(shm, layout)
+        for key, df in frames.items():
+            pd.testing.assert_frame_equal(unpacked[key], df)
+        assert np.shares_memory(
+            unpacked[('a', None, 'dataIn_m')]['x'].to_numpy(),
+            np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf))
+        del unpacked, df
+    finally:
+        shm.close()
+        shm.unlink()
+
+    r1 = PV_ICE.Simulation()
+    for scen in ['standard', 'short']:
+        r1.createScenario(scen, massmodulefile=MODULEBASELINE)
+        r1.scenario[scen].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.scenario['short'].dataIn_m['mod_lifetime'] = 15.0
+    r1.calculateMassFlow(n_jobs=2, sharedmemory=True)
+    shared = {scen: r1.scenario[scen].dataOut_m.copy()
+              for scen in r1.scenario}
+    r1.calculateMassFlow()
+    for scen in r1.scenario:
+        pd.testing.assert_frame_equal(shared[scen],
+                                      r1.scenario[scen].dataOut_m)
+
+
+def test_material_threads(tmp_cwd):
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    for mat in ['glass', 'glass_2', 'glass_3']:
+        r1.scenario['standard'].addMaterial(mat, massmatfile=MATERIALBASELINE)
+    r1.scenario['standard'].material['glass_2'].matdataIn_m[
+        'mat_EOL_collected_Recycled'] = 50.0
+
+    r1.calculateMassFlow(n_threads=2)
+    threaded = {mat: material.matdataOut_m.copy()
+                for mat, material in r1.scenario['standard'].material.items()}
+    r1.calculateMassFlow()
+    for mat, material in r1.scenario['standard'].material.items():
+        pd.testing.assert_frame_equal(threaded[mat], material.matdataOut_m)
+
+
+def test_clone_scenario():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.calculateMassFlow()
+    original = r1.scenario['standard'].dataIn_m.copy()
+    originalmat = r1.scenario['standard'].material['glass'].matdataIn_m.copy()
+
+    # Clones own their inputs for any write
+    r1.cloneScenario('standard', 'owned')
+    owned = r1.scenario['owned']
+    assert owned.name == 'owned'
+    assert not hasattr(owned, 'dataOut_m')
+    owned.dataIn_m.loc[5:10, 'mod_lifetime'] = 3.0
+    owned.dataIn_m.iloc[0, 1] = 0
+    owned.material['glass'].matdataIn_m.loc[:, 'mat_virgin_eff'] = 50.0
+    owned.metdataIn_m['year'] = 'edited'
+    pd.testing.assert_frame_equal(r1.scenario['standard'].dataIn_m, original)
+    pd.testing.assert_frame_equal(
+        r1.scenario['standard'].material['glass'].matdataIn_m, originalmat)
+    assert r1.scenario['standard'].metdataIn_m['year'] != 'edited'
+
+    # Shared columns are only copied by the modify methods
+    r1.cloneScenario('standard', 'clone', share=True)
+    clone = r1.scenario['clone']
+    assert np.shares_memory(clone.dataIn_m['mod_lifetime'].values,
+                            r1.scenario['standard'].dataIn_m['mod_lifetime'].values)
+    r1.modifyScenario('clone', 'mod_lifetime', 30.0, start_year=1995)
+    clone.modifyMaterials('glass', 'mat_virgin_eff', 50.0, start_year=1995)
+    pd.testing.assert_frame_equal(r1.scenario['standard'].dataIn_m, original)
+    pd.testing.assert_frame_equal(
+        r1.scenario['standard'].material['glass'].matdataIn_m, originalmat)
+    assert (clone.dataIn_m.loc[clone.dataIn_m['year'] >= 1995,
+                               'mod_lifetime'] == 30.0).all()
+
+    del r1.scenario['owned']
+    r1.calculateMassFlow()
+    assert not r1.scenario['standard'].dataOut_m.equals(clone.dataOut_m)
+
+
+def test_overlay_scenario():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.cloneScenario('standard', 'clone')
+    r1.overlayScenario('standard', 'overlay',
+                       edits=[('mod_lifetime', 30.0, 2000)])
+    overlay = r1.scenario['overlay']
+    assert overlay._resolved == {}
+    r1.modifyScenario(['clone', 'overlay'], 'mod_degradation', 1.0,
+                      start_year=2010)
+    for scen in ['clone', 'overlay']:
+        r1.scenario[scen].modifyMaterials('glass', 'mat_virgin_eff', 50.0,
+                                          start_year=2020)
+    r1.modifyScenario('clone', 'mod_lifetime', 30.0, start_year=2000)
+    assert len(overlay.edits) == 2 and len(overlay.material['glass'].edits) == 1
+
+    r1.calculateMassFlow()
+    pd.testing.assert_frame_equal(r1.scenario['clone'].dataOut_m,
+                                  overlay.dataOut_m)
+    pd.testing.assert_frame_equal(
+        r1.scenario['clone'].material['glass'].matdataOut_m,
+        overlay.material['glass'].matdataOut_m)
+    assert (r1.scenario['standard'].dataIn_m['mod_lifetime'] == 15.0).all()
+    # Calculating does not resolve the inputs
+    assert overlay._resolved == {}
+
+    # The resolved inputs are owned by the overlay
+    base = r1.scenario['standard']
+    original = base.dataIn_m.copy()
+    overlay.dataIn_m.loc[5:10, 'mod_eff'] = 3.0
+    overlay.material['glass'].matdataIn_m.iloc[0, 1] = 0
+    pd.testing.assert_frame_equal(base.dataIn_m, original)
+    assert base.material['glass'].matdataIn_m.iloc[0, 1] != 0
+
+    # Overlays see the base as it was when they were created, whether or
+    # not their inputs were read before the base changed.
+    r1.overlayScenario('standard', 'unread')
+    base.dataIn_m.loc[:, 'mod_Repair'] = 7.0
+    base.material['glass'].matdataIn_m['mat_virgin_eff'] = 42.0
+    for scen in ['overlay', 'unread']:
+        pd.testing.assert_series_equal(r1.scenario[scen].dataIn_m['mod_Repair'],
+                                       original['mod_Repair'])
+        assert (r1.scenario[scen].material['glass'].matdataIn_m[
+            'mat_virgin_eff'] != 42.0).all()
+    r1.overlayScenario('standard', 'later')
+    assert (r1.scenario['later'].dataIn_m['mod_Repair'] == 7.0).all()
+
+    r1.overlayScenario('standard', 'same')
+    r1.scenario['same'].addEdit('mod_lifetime', 30.0, 2000)
+    r1.scenario['same'].addEdit('mod_degradation', 1.0, 2010)
+    assert r1.scenario['same'].fingerprint() != overlay.fingerprint()
+    r1.scenario['same'].material['glass'].addEdit('mat_virgin_eff', 50.0, 2020)
+    assert r1.scenario['same'].fingerprint() == overlay.fingerprint()
+
+
+def test_shards(tmp_path):
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    definitions = ['standard'] + [('lifetime_{}'.format(lifetime), 'standard',
+                                   [('mod_lifetime', lifetime, 2000)])
+                                  for lifetime in [20.0, 30.0]]
+    shards = r1.writeShards(str(tmp_path), definitions, shardsize=2,
+                            method='calculateMassFlow')
+    assert len(shards) == 2
+    assert r1.reduceShards(str(tmp_path)) == shards
+
+    # A second worker only finds the shard the first one left
+    assert PV_ICE.runShards(str(tmp_path), maxshards=1) == shards[:1]
+    assert PV_ICE.runShards(str(tmp_path)) == shards[1:]
+    assert PV_ICE.runShards(str(tmp_path)) == []
+    assert r1.reduceShards(str(tmp_path)) == []
+    sharded = {scen: r1.scenario[scen].dataOut_m.copy()
+               for scen in r1.scenario}
+    # Overlay shards refer to their base in bases.pkl
+    assert os.path.getsize(shards[1]) < os.path.getsize(
+        tmp_path / 'bases.pkl')/10
+
+    # Writing to the same folder again clears the previous sweep
+    again = r1.writeShards(str(tmp_path), ['standard'],
+                           method='calculateMassFlow')
+    assert sorted(os.listdir(tmp_path)) == ['bases.pkl', 'shard_00000.pkl']
+    assert r1.reduceShards(str(tmp_path)) == again
+    assert PV_ICE.runShards(str(tmp_path)) == again
+
+    # Only the locks of workers that died on this host are reclaimed, and
+    # the others after the timeout
+    folder = str(tmp_path / 'stale')
+    shards = r1.writeShards(folder, list(r1.scenario), shardsize=2,
+                            method='calculateMassFlow')
+    child = subprocess.Popen([sys.executable, '-c', 'pass'])
+    child.wait()
+    for shard, pid in zip(shards, [child.pid, os.getpid()]):
+        with open(shard.replace('.pkl', '.lock'), 'w') as lock:
+            lock.write('{} {} {}\n'.format(socket.gethostname(), pid,
+                                           time.time()))
+    assert PV_ICE.runShards(folder) == shards[:1]
+    assert PV_ICE.runShards(folder) == []
+    assert PV_ICE.runShards(folder, timeout=0) == shards[1:]
+    assert r1.reduceShards(folder) == []
+
+    r1.calculateMassFlow()
+    assert len(sharded) == 3
+    for scen in r1.scenario:
+        pd.testing.assert_frame_equal(sharded[scen],
+                                      r1.scenario[scen].dataOut_m)
+
+
+def test_checkpoint_resume(tmp_path, capsys):
+    baselines = PV_ICE.main.DATA_PATH
+    r1 = PV_ICE.Simulation()
+    for scen in ['a', 'b', 'c']:
+        r1.createScenario(scen, massmodulefile=os.path.join(
+                              baselines, 'baseline_modules_mass_US.csv'),
+                          energymodulefile=os.path.join(
+                              baselines, 'baseline_modules_energy.csv'))
+        r1.scenario[scen].addMaterials(['glass'], baselinefolder=baselines)
+    r1.scenario['b'].dataIn_m['mod_lifetime'] = 20.0
+    r1.calculateFlows(checkpoint=str(tmp_path))
+    assert len(list(tmp_path.glob('scenario_*.npz'))) == 3
+    expected = {scen: (r1.scenario[scen].dataOut_m.copy(),
+                       r1.scenario[scen].dataOut_e.copy(),
+                       r1.scenario[scen].material['glass'].matdataOut_e.copy())
+                for scen in r1.scenario}
+
+    # Scenarios in the manifest are loaded, the others calculated again
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    del manifest['done']['c']
+    (tmp_path / 'manifest.json').write_text(json.dumps(manifest))
+    for scen in r1.scenario:
+        del r1.scenario[scen].dataOut_m, r1.scenario[scen].dataOut_e
+    r1.calculateFlows(checkpoint=str(tmp_path), resume=True)
+    for scen, (dfm, dfe, dfmat) in expected.items():
+        pd.testing.assert_frame_equal(r1.scenario[scen].dataOut_m, dfm)
+        pd.testing.assert_frame_equal(r1.scenario[scen].dataOut_e, dfe)
+        pd.testing.assert_frame_equal(
+            r1.scenario[scen].material['glass'].matdataOut_e, dfmat)
+
+    # Scenarios whose inputs changed are calculated again, the others loaded
+    r1.scenario['a'].dataIn_m['mod_lifetime'] = 20.0
+    r1.scenario['b'].dataOut_m = None
+    capsys.readouterr()
+    r1.calculateFlows(checkpoint=str(tmp_path), resume=True)
+    assert 'Resuming from checkpoint: 2 ' in capsys.readouterr().out
+    pd.testing.assert_frame_equal(r1.scenario['a'].dataOut_m,
+                                  expected['b'][0])
+    pd.testing.assert_frame_equal(r1.scenario['b'].dataOut_m,
+                                  expected['b'][0])
+    manifest = json.loads((tmp_path / 'manifest.json').read_text())
+    assert len(set(manifest['fingerprints'].values())) == 2
+    assert manifest['fingerprints']['a'] == manifest['fingerprints']['b']
+
+    # And so are all of them when the arguments change
+    r1.scenario['b'].dataOut_m = None
+    r1.calculateFlows(checkpoint=str(tmp_path), resume=True,
+                      nameplatedeglimit=0.95)
+    assert 'Resuming from checkpoint: 0 ' in capsys.readouterr().out
+    assert r1.scenario['b'].dataOut_m is not None
+    assert not r1.scenario['b'].dataOut_m.equals(expected['b'][0])
+
+
+def test_reducers():
+    baselines = PV_ICE.main.DATA_PATH
+    r1 = PV_ICE.Simulation(name='sim')
+    for scen, lifetime in [('a', 20.0), ('b', 30.0), ('c', 40.0)]:
+        r1.createScenario(scen, massmodulefile=os.path.join(
+                              baselines, 'baseline_modules_mass_US.csv'),
+                          energymodulefile=os.path.join(
+                              baselines, 'baseline_modules_energy.csv'))
+        r1.scenario[scen].addMaterials(['glass', 'silicon'],
+                                       baselinefolder=baselines)
+        r1.scenario[scen].dataIn_m['mod_lifetime'] = lifetime
+    reduced = r1.calculateFlows(reducers={
+        'totals': PV_ICE.aggregateScenario,
+        'peak': lambda scenario: scenario.dataOut_m['Effective_Capacity_[W]'].max()})
+    assert reduced is r1.reduced
+    assert not hasattr(r1.scenario['a'], 'dataOut_m')
+    assert 'matdataOut_m' not in vars(r1.scenario['a'].material['glass'])
+
+    r1.calculateFlows()
+    USyearly, UScum = r1.aggregateResults()
+    for scen in r1.scenario:
+        totals = reduced['totals'][scen]
+        expected = USyearly.filter(like='_sim_' + scen)
+        expected.columns = [col.replace('_sim_' + scen, '')
+                            for col in expected.columns]
+        np.testing.assert_allclose(totals[expected.columns].values,
+                                   expected.values)
+
+    peak = PV_ICE.reducedPercentiles(reduced['peak'], [0, 100])
+    assert peak.tolist() == [min(reduced['peak'].values()),
+                             max(reduced['peak'].values())]
+    median = PV_ICE.reducedPercentiles(reduced['totals'], [50])
+    assert median.shape == (len(totals), totals.shape[1])
+
+
+def test_regions(monkeypatch):
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    years = np.arange(2000, 2051)
+    installs = pd.DataFrame({'p1': np.linspace(10, 100, len(years)),
+                             'p2': np.full(len(years), 50.0)}, index=years)
+    results = r1.calculateRegions(installs)
+    assert list(r1.scenario) == ['standard']
+    assert results.values.shape == (1, 2, 100, len(results.metrics))
+
+    # Same as a scenario with those installs
+    r1.cloneScenario('standard', 'p1')
+    r1.scenario['p1'].dataIn_m['new_Installed_Capacity_[MW]'] = (
+        installs['p1'].reindex(r1.scenario['p1'].dataIn_m['year']).fillna(0.0).values)
+    r1.calculateMassFlow(scenarios='p1')
+    expected = PV_ICE.aggregateScenario(r1.scenario['p1'])
+    pd.testing.assert_series_equal(
+        results.frame('VirginStock_Module_[Tonnes]')['p1'],
+        expected['VirginStock_Module_[Tonnes]'], check_names=False)
+    # Regions run with impulseresponse, exact up to cancellation residuals
+    np.testing.assert_allclose(results.values[0, 0], expected.values,
+                               atol=1e-12*np.abs(expected.values).max())
+
+    # Regions are calculated and reduced REDUCE_SCENARIOS at a time
+    monkeypatch.setattr(PV_ICE.main, 'REDUCE_SCENARIOS', 1)
+    chunked = r1.calculateRegions(installs, scenarios='standard')
+    np.testing.assert_allclose(chunked.values, results.values, rtol=1e-12)
+
+
+def test_impulse_response():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    r1.cloneScenario('standard', 'other')
+    r1.calculateMassFlow(impulseresponse=True)
+    assert len(r1._impulseResponses) == 1
+
+    # New installs reuse the cached responses
+    installs = r1.scenario['other'].dataIn_m['new_Installed_Capacity_[MW]']
+    r1.scenario['other'].dataIn_m['new_Installed_Capacity_[MW]'] = (
+        installs*np.linspace(0.5, 2, len(installs)))
+    r1.calculateMassFlow(impulseresponse=True)
+    assert len(r1._impulseResponses) == 1
+    results = {scen: (r1.scenario[scen].dataOut_m,
+                      r1.scenario[scen].material['glass'].matdataOut_m)
+               for scen in r1.scenario}
+
+    # Same up to rounding, relative to the largest flow of each dataframe
+    r1.calculateMassFlow()
+    for scen, (dataOut_m, matdataOut_m) in results.items():
+        expected = r1.scenario[scen].dataOut_m.drop(columns='WeibullParams')
+        np.testing.assert_allclose(
+            dataOut_m.drop(columns='WeibullParams')[expected.columns],
+            expected, rtol=1e-9, atol=1e-12*np.abs(expected.values).max())
+        expected = r1.scenario[scen].material['glass'].matdataOut_m
+        np.testing.assert_allclose(
+            matdataOut_m[expected.columns], expected,
+            rtol=1e-9, atol=1e-12*np.abs(expected.values).max())
+
+
+def test_capacity_target():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    years = r1.scenario['standard'].dataIn_m['year'].values
+    target = pd.Series(np.linspace(100, 10000, len(years)), index=years)
+    r1.calculateMassFlow(capacitytarget=target)
+    dataOut_m = r1.scenario['standard'].dataOut_m
+    assert (dataOut_m['new_Installed_Capacity_[MW]'] >= 0).all()
+    np.testing.assert_allclose(dataOut_m['Effective_Capacity_[W]']/1e6,
+                               target.values)
+
+    # Same as installing the solved capacity
+    r1.cloneScenario('standard', 'solved')
+    r1.scenario['solved'].dataIn_m['new_Installed_Capacity_[MW]'] = (
+        dataOut_m['new_Installed_Capacity_[MW]'].values)
+    r1.calculateMassFlow(scenarios='solved')
+    np.testing.assert_allclose(
+        r1.scenario['solved'].dataOut_m['Effective_Capacity_[W]'],
+        dataOut_m['Effective_Capacity_[W]'])
+
+
+def test_jacobian():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    years = r1.scenario['standard'].dataIn_m['year'].values[15:20]
+    jacobian = r1.calculateJacobian(
+        'standard', ['mat_EnteringModuleManufacturing_total', 'EOL_PG',
+                     'Repaired_Area'],
+        ['mod_EOL_collection_eff', 'mod_Repair', ('glass', 'mat_massperm2')],
+        years=years)
+    assert list(r1.scenario) == ['standard']
+    assert jacobian.shape == (3*100, 3*len(years))
+
+    # Manufacturing needs are area x massperm2 on the same year only
+    dataOut_m = r1.scenario['standard'].dataOut_m
+    dataIn_m = r1.scenario['standard'].dataIn_m
+    manufacturing = jacobian.loc[('glass', 'mat_EnteringModuleManufacturing_total')]
+    expected = np.diag(dataOut_m['Area']*100/dataIn_m['mod_MFG_eff'])[:, 15:20]
+    np.testing.assert_allclose(manufacturing[('glass', 'mat_massperm2')],
+                               expected, rtol=1e-12)
+    assert (manufacturing['module'] == 0).all().all()
+
+    # Path good collected on the year of the collection efficiency is the
+    # area at end of life not resold, and the area repaired is the area
+    # failed before repairs
+    collected = jacobian.loc[('module', 'EOL_PG'),
+                             ('module', 'mod_EOL_collection_eff')]
+    expected = ((dataOut_m['Yearly_Sum_Area_EOLby_ProjectLifetime'] +
+                 dataOut_m['Resold_Area']) *
+                (100 - dataIn_m['mod_EOL_pg0_resell'])/1e4)
+    np.testing.assert_allclose(np.diag(collected.values, -15),
+                               expected[15:20], rtol=1e-12)
+    repaired = jacobian.loc[('module', 'Repaired_Area'),
+                            ('module', 'mod_Repair')]
+    expected = (dataOut_m['Yearly_Sum_Area_EOLby_Failure'] +
+                dataOut_m['Repaired_Area'])/100
+    np.testing.assert_allclose(np.diag(repaired.values, -15),
+                               expected[15:20], rtol=1e-12)
+
+    # Inputs only change the outputs of their year and after
+    for key in jacobian.index.droplevel('year').unique():
+        for field in jacobian.columns.droplevel('year').unique():
+            block = jacobian.loc[key, field].values
+            assert (np.triu(block, -14) == 0).all()
+
+    # Energy flows follow the mass flows
+    baselines = os.path.join(os.path.dirname(PV_ICE.__file__), 'baselines')
+    r2 = PV_ICE.Simulation(dtype=np.float32)
+    r2.createScenario('standard', massmodulefile=MODULEBASELINE,
+                      energymodulefile=os.path.join(
+                          baselines, 'baseline_modules_energy.csv'))
+    r2.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    jacobian = r2.calculateJacobian(
+        'standard', ['mod_MFG', 'EOL_PG'], ['mod_MFG_eff', 'mod_Repair'],
+        years=[2010], method='calculateFlows')
+    assert not np.isnan(jacobian.loc[('module', 'EOL_PG')].values).any()
+    dataOut_m = r2.scenario['standard'].dataOut_m
+    efficiency = r2.scenario['standard'].dataIn_m['mod_MFG_eff']
+    years = r2.scenario['standard'].dataIn_m['year'].values
+    # Energy inputs end before the simulation does
+    energy = r2.scenario['standard'].dataIn_e['e_mod_MFG'].values
+    known = len(energy)
+    expected = (-dataOut_m['Area']*100/efficiency**2)[:known]*energy
+    mfg = jacobian.loc[('module', 'mod_MFG'), ('module', 'mod_MFG_eff', 2010)]
+    np.testing.assert_allclose(
+        mfg.values[:known],
+        np.where(years[:known] == 2010, expected, 0), rtol=1e-12)
+    assert not getattr(r2, '_impulseResponses', None)
+
+    # Fields moving the retirement ages are not differentiable
+    with pytest.raises(ValueError):
+        r2.calculateJacobian('standard', 'EOL_PG', 'mod_lifetime')
+
+
+def test_carryover_derivative():
+    balance = np.array([2., -1., -3., 1.])
+    carry = PV_ICE.main._carryoverSurplus(balance)
+    np.testing.assert_array_equal(carry, [2, 1, 0, 1])
+    # Carry runs out on the third year, so the balances before it stop
+    # counting from then on
+    jacobian = PV_ICE.main._carryoverDerivative(carry, np.eye(4)).T
+    np.testing.assert_array_equal(jacobian, [[1, 0, 0, 0], [1, 1, 0, 0],
+                                             [0, 0, 0, 0], [0, 0, 0, 1]])
+
+
+def test_optimize_levers():
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+
+    def virgin(scen):
+        results = PV_ICE.aggregateScenario(scen)
+        return results.loc[2030:2050, 'VirginStock_glass_[Tonnes]'].sum()
+
+    # Virgin stock with a 60% recycling yield from 2020
+    r1.overlayScenario('standard', 'yield60')
+    r1.scenario['yield60'].material['glass'].addEdit(
+        'mat_Recycling_yield', 60, 2020)
+    r1.calculateMassFlow(scenarios='yield60')
+    limit = virgin(r1.scenario['yield60'])
+
+    # Lowest yield keeping the virgin stock under that limit
+    lever = (('glass', 'mat_Recycling_yield'), 0, 100, 2020)
+    result = r1.optimizeLevers(
+        'standard', [lever],
+        objective=lambda scen: scen.material['glass'].matdataIn_m[
+            'mat_Recycling_yield'].iloc[-1],
+        constraints=[lambda scen: virgin(scen) - limit], name='best')
+    assert result['success']
+    assert abs(result['x'].iloc[0] - 60) < 0.1
+    assert virgin(r1.scenario['best']) <= limit
+    assert sorted(r1.scenario) == ['best', 'standard', 'yield60']
+
+
+def test_surrogate(tmp_path):
+    r1 = PV_ICE.Simulation()
+    r1.createScenario('standard', massmodulefile=MODULEBASELINE)
+    r1.scenario['standard'].addMaterial('glass', massmatfile=MATERIALBASELINE)
+    levers = [(('glass', 'mat_massperm2'), 5000, 15000, 2020),
+              ('mod_EOL_collection_eff', 20, 80, 2020)]
+    metrics = ['WasteEOL_glass_[Tonnes]', 'WasteAll_Module_[Tonnes]']
+    surrogate = r1.trainSurrogate('standard', levers, metrics, degree=2,
+                                  seed=0)
+    assert list(r1.scenario) == ['standard']
+
+    values, errors = surrogate.predict([10000, 50], errors=True)
+    assert values.shape == errors.shape == (100, 2)
+    assert surrogate.predict([[10000, 50], [6000, 30]]).shape == (200, 2)
+
+    # Waste is bilinear on mass and collection, so the fit is exact
+    validation = surrogate.validate(r1, nsamples=4, seed=1)
+    assert (validation['max_error'] <= 1e-9*validation['scale']).all()
+
+    surrogate.save(tmp_path / 'surrogate.npz')
+    loaded = PV_ICE.Surrogate.load(tmp_path / 'surrogate.npz')
+    assert loaded.labels == surrogate.labels
+    pd.testing.assert_frame_equal(loaded.predict([10000, 50]), values)